@@ -3,7 +3,16 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 
+# Order of the gates in the fused convolutions: the three sigmoid gates first, then the cell candidate
+GATES = ('i', 'f', 'o', 'c')
+
+
 class MyConvLSTMCell(nn.Module):
+    """ConvLSTM cell computing the four gates with one input conv and one hidden conv.
+
+    Checkpoints of the former per-gate layout (conv_i_xx, conv_i_hh, ...) are converted
+    when loaded, the weights of the gates are concatenated in the GATES order.
+    """
 
     def __init__(self, input_size, hidden_size, kernel_size=3, stride=1, padding=1):
         super(MyConvLSTMCell, self).__init__()
@@ -12,47 +21,60 @@ class MyConvLSTMCell(nn.Module):
         self.kernel_size = kernel_size
         self.stride = stride
         self.padding = padding
-        self.conv_i_xx = nn.Conv2d(input_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding)
-        self.conv_i_hh = nn.Conv2d(hidden_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding,
-                                   bias=False)
-
-        self.conv_f_xx = nn.Conv2d(input_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding)
-        self.conv_f_hh = nn.Conv2d(hidden_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding,
-                                   bias=False)
+        self.conv_xx = nn.Conv2d(input_size, 4 * hidden_size, kernel_size=kernel_size, stride=stride, padding=padding)
+        self.conv_hh = nn.Conv2d(hidden_size, 4 * hidden_size, kernel_size=kernel_size, stride=stride, padding=padding,
+                                 bias=False)
 
-        self.conv_c_xx = nn.Conv2d(input_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding)
-        self.conv_c_hh = nn.Conv2d(hidden_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding,
-                                   bias=False)
+        # initialized gate by gate, as the separate convs were
+        for gate in range(len(GATES)):
+            torch.nn.init.xavier_normal_(self.conv_xx.weight[gate * hidden_size:(gate + 1) * hidden_size])
+            torch.nn.init.xavier_normal_(self.conv_hh.weight[gate * hidden_size:(gate + 1) * hidden_size])
+        torch.nn.init.constant_(self.conv_xx.bias, 0)
 
-        self.conv_o_xx = nn.Conv2d(input_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding)
-        self.conv_o_hh = nn.Conv2d(hidden_size, hidden_size, kernel_size=kernel_size, stride=stride, padding=padding,
-                                   bias=False)
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        for conv, params in (('xx', ('weight', 'bias')), ('hh', ('weight',))):
+            for param in params:
+                old_keys = [prefix + 'conv_{}_{}.{}'.format(gate, conv, param) for gate in GATES]
+                if all(key in state_dict for key in old_keys):
+                    state_dict[prefix + 'conv_{}.{}'.format(conv, param)] = torch.cat(
+                        [state_dict.pop(key) for key in old_keys], 0)
+        super(MyConvLSTMCell, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                          unexpected_keys, error_msgs)
 
-        torch.nn.init.xavier_normal_(self.conv_i_xx.weight)
-        torch.nn.init.constant_(self.conv_i_xx.bias, 0)
-        torch.nn.init.xavier_normal_(self.conv_i_hh.weight)
-
-        torch.nn.init.xavier_normal_(self.conv_f_xx.weight)
-        torch.nn.init.constant_(self.conv_f_xx.bias, 0)
-        torch.nn.init.xavier_normal_(self.conv_f_hh.weight)
-
-        torch.nn.init.xavier_normal_(self.conv_c_xx.weight)
-        torch.nn.init.constant_(self.conv_c_xx.bias, 0)
-        torch.nn.init.xavier_normal_(self.conv_c_hh.weight)
+    def forward(self, x, state):
+        # type: (Tensor, Optional[Tuple[Tensor, Tensor]]) -> Tuple[Tensor, Tensor]
+        return self.step(self.conv_xx(x), state)
 
-        torch.nn.init.xavier_normal_(self.conv_o_xx.weight)
-        torch.nn.init.constant_(self.conv_o_xx.bias, 0)
-        torch.nn.init.xavier_normal_(self.conv_o_hh.weight)
+    @torch.jit.export
+    def forward_sequence(self, xs, state):
+        # type: (Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tensor]
+        """Runs the cell over a whole (T x B x C x H x W) sequence and returns the final (ht, ct).
+        The input convolution of every timestep is computed as one conv over T*B,
+        only the hidden convolution stays in the recurrence. Exported when the cell is scripted,
+        so that the recurrence keeps its loop in a traced model (see exportModel.py).
+        """
+        seq_len, batch = xs.size(0), xs.size(1)
+        gates_x = self.conv_xx(xs.reshape(seq_len * batch, xs.size(2), xs.size(3), xs.size(4)))
+        gates_x = gates_x.view(seq_len, batch, gates_x.size(1), gates_x.size(2), gates_x.size(3))
+        for t in range(seq_len):
+            state = self.step(gates_x[t], state)
+        return state
 
-    def forward(self, x, state):
+    def step(self, gates_x, state):
+        # type: (Tensor, Optional[Tuple[Tensor, Tensor]]) -> Tuple[Tensor, Tensor]
+        """One timestep, gates_x being the input convolution conv_xx(x) of that timestep"""
         if state is None:
-            state = (Variable(torch.randn(x.size(0), x.size(1), x.size(2), x.size(3)).cuda()),
-                     Variable(torch.randn(x.size(0), x.size(1), x.size(2), x.size(3)).cuda()))
-        ht_1, ct_1 = state
-        it = torch.sigmoid(self.conv_i_xx(x) + self.conv_i_hh(ht_1))
-        ft = torch.sigmoid(self.conv_f_xx(x) + self.conv_f_hh(ht_1))
-        ct_tilde = torch.tanh(self.conv_c_xx(x) + self.conv_c_hh(ht_1))
+            shape = [gates_x.size(0), self.hidden_size, gates_x.size(2), gates_x.size(3)]
+            ht_1 = torch.randn(shape, device=gates_x.device, dtype=gates_x.dtype)
+            ct_1 = torch.randn(shape, device=gates_x.device, dtype=gates_x.dtype)
+        else:
+            ht_1, ct_1 = state
+        # the gates and the cell state ct are computed in fp32, also when the convs run under bf16 autocast
+        gates = gates_x.float() + self.conv_hh(ht_1).float()
+        sig_gates = torch.sigmoid(gates[:, :3 * self.hidden_size])
+        it, ft, ot = sig_gates.chunk(3, 1)
+        ct_tilde = torch.tanh(gates[:, 3 * self.hidden_size:])
         ct = (ct_tilde * it) + (ct_1 * ft)
-        ot = torch.sigmoid(self.conv_o_xx(x) + self.conv_o_hh(ht_1))
         ht = ot * torch.tanh(ct)
         return ht, ct
@@ -4,6 +4,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from torch.autograd import Variable
 from MyConvLSTMCell import *
+from timeDistributed import time_distributed
 from objectAttentionModelConvLSTM import attentionModel
 
 
@@ -35,31 +36,51 @@ class attentionModel_ml(nn.Module):
             
             
     def forward(self, inputVariable):
-        state = (Variable(torch.zeros((inputVariable.size(1), self.mem_size, 7, 7)).cuda()),
-                 Variable(torch.zeros((inputVariable.size(1), self.mem_size, 7, 7)).cuda()))
-        output_msnet = []
-        for t in range(inputVariable.size(0)): #frame
-            logit, feature_conv, feature_convNBN = self.resNet(inputVariable[t])
-            bz, nc, h, w = feature_conv.size()
-            feature_conv1 = feature_conv.view(bz, nc, h*w)
-            probs, idxs = logit.sort(1, True)
-            class_idx = idxs[:, 0]
-            cam = torch.bmm(self.weight_softmax[class_idx].unsqueeze(1), feature_conv1)
+        return self.forward_features(self.features(inputVariable))
+
+    def forward_layer3(self, layer3):
+        """Forward from the layer3 activations of the clip, e.g. read from extractFeatures.py --level layer3"""
+        return self.forward_features(self.features_layer3(layer3))
+
+    def features(self, inputVariable):
+        """CAM weighted features (T x B x 512 x 7 x 7) of a clip, input of the MS head and of the ConvLSTM"""
+        return self.features_layer3(time_distributed(self.resNet.forward_prefix, inputVariable, self.resNet))
+
+    def features_layer3(self, layer3):
+        """Same as features, from the layer3 activations (T x B x 256 x 14 x 14) of the clip"""
+        # backbone and attention of all the frames at once, (T*B) x ...
+        seq_len = layer3.size(0)
+        logit, feature_conv, feature_convNBN = time_distributed(self.resNet.forward_layer4, layer3, self.resNet)
+        _, bz, nc, h, w = feature_conv.size()
+        feature_conv1 = feature_conv.view(seq_len*bz, nc, h*w)
+        # CAM of the top scoring class of each frame
+        class_idx = logit.view(seq_len*bz, -1).argmax(1)
+        # the CAM and its softmax stay in fp32 under autocast
+        with torch.autocast(feature_conv.device.type, enabled=False):
+            cam = torch.bmm(self.weight_softmax[class_idx].unsqueeze(1), feature_conv1.float())
             attentionMAP = torch.softmax(cam.squeeze(1), dim=1)
-            attentionMAP = attentionMAP.view(attentionMAP.size(0), 1, 7, 7)
-            attentionFeat = feature_convNBN * attentionMAP.expand_as(feature_conv)
+        attentionMAP = attentionMAP.view(seq_len, bz, 1, 7, 7)
+        return feature_convNBN * attentionMAP.expand_as(feature_conv)
+
+    def forward_features(self, lstm_input):
+        """Rest of the forward from the output of features, e.g. read from extractFeatures.py"""
+        # initial state on the device of the input
+        state = (lstm_input.new_zeros((lstm_input.size(1), self.mem_size, 7, 7)),
+                 lstm_input.new_zeros((lstm_input.size(1), self.mem_size, 7, 7)))
+        # MS head of all the frames at once, (T*B) x ...
+        seq_len, bz, nc, h, w = lstm_input.size()
+        attentionFeat = lstm_input.reshape(seq_len*bz, nc, h, w)
 
-            x = self.conv(attentionFeat)
-            x = x.view(x.size(0), -1) #32,4900
-            if self.regressor == 0:
-                x = self.clas(x).view(x.size(0),7*7,2)
-                x = self.soft(x)
-            elif self.regressor == 1:
-                x = self.clas(x).view(x.size(0),7*7)   
-            output_msnet.append(x)
-            state = self.lstm_cell(attentionFeat, state)
+        x = self.conv(attentionFeat)
+        x = x.reshape(x.size(0), -1) #25*32,4900, reshape as x may be channels last
+        if self.regressor == 0:
+            x = self.clas(x).view(x.size(0),7*7,2)
+            x = self.soft(x)
+        elif self.regressor == 1:
+            x = self.clas(x).view(x.size(0),7*7)
+        output_msnet = x.view(seq_len, bz, *x.shape[1:]) #25*32*49*2
 
-        output_msnet = torch.stack(output_msnet, 0) #7*32*49*2
+        state = self.lstm_cell.forward_sequence(attentionFeat.view(seq_len, bz, nc, h, w), state)
         feats1 = self.avgpool(state[1]).view(state[1].size(0), -1)
         feats = self.classifier(feats1)
         return feats, output_msnet
@@ -0,0 +1,110 @@
+import time
+import argparse
+import torch
+from objectAttentionModelConvLSTM import attentionModel
+from attentionmodel_ml import attentionModel_ml
+from flow_camModel import attentionModel_flow
+from flow_resnet import flow_resnet34
+from twoStreamModel import twoStreamAttentionModel
+from devices import get_device, setup_device, prepare_model
+from onnxBackend import onnx_model
+
+
+def make_model(name, num_classes, stackSize, memSize=512):
+    """Untrained model of each name of the tools, memSize being the ConvLSTM hidden state size"""
+    if name == 'rgb':
+        return attentionModel(num_classes=num_classes, mem_size=memSize)
+    if name == 'ms':
+        return attentionModel_ml(num_classes=num_classes, mem_size=memSize)
+    if name == 'flow':
+        return flow_resnet34(False, channels=2 * stackSize, num_classes=num_classes)
+    if name == 'rgbflow':
+        return attentionModel_flow(num_classes=num_classes, mem_size=memSize)
+    if name == 'twoStream':
+        return twoStreamAttentionModel(stackSize=stackSize, memSize=memSize, num_classes=num_classes)
+    raise ValueError('Unknown model {}'.format(name))
+
+
+def make_inputs(name, batchSize, seqLen, stackSize):
+    """Random inputs of the shape the training scripts feed to each model"""
+    if name == 'flow':
+        return (torch.randn(batchSize, 2 * stackSize, 224, 224),)
+    if name == 'rgbflow':
+        return torch.randn(seqLen, batchSize, 2, 224, 224), torch.randn(seqLen, batchSize, 3, 224, 224)
+    if name == 'twoStream':
+        return torch.randn(batchSize, 2 * stackSize, 224, 224), torch.randn(seqLen, batchSize, 3, 224, 224)
+    return (torch.randn(seqLen, batchSize, 3, 224, 224),)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run(model, inputs, device, iters, warmup):
+    """Clips per second of the inference forward of model"""
+    inputs = [x.to(device) for x in inputs]
+    batchSize = inputs[-1].size(1) if inputs[-1].dim() == 5 else inputs[-1].size(0)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(*inputs)
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(*inputs)
+        _sync(device)
+    return iters * batchSize / (time.perf_counter() - start)
+
+
+def main_run(model_name, device, cpuThreads, batchSize, seqLen, stackSize, iters, warmup, compare_profile, backend='torch'):
+    model = make_model(model_name, 61, stackSize)
+    model.train(False)
+    inputs = make_inputs(model_name, batchSize, seqLen, stackSize)
+
+    device = get_device(device)
+    if compare_profile:
+        # plain model.to(device) of the same model code, before the profile changes the global torch
+        # settings. It isolates the device profile, the model changes of the series are in both timings
+        model.to(device)
+        plain = run(model, inputs, device, iters, warmup)
+        print('{} on {}, plain .to(device): {:.2f} clips/s'.format(model_name, device, plain))
+    setup_device(str(device), cpuThreads)
+    prepare_model(model, device)
+    profiled = run(model, inputs, device, iters, warmup)
+    print('{} on {}, {} threads, device profile: {:.2f} clips/s'.format(
+        model_name, device, torch.get_num_threads(), profiled))
+    if compare_profile:
+        print('Device profile / plain .to(device) = {:.2f}x'.format(profiled / plain))
+    if backend == 'onnxruntime':
+        # same model and clips through the ORT session
+        session = onnx_model(model, model_name, inputs, device, cpuThreads)
+        ort_rate = run(session, inputs, device, iters, warmup)
+        print('{} on {}, onnxruntime: {:.2f} clips/s | Speedup over eager = {:.2f}x'.format(
+            model_name, device, ort_rate, ort_rate / profiled))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='rgb', choices=['rgb', 'ms', 'flow', 'rgbflow', 'twoStream'],
+                        help='Model to time')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
+    parser.add_argument('--batchSize', type=int, default=1, help='Clips per forward')
+    parser.add_argument('--seqLen', type=int, default=25, help='Length of sequence')
+    parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input (flow model)')
+    parser.add_argument('--iters', type=int, default=10, help='Timed forwards')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed forwards before timing')
+    parser.add_argument('--compareProfile', action='store_true',
+                        help='Also time the same model with a plain model.to(device) and print the gain of the '
+                             'device profile alone (not a comparison with the original code)')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+                        help='Also export the model to ONNX and time it with onnxruntime on the same clips')
+
+    args = parser.parse_args()
+
+    main_run(args.model, args.device, args.cpuThreads, args.batchSize, args.seqLen, args.stackSize, args.iters,
+             args.warmup, args.compareProfile, args.backend)
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,179 @@
+import os
+import io
+import json
+import mmap
+import struct
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from datasetManifest import load_manifest, manifest_trees, LEAVES
+
+
+# A clip archive packs every frame of one instance (rgb, mmaps, flow_x, flow_y) in a single file:
+#   MAGIC | uint64 index offset | uint64 index length | frame blobs ... | JSON index
+# The index maps a member name ('processed_frames2/rgb/rgb0001.png', 'flow_x_processed/flow_x_00001.png')
+# to [offset, length] for PNG blobs, or [offset, length, mode, width, height] for raw pixels.
+MAGIC = b'EGOCLIP1'
+HEADER = struct.Struct('<8sQQ')
+ARCHIVE_EXT = '.clip'
+
+
+class ClipArchive(object):
+    """Read-only, memory-mapped view of one clip archive."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise IOError('{} is not a clip archive'.format(path))
+        self.index = json.loads(bytes(self.mm[index_offset:index_offset + index_length]).decode('utf-8'))
+        self.view = memoryview(self.mm)
+
+    def __contains__(self, member):
+        return member in self.index
+
+    def open(self, member):
+        """Returns the frame as a PIL image. Raw frames are sliced from the mapping and skip the image
+        decode, PIL still copies their pixels (and FrameLoader converts them to the requested mode)."""
+        entry = self.index[member]
+        data = self.view[entry[0]:entry[0] + entry[1]]
+        if len(entry) == 2:
+            return Image.open(io.BytesIO(data))
+        mode, w, h = entry[2:]
+        return Image.frombuffer(mode, (w, h), data, 'raw', mode, 0, 1)
+
+
+class ArchiveStore(object):
+    """Maps frame paths under root_dir to members of the clip archives in archive_dir.
+
+    GTEA61/processed_frames2/S1/close_choco/1/rgb/rgb0001.png is read from
+    archive_dir/S1/close_choco/1.clip, member processed_frames2/rgb/rgb0001.png.
+    At most max_open archives stay mapped per process.
+    """
+
+    def __init__(self, root_dir, archive_dir, max_open=256):
+        self.root_dir = os.path.abspath(root_dir)
+        self.archive_dir = archive_dir
+        self.max_open = max_open
+        self.archives = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def locate(self, path):
+        parts = os.path.relpath(os.path.abspath(path), self.root_dir).split(os.sep)
+        tree, user, target, inst = parts[:4]
+        shard = os.path.join(self.archive_dir, user, target, inst + ARCHIVE_EXT)
+        return shard, '/'.join([tree] + parts[4:])
+
+    def archive(self, shard):
+        with self.lock:
+            if shard in self.archives:
+                self.archives.move_to_end(shard)
+                return self.archives[shard]
+            if not os.path.exists(shard):
+                return None
+            archive = ClipArchive(shard)
+            self.archives[shard] = archive
+            if len(self.archives) > self.max_open:
+                # unmapped once the frames still referencing it are released
+                self.archives.popitem(last=False)
+            return archive
+
+    def exists(self, path):
+        shard, member = self.locate(path)
+        archive = self.archive(shard)
+        return archive is not None and member in archive
+
+    def open(self, path):
+        shard, member = self.locate(path)
+        archive = self.archive(shard)
+        if archive is None or member not in archive:
+            raise FileNotFoundError(path)
+        return archive.open(member)
+
+    def __getstate__(self):
+        # mappings are reopened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['archives'] = collections.OrderedDict()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def pack_instance(members, out_path, raw=False):
+    """Writes one archive. members is a list of (member name, source png or jpg path).
+
+    With raw=True frames are stored decoded ('RGB' for rgb frames, 'L' for flow and maps, the
+    modes the datasets convert to), so readers get them from the mapping with no decode at all.
+    """
+    index = {}
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for member, src in members:
+            offset = f.tell()
+            if raw:
+                img = Image.open(src)
+                img = img.convert('RGB' if '/rgb/' in member else 'L')
+                f.write(img.tobytes())
+                index[member] = [offset, f.tell() - offset, img.mode, img.size[0], img.size[1]]
+            else:
+                with open(src, 'rb') as s:
+                    f.write(s.read())
+                index[member] = [offset, f.tell() - offset]
+        index_offset = f.tell()
+        blob = json.dumps(index, separators=(',', ':')).encode('utf-8')
+        f.write(blob)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(blob)))
+    os.replace(tmp_path, out_path)
+
+
+def plan_archives(root_dir, manifest):
+    """Groups the frames of every (user, class, instance) of all trees into one member list"""
+    plan = collections.OrderedDict()
+    for tree in manifest_trees(manifest):
+        for user, u in sorted(manifest['trees'][tree]['users'].items()):
+            for target, c in sorted(u['classes'].items()):
+                for inst in sorted(c['insts']):
+                    members = plan.setdefault((user, target, inst), [])
+                    for leaf in LEAVES.get(tree, ('',)):
+                        src_dir = os.path.join(root_dir, tree, user, target, inst, leaf)
+                        if not os.path.isdir(src_dir):
+                            continue
+                        prefix = '/'.join(p for p in (tree, leaf) if p)
+                        for name in sorted(n for n in os.listdir(src_dir) if n.endswith(('.png', '.jpg'))):
+                            members.append((prefix + '/' + name, os.path.join(src_dir, name)))
+    return plan
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetDir', type=str, required=True, help='Dataset directory')
+    parser.add_argument('--archiveDir', type=str, required=True, help='Directory to write the clip archives to')
+    parser.add_argument('--raw', action='store_true', help='Store decoded pixels instead of the png / jpg files')
+    parser.add_argument('--workers', type=int, default=8, help='Archives written in parallel')
+
+    args = parser.parse_args()
+
+    plan = plan_archives(args.datasetDir, load_manifest(args.datasetDir))
+
+    def pack(item):
+        (user, target, inst), members = item
+        out_dir = os.path.join(args.archiveDir, user, target)
+        os.makedirs(out_dir, exist_ok=True)
+        pack_instance(members, os.path.join(out_dir, inst + ARCHIVE_EXT), args.raw)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(pack, plan.items()))
+    print('Packed {} instances into {}'.format(len(plan), args.archiveDir))
+
+
+if __name__ == '__main__':
+    __main__()
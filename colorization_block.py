@@ -6,6 +6,7 @@ from torch.nn import functional as F
 from torch.autograd import Variable
 from MyConvLSTMCell import *
 from objectAttentionModelConvLSTM import attentionModel
+from timeDistributed import time_distributed
 from PIL import Image
 import numpy as np
 from torchvision.utils import save_image
@@ -55,22 +56,23 @@ class colorization(nn.Module):
         self.RGBnet = attentionModel(num_classes=num_classes, mem_size=512)
         self.k=0
 
-    def forward(self,inputVariable,f_print=0):
-        flow_list =[]
-        for t in range(inputVariable.size(0)):
-            x=self.conv1(inputVariable[t])
-            
-            x=self.bn1(x) 
-            x=self.relu(x) 
-            x=self.maxpool(x)
-            
-            
-            x=self.residual_block(x)
+    def colorize(self, x):
+        x=self.conv1(x)
+
+        x=self.bn1(x)
+        x=self.relu(x)
+        x=self.maxpool(x)
+
+
+        x=self.residual_block(x)
 
-            x=self.conv2(x) 
-            x=self.upS(x)
-            flow_list.append(x)
-        flow_list = torch.stack(flow_list, 0)
+        x=self.conv2(x)
+        x=self.upS(x)
+        return x
+
+    def forward(self,inputVariable,f_print=0):
+        # all the frames at once, unless the batch norms are training
+        flow_list = time_distributed(self.colorize, inputVariable, self.bn1, self.residual_block)
         if f_print==1:
             self.k+=1
             path='/content/Images/'+str(self.k)
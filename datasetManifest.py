@@ -0,0 +1,245 @@
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# The manifests are kept out of the scanned tree: writing one into root_dir would change the mtime of
+# root_dir recorded in it, and the dataset dir may be read-only (network storage)
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gtea61_manifests')
+MANIFEST_VERSION = 1
+
+# Sub-directories of an instance that hold frames, per tree. Trees not listed here
+# (flow_x_processed, flow_y_processed, ...) keep their frames directly in the instance dir.
+LEAVES = {'processed_frames2': ('rgb', 'mmaps')}
+
+_manifests = {}  # root_dir -> manifest, so train/val datasets of one run share a single refresh
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _subdirs(path):
+    """Sorted sub-directory names of path, skipping .DS_Store"""
+    with os.scandir(path) as it:
+        return sorted(e.name for e in it if e.name != '.DS_Store' and e.is_dir())
+
+
+def _count_png(path):
+    """Same count as len(glob.glob1(path, '*.png')), without building the list of names"""
+    try:
+        with os.scandir(path) as it:
+            return sum(1 for e in it if e.name.endswith('.png') and not e.name.startswith('.'))
+    except FileNotFoundError:
+        return 0
+
+
+def _scan_class(class_dir, leaves, old):
+    """Lists the instances of a class dir and counts their frames.
+
+    Directories whose mtime did not change since the previous manifest are not read again.
+    Returns the new class entry {'mtime', 'insts': {inst: {leaf: [mtime, count]}}}.
+    """
+    mtime = _mtime(class_dir)
+    old = old or {}
+    old_insts = old.get('insts', {})
+    if mtime == old.get('mtime'):
+        insts = sorted(old_insts)
+    else:
+        insts = _subdirs(class_dir)
+    entry = {'mtime': mtime, 'insts': {}}
+    for inst in insts:
+        old_inst = old_insts.get(inst, {})
+        counts = {}
+        for leaf in leaves:
+            leaf_dir = os.path.join(class_dir, inst, leaf) if leaf else os.path.join(class_dir, inst)
+            leaf_mtime = _mtime(leaf_dir)
+            prev = old_inst.get(leaf)
+            if prev is not None and prev[0] == leaf_mtime:
+                counts[leaf] = prev
+            else:
+                counts[leaf] = [leaf_mtime, _count_png(leaf_dir)]
+        entry['insts'][inst] = counts
+    return entry
+
+
+def _listing(path, old, key):
+    """Sub-directories of path, reusing the previous listing when the dir mtime is unchanged"""
+    mtime = _mtime(path)
+    if old is not None and old.get('mtime') == mtime:
+        return mtime, sorted(old[key])
+    return mtime, _subdirs(path)
+
+
+def manifest_path(root_dir):
+    """Default manifest file of root_dir in MANIFEST_DIR, named after its absolute path"""
+    root_dir = os.path.abspath(root_dir)
+    digest = hashlib.sha1(root_dir.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(MANIFEST_DIR, '{}-{}.json'.format(os.path.basename(root_dir) or 'root', digest))
+
+
+def build_manifest(root_dir, old=None, workers=16):
+    """Scans root_dir (GTEA61/ with processed_frames2/, flow_x_processed/, ...) into a manifest.
+
+    The tree/user levels are walked sequentially, class directories are scanned in a thread
+    pool. When old is given, only directories whose mtime changed are listed again.
+    """
+    old_trees = (old or {}).get('trees', {})
+    manifest = {'version': MANIFEST_VERSION, 'trees': {}}
+    for key in (old or {}):
+        if key not in ('version', 'trees'):
+            manifest[key] = old[key]  # extra metadata, e.g. the pre-resized short side
+
+    jobs = []
+    tree_mtime, trees = _listing(root_dir, old, 'trees')
+    manifest['mtime'] = tree_mtime
+    for tree in trees:
+        tree_dir = os.path.join(root_dir, tree)
+        old_tree = old_trees.get(tree)
+        mtime, users = _listing(tree_dir, old_tree, 'users')
+        manifest['trees'][tree] = {'mtime': mtime, 'users': {}}
+        for user in users:
+            user_dir = os.path.join(tree_dir, user)
+            old_user = old_tree['users'].get(user) if old_tree else None
+            mtime, targets = _listing(user_dir, old_user, 'classes')
+            manifest['trees'][tree]['users'][user] = {'mtime': mtime, 'classes': {}}
+            for target in targets:
+                old_class = old_user['classes'].get(target) if old_user else None
+                jobs.append((tree, user, target, os.path.join(user_dir, target), old_class))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = pool.map(lambda job: _scan_class(job[3], LEAVES.get(job[0], ('',)), job[4]), jobs)
+        for (tree, user, target, _, _), entry in zip(jobs, entries):
+            manifest['trees'][tree]['users'][user]['classes'][target] = entry
+    return manifest
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Could not write dataset manifest {}: {}'.format(path, e))
+
+
+def load_manifest(root_dir, path=None, workers=16, refresh=True):
+    """Returns the manifest of root_dir, refreshing the on-disk copy incrementally.
+
+    Args:
+        root_dir (string): Dataset root, the directory passed as trainDatasetDir/valDatasetDir.
+        path (string, optional): Manifest file. Defaults to manifest_path(root_dir), out of the dataset tree.
+        workers (int): Threads used to scan class directories.
+        refresh (bool): If False, an existing manifest is trusted as it is.
+    """
+    key = os.path.abspath(root_dir)
+    if key in _manifests:
+        return _manifests[key]
+    if path is None:
+        path = manifest_path(root_dir)
+    old = None
+    if os.path.exists(path):
+        with open(path) as f:
+            old = json.load(f)
+        if old.get('version') != MANIFEST_VERSION:
+            old = None
+    if old is not None and not refresh:
+        manifest = old
+    else:
+        manifest = build_manifest(root_dir, old, workers)
+        if manifest != old:
+            save_manifest(manifest, path)
+    _manifests[key] = manifest
+    return manifest
+
+
+def manifest_trees(manifest):
+    return sorted(manifest['trees'])
+
+
+def iter_instances(root_dir, manifest, tree, phase):
+    """Yields (dir_user, class_id, inst_dir, counts) for one tree, in the order of the old
+    os.listdir walk of gen_split. class_id is the index of the class in the sorted class dirs
+    of the user, counts maps each leaf ('rgb', 'mmaps', or '' for flow) to its frame count.
+    """
+    users = manifest['trees'].get(tree, {'users': {}})['users']
+    for dir_user in sorted(users):
+        if not ((phase == 'train') ^ (dir_user == "S2")):
+            continue
+        classes = users[dir_user]['classes']
+        for class_id, target in enumerate(sorted(classes)):
+            insts = classes[target]['insts']
+            for inst in sorted(insts):
+                inst_dir = os.path.join(root_dir, tree, dir_user, target, inst)
+                counts = {leaf: value[1] for leaf, value in insts[inst].items()}
+                yield dir_user, class_id, inst_dir, counts
+
+
+def join_instances(root_dir, manifest, trees, phase):
+    """Joins the instances of several trees on (user, class, instance) in one pass over the manifest.
+
+    class_id is taken from the first tree, like the labels of the old gen_split.
+    Returns (joined, incomplete): joined is a list of (dir_user, class_id, {tree: (inst_dir, counts)})
+    for the instances present in every tree, incomplete a list of ((user, class, instance), missing trees).
+    """
+    found = {}
+    for tree in trees:
+        users = manifest['trees'].get(tree, {'users': {}})['users']
+        for dir_user in sorted(users):
+            if not ((phase == 'train') ^ (dir_user == "S2")):
+                continue
+            classes = users[dir_user]['classes']
+            for class_id, target in enumerate(sorted(classes)):
+                insts = classes[target]['insts']
+                for inst in sorted(insts):
+                    entry = found.setdefault((dir_user, target, inst), {'class_id': class_id, 'trees': {}})
+                    entry['trees'][tree] = (os.path.join(root_dir, tree, dir_user, target, inst),
+                                            {leaf: value[1] for leaf, value in insts[inst].items()})
+
+    joined = []
+    incomplete = []
+    for key in sorted(found):
+        entry = found[key]
+        missing = [tree for tree in trees if tree not in entry['trees']]
+        if missing:
+            incomplete.append((key, missing))
+        else:
+            joined.append((key[0], entry['class_id'], entry['trees']))
+    return joined, incomplete
+
+
+def clip_key(inst_dir):
+    """Instance of a clip dir of any tree, e.g. S1/close_choco/1 for GTEA61/flow_x_processed/S1/close_choco/1,
+    GTEA61/processed_frames2/S1/close_choco/1/rgb and .../mmaps, so that the dataset dirs, the splits and
+    the runs of the rgb and flow models line up
+    """
+    parts = os.path.normpath(inst_dir).split(os.sep)
+    if parts[-1] in [leaf for leaves in LEAVES.values() for leaf in leaves]:
+        parts = parts[:-1]
+    return '/'.join(parts[-3:])
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetDir', type=str, required=True, help='Dataset directory')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifest path (default: a file of ~/.cache/gtea61_manifests named after datasetDir)')
+    parser.add_argument('--workers', type=int, default=16, help='Threads used to scan the dataset')
+
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.datasetDir, args.manifest, args.workers)
+    for tree in manifest_trees(manifest):
+        numInsts = sum(len(c['insts']) for u in manifest['trees'][tree]['users'].values()
+                       for c in u['classes'].values())
+        print('{}: {} instances'.format(tree, numInsts))
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,40 @@
+import torch
+
+
+def get_device(name='auto'):
+    """torch.device of --device: 'auto' is cuda when available, cpu otherwise"""
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(name)
+
+
+def setup_device(name='auto', threads=0):
+    """Returns the device of a run and applies its execution profile.
+
+    On cpu, convolutions go through oneDNN (mkldnn), denormals are flushed to zero and, when
+    threads > 0, the intra-op thread pool is set to threads (torch uses the physical cores by
+    default, lower it when DataLoader workers share the machine).
+    """
+    device = get_device(name)
+    if device.type == 'cpu':
+        torch.backends.mkldnn.enabled = True
+        torch.set_flush_denormal(True)
+        if threads > 0:
+            torch.set_num_threads(threads)
+    return device
+
+
+def prepare_model(model, device):
+    """Moves model to device. On cpu the conv weights are also stored channels last (NHWC),
+    the layout oneDNN runs natively, so that the activations follow it instead of being
+    reordered around every convolution.
+    """
+    model.to(device)
+    if device.type == 'cpu':
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def pin_memory(device):
+    """pin_memory of the DataLoaders feeding device"""
+    return device.type == 'cuda'
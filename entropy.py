@@ -9,6 +9,7 @@ import argparse
 import sys
 import os
 from tensorboardX import SummaryWriter
+from devices import setup_device, prepare_model, pin_memory
 
 
 class HLoss(nn.Module):
@@ -22,7 +23,8 @@ class HLoss(nn.Module):
 
 
 def main_run(dataset, train_data_dir, stage1_dict, out_dir, seqLen, trainBatchSize,
-             numEpochs, lr1, decay_factor, decay_step, memSize):
+             numEpochs, lr1, decay_factor, decay_step, memSize, device='auto', cpuThreads=0):
+    device = setup_device(device, cpuThreads)
 
     if dataset == 'gtea61':
         num_classes = 61
@@ -57,13 +59,13 @@ def main_run(dataset, train_data_dir, stage1_dict, out_dir, seqLen, trainBatchSi
                                 spatial_transform=spatial_transform, seqLen=seqLen, fmt='.png',phase='train')
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, num_workers=4, pin_memory=True)
+                            shuffle=True, num_workers=4, pin_memory=pin_memory(device))
     
 
     train_params = []
 
     model = colorization(num_classes=num_classes, mem_size=memSize)
-    model.attML.load_state_dict(torch.load(stage1_dict))
+    model.attML.load_state_dict(torch.load(stage1_dict, map_location='cpu'))
     model.train(True)
     model.attML.train(False)
 
@@ -90,7 +92,7 @@ def main_run(dataset, train_data_dir, stage1_dict, out_dir, seqLen, trainBatchSi
     for params in model.attML.parameters():
         params.requires_grad = False
 
-    model.cuda()
+    prepare_model(model, device)
 
     loss_fn = nn.CrossEntropyLoss()
     optimizer_fn = torch.optim.Adam(train_params, lr=lr1, weight_decay=4e-5, eps=1e-4)
@@ -113,7 +115,7 @@ def main_run(dataset, train_data_dir, stage1_dict, out_dir, seqLen, trainBatchSi
             
             iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            flow = flow.permute(1, 0, 2, 3, 4).cuda()
+            flow = flow.permute(1, 0, 2, 3, 4).to(device)
             logit=model(flow,True)
             loss=HLoss()(logit)
             loss.backward()
@@ -152,6 +154,9 @@ def __main__():
     parser.add_argument('--decayRate', type=float, default=0.1, help='Learning rate decay rate')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
     
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -166,9 +171,11 @@ def __main__():
     stepSize = args.stepSize
     decayRate = args.decayRate
     memSize = args.memSize
+    device = args.device
+    cpuThreads = args.cpuThreads
 
     main_run(dataset, trainDatasetDir, stage1Dict, outDir, seqLen, trainBatchSize,
-             numEpochs, lr1, decayRate, stepSize, memSize)
+             numEpochs, lr1, decayRate, stepSize, memSize, device, cpuThreads)
 
 __main__()
     
@@ -4,12 +4,19 @@ from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize)
 from torch.autograd import Variable
 from torch.utils.data.sampler import WeightedRandomSampler
 from makeDatasetFlow import *
-from sklearn.metrics import confusion_matrix
-import matplotlib.pyplot as plt
 import argparse
 import sys
-
-def main_run(dataset, model_state_dict, dataset_dir, stackSize, numSeg):
+from devices import setup_device, prepare_model, pin_memory
+from foldModel import fold_model
+from onnxBackend import onnx_model
+from metrics import ClassificationMetrics, plot_confusion
+from logitStore import run_name, write_result
+from evalEngine import evaluate, report, segment_mean
+
+def main_run(dataset, model_state_dict, dataset_dir, stackSize, numSeg, batchSize=8, numWorkers=4,
+             device='auto', cpuThreads=0, plot=1, logitStore=None, view=None, fold=0,
+             backend='torch', onnxFile=None, amp=0, archiveDir=None):
+    device = setup_device(device, cpuThreads)
 
     if dataset == 'gtea61':
         num_classes = 61
@@ -25,51 +32,48 @@ def main_run(dataset, model_state_dict, dataset_dir, stackSize, numSeg):
 
     normalize = Normalize(mean=mean, std=std)
 
-    spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])
+    if fold:
+        # the normalization is folded into conv1, the model takes the raw frames
+        spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(1)])
+    else:
+        spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])
 
     vid_seq_test = makeDataset(dataset_dir, spatial_transform=spatial_transform, sequence=True,
-                               numSeg=numSeg, stackSize=stackSize, fmt='.jpg', phase='Test')
+                               numSeg=numSeg, stackSize=stackSize, fmt='.jpg', phase='Test',
+                               archive_dir=archiveDir)
 
-    test_loader = torch.utils.data.DataLoader(vid_seq_test, batch_size=1,
-                            shuffle=False, num_workers=2, pin_memory=True)
+    test_loader = torch.utils.data.DataLoader(vid_seq_test, batch_size=batchSize,
+                            shuffle=False, num_workers=numWorkers, pin_memory=pin_memory(device))
 
     model = flow_resnet34(False, channels=2*stackSize, num_classes=num_classes)
-    model.load_state_dict(torch.load(model_state_dict))
+    model.load_state_dict(torch.load(model_state_dict, map_location='cpu'))
     for params in model.parameters():
         params.requires_grad = False
 
     model.train(False)
-    model.cuda()
+    if fold:
+        model = fold_model(model, mean, std)
+    prepare_model(model, device)
+    if backend == 'onnxruntime':
+        model = onnx_model(model, 'flow', (torch.zeros(1, 2 * stackSize, 224, 224),), device, cpuThreads, onnxFile)
     test_samples = vid_seq_test.__len__()
     print('Number of samples = {}'.format(test_samples))
     print('Evaluating...')
-    numCorr = 0
-    true_labels = []
-    predicted_labels = []
-
-    for j, (inputs, targets) in enumerate(test_loader):
-        inputVariable = Variable(inputs[0].cuda(), volatile=True)
-        output_label, _ = model(inputVariable)
-        output_label_mean = torch.mean(output_label.data, 0, True)
-        _, predicted = torch.max(output_label_mean, 1)
-        numCorr += (predicted == targets[0]).sum()
-        true_labels.append(targets)
-        predicted_labels.append(predicted)
-    test_accuracy = (numCorr / test_samples) * 100
-    print('Test Accuracy  = {}%'.format(test_accuracy))
-
-    cnf_matrix = confusion_matrix(true_labels, predicted_labels).astype(float)
-    cnf_matrix_normalized = cnf_matrix / cnf_matrix.sum(axis=1)[:, np.newaxis]
-
-    ticks = np.linspace(0, 60, num=61)
-    plt.imshow(cnf_matrix_normalized, interpolation='none', cmap='binary')
-    plt.colorbar()
-    plt.xticks(ticks, fontsize=6)
-    plt.yticks(ticks, fontsize=6)
-    plt.grid(True)
-    plt.clim(0, 1)
-    plt.savefig(dataset + '-flow.jpg', bbox_inches='tight')
-    plt.show()
+    def forward(inputs):
+        # the numSeg stacks of all the clips of a batch go through the model at once
+        output_label, feats1 = segment_mean(model, inputs)
+        return output_label, {'logits': output_label, 'feats1': feats1}
+
+    result = evaluate(forward, test_loader, device, ClassificationMetrics(num_classes),
+                      keep_outputs=logitStore is not None, amp=amp)
+    test_accuracy = report(result)
+    if logitStore is not None:
+        write_result(logitStore, run_name(dataset, 'flow', model_state_dict, view), vid_seq_test.imagesX, result,
+                     meta={'model': 'flow', 'checkpoint': model_state_dict, 'stackSize': stackSize,
+                           'numSeg': numSeg})
+
+    if plot:
+        plot_confusion(result['confusion'], dataset + '-flow.jpg')
 
 def __main__():
     parser = argparse.ArgumentParser()
@@ -81,6 +85,26 @@ def __main__():
                         help='Model path')
     parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input')
     parser.add_argument('--numSegs', type=int, default=5, help='Number of stacked optical flows')
+    parser.add_argument('--batchSize', type=int, default=8, help='Clips per forward')
+    parser.add_argument('--numWorkers', type=int, default=4, help='DataLoader worker processes')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory')
+    parser.add_argument('--plot', type=int, default=1, help='Save and show the confusion matrix')
+    parser.add_argument('--logitStore', type=str, default=None,
+                        help='Store the per-clip logits and features of the run in this directory, see logitFusion.py')
+    parser.add_argument('--view', type=str, default=None,
+                        help='Name of the test transform of the run in the logit store, e.g. to average TTA runs')
+    parser.add_argument('--fold', type=int, default=0,
+                        help='Fold the BatchNorms and the input Normalize into the convolutions, see foldModel.py')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+                        help='Run the model eagerly, or export it to ONNX and run it with onnxruntime')
+    parser.add_argument('--onnxFile', type=str, default=None,
+                        help='Path of the ONNX export of the onnxruntime backend, a temporary file by default')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the model under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -89,7 +113,21 @@ def __main__():
     dataset_dir = args.datasetDir
     stackSize = args.stackSize
     numSegs = args.numSegs
-
-    main_run(dataset, model_state_dict, dataset_dir, stackSize, numSegs)
+    batchSize = args.batchSize
+    numWorkers = args.numWorkers
+    device = args.device
+    cpuThreads = args.cpuThreads
+    plot = args.plot
+    logitStore = args.logitStore
+    view = args.view
+    fold = args.fold
+    backend = args.backend
+    onnxFile = args.onnxFile
+    amp = args.amp
+    archiveDir = args.archiveDir
+
+    main_run(dataset, model_state_dict, dataset_dir, stackSize, numSegs, batchSize, numWorkers, device,
+             cpuThreads, plot, logitStore, view, fold, backend, onnxFile, amp,
+             archiveDir)
 
 __main__()
\ No newline at end of file
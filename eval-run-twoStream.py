@@ -5,12 +5,20 @@ from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize)
 from torch.autograd import Variable
 from torch.utils.data.sampler import WeightedRandomSampler
 from makeDatasetTwoStream import *
-from sklearn.metrics import confusion_matrix
-import matplotlib.pyplot as plt
+import os
 import argparse
+from devices import setup_device, prepare_model, pin_memory
+from foldModel import fold_model
+from onnxBackend import onnx_model
+from metrics import ClassificationMetrics, plot_confusion
+from logitStore import run_name, write_result
+from evalEngine import evaluate, report, segment_mean
 
 
-def main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, stackSize, seqLen, memSize, numSeg):
+def main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, stackSize, seqLen, memSize, numSeg,
+             batchSize=8, numWorkers=4, device='auto', cpuThreads=0, plot=1, logitStore=None, view=None,
+             flow_wt=0.5, fold=0, backend='torch', onnxFile=None, amp=0, archiveDir=None):
+    device = setup_device(device, cpuThreads)
 
     if dataset == 'gtea61':
         num_classes = 61
@@ -26,21 +34,24 @@ def main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, st
 
     normalize = Normalize(mean=mean, std=std)
 
-    flow_wt = 0.5
-    testBatchSize = 1
     sequence = True
-    spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])
+    if fold:
+        # the normalization is folded into conv1, the model takes the raw frames
+        spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(1)])
+    else:
+        spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])
 
     vid_seq_test = makeDataset(dataset_dir, spatial_transform=spatial_transform, sequence=sequence, numSeg=numSeg,
-                               stackSize=stackSize, fmt='.jpg', phase='Test', seqLen=seqLen)
+                               stackSize=stackSize, fmt='.jpg', phase='Test', seqLen=seqLen,
+                               archive_dir=archiveDir)
 
-    test_loader = torch.utils.data.DataLoader(vid_seq_test, batch_size=testBatchSize,
-                            shuffle=False, num_workers=2, pin_memory=True)
+    test_loader = torch.utils.data.DataLoader(vid_seq_test, batch_size=batchSize,
+                            shuffle=False, num_workers=numWorkers, pin_memory=pin_memory(device))
 
     modelFlow = flow_resnet34(False, channels=2*stackSize, num_classes=num_classes)
-    modelFlow.load_state_dict(torch.load(flowModel_state_dict))
+    modelFlow.load_state_dict(torch.load(flowModel_state_dict, map_location='cpu'))
     modelRGB = attentionModel(num_classes=num_classes, mem_size=memSize)
-    modelRGB.load_state_dict(torch.load(RGBModel_state_dict))
+    modelRGB.load_state_dict(torch.load(RGBModel_state_dict, map_location='cpu'))
 
 
     for params in modelFlow.parameters():
@@ -51,42 +62,43 @@ def main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, st
 
     modelFlow.train(False)
     modelRGB.train(False)
-    modelFlow.cuda()
-    modelRGB.cuda()
+    if fold:
+        modelFlow = fold_model(modelFlow, mean, std)
+        modelRGB = fold_model(modelRGB, mean, std)
+    prepare_model(modelFlow, device)
+    prepare_model(modelRGB, device)
+    if backend == 'onnxruntime':
+        # one export per stream, <onnxFile>-flow.onnx and <onnxFile>-rgb.onnx
+        flowFile, rgbFile = None, None
+        if onnxFile is not None:
+            flowFile = os.path.splitext(onnxFile)[0] + '-flow.onnx'
+            rgbFile = os.path.splitext(onnxFile)[0] + '-rgb.onnx'
+        modelFlow = onnx_model(modelFlow, 'flow', (torch.zeros(1, 2 * stackSize, 224, 224),), device, cpuThreads,
+                               flowFile)
+        modelRGB = onnx_model(modelRGB, 'rgb', (torch.zeros(seqLen, 1, 3, 224, 224),), device, cpuThreads, rgbFile)
     test_samples = vid_seq_test.__len__()
     print('Number of samples = {}'.format(test_samples))
     print('Evaluating...')
-    numCorrTwoStream = 0
-
-    true_labels = []
-    predicted_labels = []
-
-    for j, (inputFlow, inputFrame, targets) in enumerate(test_loader):
-        inputVariableFlow = Variable(inputFlow[0].cuda(), volatile=True)
-        inputVariableFrame = Variable(inputFrame.permute(1, 0, 2, 3, 4).cuda(), volatile=True)
-        output_labelFlow, _ = modelFlow(inputVariableFlow)
-        output_labelFrame, _ = modelRGB(inputVariableFrame)
-        output_label_meanFlow = torch.mean(output_labelFlow.data, 0, True)
-        output_label_meanTwoStream = (flow_wt * output_label_meanFlow) + ((1-flow_wt) * output_labelFrame.data)
-        _, predictedTwoStream = torch.max(output_label_meanTwoStream, 1)
-        numCorrTwoStream += (predictedTwoStream == targets[0]).sum()
-        true_labels.append(targets)
-        predicted_labels.append(predictedTwoStream)
-    test_accuracyTwoStream = (numCorrTwoStream / test_samples) * 100
-    print('Test Accuracy = {}'.format(test_accuracyTwoStream))
-
-    cnf_matrix = confusion_matrix(true_labels, predicted_labels).astype(float)
-    cnf_matrix_normalized = cnf_matrix / cnf_matrix.sum(axis=1)[:, np.newaxis]
-
-    ticks = np.linspace(0, 60, num=61)
-    plt.imshow(cnf_matrix_normalized, interpolation='none', cmap='binary')
-    plt.colorbar()
-    plt.xticks(ticks, fontsize=6)
-    plt.yticks(ticks, fontsize=6)
-    plt.grid(True)
-    plt.clim(0, 1)
-    plt.savefig(dataset + '-twoStream.jpg', bbox_inches='tight')
-    plt.show()
+    def forward(inputFlow, inputFrame):
+        output_label_meanFlow, feats1Flow = segment_mean(modelFlow, inputFlow)
+        output_labelFrame, feats1Frame = modelRGB(inputFrame.permute(1, 0, 2, 3, 4))
+        output_label = (flow_wt * output_label_meanFlow) + ((1-flow_wt) * output_labelFrame)
+        return output_label, {'flow/logits': output_label_meanFlow, 'flow/feats1': feats1Flow,
+                              'rgb/logits': output_labelFrame, 'rgb/feats1': feats1Frame}
+
+    result = evaluate(forward, test_loader, device, ClassificationMetrics(num_classes),
+                      keep_outputs=logitStore is not None, amp=amp)
+    test_accuracyTwoStream = report(result)
+    if logitStore is not None:
+        # one run per stream, logitFusion.py sweeps flow_wt over them
+        write_result(logitStore, run_name(dataset, 'flow', flowModel_state_dict, view), vid_seq_test.imagesF,
+                     result, prefix='flow/', meta={'model': 'flow', 'checkpoint': flowModel_state_dict,
+                                                   'stackSize': stackSize, 'numSeg': numSeg})
+        write_result(logitStore, run_name(dataset, 'rgb', RGBModel_state_dict, view), vid_seq_test.imagesF,
+                     result, prefix='rgb/', meta={'model': 'rgb', 'checkpoint': RGBModel_state_dict, 'seqLen': seqLen})
+
+    if plot:
+        plot_confusion(result['confusion'], dataset + '-twoStream.jpg')
 
 def __main__():
     parser = argparse.ArgumentParser()
@@ -101,6 +113,27 @@ def __main__():
     parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
     parser.add_argument('--numSegs', type=int, default=10, help='Number of flow segments')
+    parser.add_argument('--batchSize', type=int, default=8, help='Clips per forward')
+    parser.add_argument('--numWorkers', type=int, default=4, help='DataLoader worker processes')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory')
+    parser.add_argument('--plot', type=int, default=1, help='Save and show the confusion matrix')
+    parser.add_argument('--flowWeight', type=float, default=0.5, help='Weight of the flow scores in the fusion')
+    parser.add_argument('--logitStore', type=str, default=None,
+                        help='Store the per-clip logits and features of the run in this directory, see logitFusion.py')
+    parser.add_argument('--view', type=str, default=None,
+                        help='Name of the test transform of the run in the logit store, e.g. to average TTA runs')
+    parser.add_argument('--fold', type=int, default=0,
+                        help='Fold the BatchNorms and the input Normalize into the convolutions, see foldModel.py')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+                        help='Run the model eagerly, or export it to ONNX and run it with onnxruntime')
+    parser.add_argument('--onnxFile', type=str, default=None,
+                        help='Path of the ONNX export of the onnxruntime backend, a temporary file by default')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the model under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -112,7 +145,22 @@ def __main__():
     stackSize = args.stackSize
     memSize = args.memSize
     numSeg = args.numSegs
-
-    main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, stackSize, seqLen, memSize, numSeg)
+    batchSize = args.batchSize
+    numWorkers = args.numWorkers
+    device = args.device
+    cpuThreads = args.cpuThreads
+    plot = args.plot
+    logitStore = args.logitStore
+    view = args.view
+    flowWeight = args.flowWeight
+    fold = args.fold
+    backend = args.backend
+    onnxFile = args.onnxFile
+    amp = args.amp
+    archiveDir = args.archiveDir
+
+    main_run(dataset, flowModel_state_dict, RGBModel_state_dict, dataset_dir, stackSize, seqLen, memSize, numSeg,
+             batchSize, numWorkers, device, cpuThreads, plot, logitStore, view, flowWeight, fold, backend, onnxFile, amp,
+             archiveDir)
 
 __main__()
@@ -0,0 +1,99 @@
+import time
+import resource
+import torch
+from mixedPrecision import autocast
+
+
+def _to(batch, device):
+    return [x.to(device, non_blocking=True) for x in batch]
+
+
+def prefetch(loader, device):
+    """Yields the batches of loader already copied to device. On cuda the copy of the next batch
+    is issued before the current one is returned, so that it overlaps the forward.
+    """
+    if device.type != 'cuda':
+        for batch in loader:
+            yield _to(batch, device)
+        return
+    it = iter(loader)
+    try:
+        nxt = _to(next(it), device)
+    except StopIteration:
+        return
+    for batch in it:
+        cur, nxt = nxt, _to(batch, device)
+        yield cur
+    yield nxt
+
+
+def segment_mean(model, x):
+    """Scores and pooled layer4 features of (B x numSeg x C x H x W) flow stacks, averaged over
+    the segments of each clip"""
+    batch, numSeg = x.size(0), x.size(1)
+    logits, feats1 = model(x.reshape(batch * numSeg, *x.shape[2:]))[:2]
+    return logits.view(batch, numSeg, -1).mean(1), feats1.view(batch, numSeg, -1).mean(1)
+
+
+def peak_memory_mb(device):
+    """Peak memory of the run: allocated by torch on cuda, resident set of the process on cpu"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # KB on Linux
+
+
+def evaluate(forward, loader, device, metrics, keep_outputs=False, amp=False):
+    """Runs forward over the batches of loader under torch.inference_mode().
+
+    Args:
+        forward (callable): Called with the inputs of a batch (every element but the
+            trailing targets) on device, returns the (B x num_classes) scores, or the scores
+            and a dict of named per-clip outputs (e.g. the logits and feats1 of each model).
+        loader (DataLoader): Batches of (inputs..., targets). Its workers and pin_memory
+            overlap the loading with the forward.
+        metrics (ClassificationMetrics): Accumulates the scores of every batch on device.
+        keep_outputs (bool): Also return the labels and the outputs of all the clips (cpu tensors),
+            in result['outputs'], the scores are stored as 'logits' when forward gives no dict.
+        amp (bool): Run forward under bf16 autocast, the scores and outputs are kept in fp32.
+    Returns a dict with the metrics.compute() values, the throughput in clips per second and
+    the peak memory in MB.
+    """
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    metrics.reset()
+    outputs = {}
+    labels = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for batch in prefetch(loader, device):
+            with autocast(device, amp):
+                output = forward(*batch[:-1])
+            named = {}
+            if isinstance(output, tuple):
+                output, named = output
+            metrics.update(output.float(), batch[-1])
+            if keep_outputs:
+                for name, value in (named or {'logits': output}).items():
+                    outputs.setdefault(name, []).append(value.float())
+                labels.append(batch[-1])
+        result = dict(metrics.compute())
+    elapsed = time.perf_counter() - start
+    if keep_outputs:
+        result['outputs'] = {name: torch.cat(values, 0).cpu() for name, values in outputs.items()}
+        result['labels'] = torch.cat(labels, 0).cpu()
+    result['clips_per_sec'] = result['samples'] / elapsed
+    result['peak_memory_mb'] = peak_memory_mb(device)
+    return result
+
+
+def report(result):
+    """Prints the accuracies, throughput and peak memory of an evaluate result, returns the accuracy"""
+    accuracy = result['accuracy']
+    print('Test Accuracy = {}%'.format(accuracy))
+    for name in sorted(result):
+        if name.startswith('top'):
+            print('{} = {}%'.format(name, result[name]))
+    per_class = result['per_class_accuracy']
+    print('Mean per-class Accuracy = {}%'.format(per_class[per_class == per_class].mean().item()))
+    print('Clips/sec = {:.2f} | Peak memory = {:.0f} MB'.format(result['clips_per_sec'], result['peak_memory_mb']))
+    return accuracy
@@ -0,0 +1,172 @@
+import copy
+import json
+import time
+import argparse
+import torch
+from spatial_transforms import Compose, ToTensor, CenterCrop, Scale, Normalize
+from MyConvLSTMCell import MyConvLSTMCell
+import makeDatasetRGB
+import makeDatasetFlow
+import makeDatasetTwoStream
+from benchmark import make_model, make_inputs
+from devices import setup_device, prepare_model
+from onnxBackend import export_onnx, OrtModel
+
+
+def script_cells(model):
+    """Replaces, in place, the ConvLSTM cells of model by their scripted version, so that a trace of
+    model keeps the loop of MyConvLSTMCell.forward_sequence over the timesteps instead of unrolling it
+    """
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, MyConvLSTMCell):
+                setattr(parent, name, torch.jit.script(child))
+    return model
+
+
+def export_torchscript(model, example_inputs, optimize=True):
+    """TorchScript module of a model in eval mode, traced on example_inputs with scripted ConvLSTM cells.
+    With optimize, the module is frozen and goes through torch.jit.optimize_for_inference
+    (constant folding, conv / BatchNorm fusion and, on cpu, oneDNN layouts).
+    """
+    model = script_cells(copy.deepcopy(model).train(False))
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example_inputs, check_trace=False)
+    if optimize:
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+    return scripted
+
+
+def clip_loader(model_name, dataset_dir, batchSize, seqLen, stackSize, fmt, drop_last=True):
+    """Test clips of the model, normalized as in the eval scripts. drop_last drops the last incomplete
+    batch, for the traces specialized to the batch size of their example
+    """
+    normalize = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    spatial_transform = Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])
+    if model_name in ('rgb', 'ms'):
+        dataset = makeDatasetRGB.makeDataset(dataset_dir, spatial_transform=spatial_transform, seqLen=seqLen,
+                                             fmt=fmt, phase='test')
+    elif model_name == 'flow':
+        dataset = makeDatasetFlow.makeDataset(dataset_dir, spatial_transform=spatial_transform, sequence=False,
+                                              stackSize=stackSize, fmt=fmt, phase='test')
+    else:
+        dataset = makeDatasetTwoStream.makeDataset(dataset_dir, spatial_transform=spatial_transform, sequence=False,
+                                                   numSeg=1, stackSize=stackSize, fmt=fmt, phase='test',
+                                                   seqLen=seqLen, frame_div=model_name == 'rgbflow')
+    return torch.utils.data.DataLoader(dataset, batch_size=batchSize, shuffle=False, num_workers=2,
+                                       drop_last=drop_last)
+
+
+def model_inputs(model_name, batch):
+    """Inputs of the model from a batch of clip_loader, in the layout of the training scripts"""
+    if model_name == 'flow':
+        return (batch[0],)
+    if model_name == 'twoStream':
+        return batch[0], batch[1].permute(1, 0, 2, 3, 4)
+    if model_name == 'rgbflow':
+        return batch[0].permute(1, 0, 2, 3, 4), batch[1].permute(1, 0, 2, 3, 4)
+    return (batch[0].permute(1, 0, 2, 3, 4),)
+
+
+def logits(outputs):
+    return outputs[0] if isinstance(outputs, tuple) else outputs
+
+
+def parity(eager, exported, batches, device):
+    """Compares the logits of the exported model with the ones of the eager model.
+    Returns the max abs difference, the top-1 agreement (%) and the time per batch of both (s)
+    """
+    max_diff = 0.0
+    agree = 0
+    total = 0
+    eager_time = 0.0
+    exported_time = 0.0
+    with torch.no_grad():
+        for inputs in batches:
+            inputs = [x.to(device) for x in inputs]
+            start = time.perf_counter()
+            reference = logits(eager(*inputs))
+            eager_time += time.perf_counter() - start
+            start = time.perf_counter()
+            output = logits(exported(*inputs))
+            exported_time += time.perf_counter() - start
+            max_diff = max(max_diff, (reference - output).abs().max().item())
+            agree += (reference.argmax(1) == output.argmax(1)).sum().item()
+            total += reference.size(0)
+    return max_diff, 100.0 * agree / total, eager_time / len(batches), exported_time / len(batches)
+
+
+def main_run(model_name, model_state_dict, out_file, dataset_dir, num_classes, batchSize, seqLen, stackSize,
+             numClips, fmt, optimize, device='cpu', cpuThreads=0, export_format='torchscript'):
+    device = setup_device(device, cpuThreads)
+    model = make_model(model_name, num_classes, stackSize)
+    if model_state_dict is not None:
+        model.load_state_dict(torch.load(model_state_dict, map_location='cpu'))
+    model.train(False)
+    for params in model.parameters():
+        params.requires_grad = False
+    prepare_model(model, device)
+
+    if dataset_dir is not None:
+        loader = clip_loader(model_name, dataset_dir, batchSize, seqLen, stackSize, fmt)
+        batches = []
+        for batch in loader:
+            batches.append(model_inputs(model_name, batch))
+            if len(batches) * batchSize >= numClips:
+                break
+    else:
+        batches = [make_inputs(model_name, batchSize, seqLen, stackSize) for _ in range(max(numClips // batchSize, 1))]
+    example = tuple(x.to(device) for x in batches[0])
+
+    if export_format == 'onnx':
+        # unrolled over seqLen, dynamic batch size
+        export_onnx(model, model_name, example, out_file)
+        print('ONNX model saved to {}'.format(out_file))
+        loaded = OrtModel(out_file, device, cpuThreads)
+        runtime = 'onnxruntime'
+    else:
+        exported = export_torchscript(model, example, optimize)
+        meta = {'model': model_name, 'num_classes': num_classes, 'batchSize': batchSize, 'seqLen': seqLen,
+                'stackSize': stackSize, 'input_shapes': [list(x.shape) for x in example]}
+        torch.jit.save(exported, out_file, _extra_files={'meta.json': json.dumps(meta)})
+        print('TorchScript model saved to {}'.format(out_file))
+        # parity of the saved module, as a Python-free runtime would load it
+        loaded = torch.jit.load(out_file, map_location=device)
+        runtime = 'TorchScript'
+
+    max_diff, agreement, eager_time, exported_time = parity(model, loaded, batches, device)
+    print('{} clips: max abs logit difference = {:.2e} | top-1 agreement = {:.2f}%'.format(
+        len(batches) * batchSize, max_diff, agreement))
+    print('Eager: {:.1f} ms/batch | {}: {:.1f} ms/batch'.format(eager_time * 1000, runtime, exported_time * 1000))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='rgb', choices=['rgb', 'ms', 'flow', 'rgbflow', 'twoStream'],
+                        help='Model to export')
+    parser.add_argument('--modelStateDict', type=str, default=None, help='Trained model path')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'],
+                        help='TorchScript module, or ONNX graph checked with onnxruntime')
+    parser.add_argument('--outFile', type=str, default='model.pt', help='Exported model path')
+    parser.add_argument('--datasetDir', type=str, default=None,
+                        help='Test set whose clips are used for the trace and the parity check, random clips otherwise')
+    parser.add_argument('--numClasses', type=int, default=61, help='Number of classes')
+    parser.add_argument('--batchSize', type=int, default=1, help='Clips per forward of the exported model')
+    parser.add_argument('--seqLen', type=int, default=25, help='Length of sequence')
+    parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input')
+    parser.add_argument('--numClips', type=int, default=16, help='Clips of the parity check')
+    parser.add_argument('--fmt', type=str, default='.jpg', help='Frame file extension of the dataset')
+    parser.add_argument('--optimize', type=int, default=1,
+                        help='Freeze the TorchScript module and apply torch.jit.optimize_for_inference')
+    parser.add_argument('--device', type=str, default='cpu', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
+
+    args = parser.parse_args()
+
+    main_run(args.model, args.modelStateDict, args.outFile, args.datasetDir, args.numClasses, args.batchSize,
+             args.seqLen, args.stackSize, args.numClips, args.fmt, args.optimize, args.device, args.cpuThreads,
+             args.format)
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,165 @@
+import os
+import json
+import random
+import argparse
+import numpy as np
+import torch
+from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize, MultiScaleCornerCrop,
+                                RandomHorizontalFlip, enumerate_views, set_view)
+from objectAttentionModelConvLSTM import attentionModel
+from timeDistributed import time_distributed
+import makeDatasetRGB
+from datasetManifest import clip_key
+from devices import setup_device, prepare_model, pin_memory
+
+INDEX_NAME = 'index.json'
+# per frame output stored for each level: the ConvLSTM input (stage 1) or the layer3 activations (stage 2)
+FEATURE_SHAPES = {'lstm': (512, 7, 7), 'layer3': (256, 14, 14)}
+
+
+def stage1_transforms():
+    """Train and test transforms of stage 1 in main-run-rgb.py and mainMsTask.py"""
+    normalize = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    return {'train': Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224),
+                              ToTensor(), normalize]),
+            'test': Compose([Scale(256), CenterCrop(224), ToTensor(), normalize])}
+
+
+def section_bytes(num_clips, num_views, seqLen, level):
+    """Size on disk of one section of the cache, stored as float16"""
+    return num_clips * num_views * seqLen * int(np.prod(FEATURE_SHAPES[level])) * 2
+
+
+def select_views(views, max_views=0, scales=None, max_bytes=None, view_bytes=1):
+    """Restricts the enumerated views of a transform.
+
+    Args:
+        max_views (int): Number of views kept, drawn at random with a fixed seed. 0 keeps all of them.
+        scales (list, optional): MultiScaleCornerCrop scales the views are restricted to.
+        max_bytes (int, optional): Disk budget, the number of views is reduced to fit it.
+        view_bytes (int): Size of one view of the section, see section_bytes.
+    """
+    if scales is not None:
+        views = [v for v in views if all(not isinstance(c, tuple) or c[0] in scales for c in v)]
+    num_views = len(views)
+    if 0 < max_views < num_views:
+        num_views = max_views
+    if max_bytes is not None:
+        num_views = min(num_views, max(int(max_bytes // view_bytes), 1))
+    if num_views < len(views):
+        views = random.Random(0).sample(views, num_views)
+    return views
+
+
+def main_run(root_dirs, out_dir, seqLen, attention, max_views, view_batch, model_dict, level='lstm', scales=None,
+             budget_gb=0, dry_run=False, device='auto', cpuThreads=0):
+    device = setup_device(device, cpuThreads)
+    # stage 1 only trains the ConvLSTM and the classifier, the ResNet part of the forward is fixed.
+    # stage 2 also trains layer4 and fc, the part up to layer3 stays fixed
+    transforms = stage1_transforms()
+    # the clips of every dataset dir, e.g. the train and val dirs of the training scripts, keyed by instance
+    instances = {}
+    for root_dir in root_dirs:
+        for phase in ('train', 'test'):
+            dataset = makeDatasetRGB.makeDataset(root_dir, spatial_transform=transforms[phase], seqLen=seqLen,
+                                                 phase=phase)
+            for idx, vid_name in enumerate(dataset.images):
+                key = clip_key(vid_name)
+                if key in instances and instances[key][0].images[instances[key][1]] != vid_name:
+                    raise ValueError('Instance {} in both {} and {}'.format(
+                        key, instances[key][0].images[instances[key][1]], vid_name))
+                instances[key] = (dataset, idx)
+    keys = sorted(instances)
+    rows = {key: row for row, key in enumerate(keys)}
+
+    index = {'seqLen': seqLen, 'attention': attention, 'level': level, 'keys': 'instance', 'sections': {},
+             'instances': rows}
+    outputs = {}
+    # the test section holds a single view, whatever is left of the budget goes to the train views
+    max_bytes = budget_gb * 2**30 - section_bytes(len(keys), 1, seqLen, level) if budget_gb > 0 else None
+    for name, transform in sorted(transforms.items()):
+        views = enumerate_views(transform)
+        print('{}: {} views enumerated, {:.1f} GB'.format(
+            name, len(views), section_bytes(len(keys), len(views), seqLen, level) / 2**30))
+        if name == 'train':
+            views = select_views(views, max_views, scales, max_bytes, section_bytes(len(keys), 1, seqLen, level))
+        index['sections'][name] = {'views': views}
+        shape = (len(keys), len(views), seqLen) + FEATURE_SHAPES[level]
+        print('{}: {} views stored, {:.1f} GB'.format(
+            name, len(views), section_bytes(len(keys), len(views), seqLen, level) / 2**30))
+        if dry_run:
+            continue
+        os.makedirs(out_dir, exist_ok=True)
+        outputs[name] = (transform, views, np.lib.format.open_memmap(
+            os.path.join(out_dir, name + '_feats.npy'), mode='w+', dtype=np.float16, shape=shape))
+
+    if dry_run:
+        return
+
+    model = attentionModel(attention=attention)
+    if model_dict is not None:
+        model.load_state_dict(torch.load(model_dict, map_location='cpu'))
+    model.train(False)
+    prepare_model(model, device)
+
+    with torch.no_grad():
+        for key in keys:
+            dataset, idx = instances[key]
+            numFrame = dataset.numFrames[idx]
+            fl_names = [dataset.images[idx] + '/' + 'rgb' + str(int(np.floor(i))).zfill(4) + dataset.fmt
+                        for i in np.linspace(1, numFrame, seqLen, endpoint=False)]
+            imgs = dataset.loader.load_clip(fl_names, 'RGB')
+            for transform, views, feats in outputs.values():
+                for v0 in range(0, len(views), view_batch):
+                    clips = []
+                    for view in views[v0:v0 + view_batch]:
+                        set_view(transform, view)
+                        # frame by frame through PIL, as the eval scripts and the val loop do,
+                        # Compose.clip only approximates the resizes
+                        clips.append(torch.stack([transform(img) for img in imgs], 0))
+                    # views of the clip go through the model as a batch, T x V x 3 x 224 x 224
+                    inputs = torch.stack(clips, 1).to(device)
+                    if level == 'layer3':
+                        out = time_distributed(model.resNet.forward_prefix, inputs, model.resNet)
+                    else:
+                        out = model.features(inputs)
+                    feats[rows[key], v0:v0 + len(clips)] = out.transpose(0, 1).cpu().numpy()
+    for _, _, feats in outputs.values():
+        feats.flush()
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    print('{} clips written to {}'.format(len(keys), out_dir))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetDir', type=str, nargs='+',
+                        default=['./dataset/gtea_warped_flow_61/split2/train', './dataset/gtea_warped_flow_61/split2/test'],
+                        help='Dataset directories, the train and val dirs of the training scripts')
+    parser.add_argument('--outDir', type=str, default='./features', help='Directory to save the features')
+    parser.add_argument('--seqLen', type=int, default=25, help='Length of sequence')
+    parser.add_argument('--attention', type=int, default=1, help='Store the attention weighted features')
+    parser.add_argument('--level', type=str, default='lstm', choices=['lstm', 'layer3'],
+                        help='Store the ConvLSTM input (stage 1) or the layer3 activations (stage 2)')
+    parser.add_argument('--maxViews', type=int, default=0,
+                        help='Number of augmentations stored per training clip, 0 stores all of them')
+    parser.add_argument('--scales', type=float, nargs='+', default=None,
+                        help='Only store the training crops of these MultiScaleCornerCrop scales')
+    parser.add_argument('--budgetGB', type=float, default=0,
+                        help='Disk budget of the cache, the training augmentations are reduced to fit it')
+    parser.add_argument('--dryRun', action='store_true', help='Only print the size of the cache')
+    parser.add_argument('--viewBatch', type=int, default=8, help='Augmentations of a clip run as one batch')
+    parser.add_argument('--modelDict', type=str, default=None,
+                        help='Model whose ResNet is used, the ImageNet weights by default')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
+
+    args = parser.parse_args()
+
+    main_run(args.datasetDir, args.outDir, args.seqLen, args.attention, args.maxViews, args.viewBatch, args.modelDict,
+             args.level, args.scales, args.budgetGB, args.dryRun, args.device, args.cpuThreads)
+
+if __name__ == '__main__':
+    __main__()
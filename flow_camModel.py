@@ -5,6 +5,7 @@ import torch.nn as nn
 from objectAttentionModelConvLSTM import *
 
 from MyConvLSTMCell import *
+from timeDistributed import time_distributed
 
 
 class attentionModel_flow(nn.Module):
@@ -14,7 +15,7 @@ class attentionModel_flow(nn.Module):
         self.attention = attention
         self.resNetRGB = resnetMod.resnet34(True, True)
         if frameModel!='':
-            self.resNetRGB.load_state_dict(OnlyResNet(torch.load(frameModel)))
+            self.resNetRGB.load_state_dict(OnlyResNet(torch.load(frameModel, map_location='cpu')))
         self.flowResNet = flow_resnet.flow_resnet34(True, channels=2, num_classes=num_classes)
         self.mem_size = mem_size
         self.lstm_cell = MyConvLSTMCell(512, mem_size)
@@ -24,21 +25,23 @@ class attentionModel_flow(nn.Module):
         self.classifier = nn.Sequential(self.dropout, self.fc)
 
     def forward(self, inputVariable_flow, inputVariable_rgb):
-        state = (torch.zeros(inputVariable_flow.size(1), self.mem_size, 7, 7).cuda(),
-                    torch.zeros(inputVariable_flow.size(1), self.mem_size, 7, 7).cuda())
+        # initial state on the device of the input
+        state = (inputVariable_flow.new_zeros((inputVariable_flow.size(1), self.mem_size, 7, 7)),
+                 inputVariable_flow.new_zeros((inputVariable_flow.size(1), self.mem_size, 7, 7)))
         #self.resNetRGB.train(False)
-        for t in range(inputVariable_flow.size(0)):
-            logit,_, feature_conv = self.flowResNet(inputVariable_flow[t])
-            _, _, feature_convNBN = self.resNetRGB(inputVariable_rgb[t])
-            if self.attention == 1:
-                bz, nc, h, w = feature_conv.size()
-                feature_conv1 = feature_conv.view(bz, nc, h*w)
-                feature_conv1 = torch.softmax(feature_conv1.squeeze(1), dim=2)
-                feature_conv1 = feature_conv1.view(feature_conv1.size(0), nc, 7, 7)
-                attentionFeat = feature_convNBN * feature_conv1
-                state = self.lstm_cell(attentionFeat, state)
-            elif self.attention == 0:
-                state = self.lstm_cell(feature_conv, state)
+        # both backbones over all the frames at once, T x B x ...
+        logit,_, feature_conv = time_distributed(self.flowResNet, inputVariable_flow)
+        _, _, feature_convNBN = time_distributed(self.resNetRGB, inputVariable_rgb)
+        if self.attention == 1:
+            seq_len, bz, nc, h, w = feature_conv.size()
+            feature_conv1 = feature_conv.view(seq_len*bz, nc, h*w)
+            # fp32 softmax under autocast
+            feature_conv1 = torch.softmax(feature_conv1.squeeze(1).float(), dim=2)
+            feature_conv1 = feature_conv1.view(seq_len, bz, nc, 7, 7)
+            attentionFeat = feature_convNBN * feature_conv1
+            state = self.lstm_cell.forward_sequence(attentionFeat, state)
+        elif self.attention == 0:
+            state = self.lstm_cell.forward_sequence(feature_conv, state)
         feats1 = self.avgpool(state[1]).view(state[1].size(0), -1)
         feats = self.classifier(feats1)
         return feats, feats1
@@ -48,10 +51,10 @@ class twoStreamAttentionModel(nn.Module):
         super(twoStreamAttentionModel, self).__init__()
         self.flow_Model = attentionModel_flow(frameModel=frameModel, num_classes=num_classes, mem_size=mem_size)
         if flowModel != '':
-            self.flow_Model.load_state_dict(torch.load(flowModel))
+            self.flow_Model.load_state_dict(torch.load(flowModel, map_location='cpu'))
         self.frame_Model = attentionModel(num_classes, memSize)
         if frameModel != '':
-            self.frame_Model.load_state_dict(torch.load(frameModel))
+            self.frame_Model.load_state_dict(torch.load(frameModel, map_location='cpu'))
         self.fc2 = nn.Linear(512 * 2, num_classes, bias=True)
         self.dropout = nn.Dropout(0.5)
         self.classifier = nn.Sequential(self.dropout, self.fc2)
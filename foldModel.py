@@ -0,0 +1,204 @@
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import resnetMod
+import flow_resnet
+from objectAttentionModelConvLSTM import attentionModel
+from attentionmodel_ml import attentionModel_ml
+from flow_camModel import attentionModel_flow
+from twoStreamModel import twoStreamAttentionModel
+from devices import setup_device, prepare_model
+from benchmark import make_model, make_inputs
+from onnxBackend import INPUTS
+
+# Normalize of the training scripts, the flow frames use the average of the mean and of the std (flow=True)
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# backbones of each model and the kind of frames they are fed with
+BACKBONES = {attentionModel: [('resNet', 'rgb')],
+             attentionModel_ml: [('resNet', 'rgb')],
+             attentionModel_flow: [('flowResNet', 'flow'), ('resNetRGB', 'rgb')],
+             twoStreamAttentionModel: [('flowModel', 'flow'), ('frameModel.resNet', 'rgb')],
+             flow_resnet.ResNet: [('', 'flow')]}
+
+
+def input_stats(kind, channels, mean=MEAN, std=STD):
+    """Per-channel mean and std of the input of a backbone, as applied by spatial_transforms.Normalize"""
+    if kind == 'flow':
+        return [float(np.mean(mean))] * channels, [float(np.mean(std))] * channels
+    return list(mean), list(std)
+
+
+def fold_bn(conv, bn):
+    """Conv2d computing bn(conv(x)), bn being in eval mode (running statistics)"""
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                           padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+        folded.to(conv.weight.device)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        folded.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+class NormalizedInputConv(nn.Module):
+    """First convolution of a backbone fed with raw [0, norm_value] frames, computing conv(normalize(x)).
+
+    The 1 / std of the normalization is folded into the weights. The mean is removed by subtracting
+    the convolution of the mean image, a constant for a given input size, so that the zero padding of
+    the normalized input is reproduced at the borders. It is precomputed for input_size x input_size frames.
+    """
+
+    def __init__(self, conv, mean, std, norm_value=255, input_size=224):
+        super(NormalizedInputConv, self).__init__()
+        mean = torch.tensor(mean, dtype=torch.float32, device=conv.weight.device) * norm_value
+        std = torch.tensor(std, dtype=torch.float32, device=conv.weight.device) * norm_value
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                              padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                              bias=conv.bias is not None)
+        self.conv.to(conv.weight.device)
+        with torch.no_grad():
+            self.conv.weight.copy_(conv.weight / std.view(1, -1, 1, 1))
+            if conv.bias is not None:
+                self.conv.bias.copy_(conv.bias)
+        self.register_buffer('mean', mean.view(1, -1, 1, 1))
+        self.input_size = (input_size, input_size)
+        self.register_buffer('offset', self.mean_offset(self.input_size))
+
+    def mean_offset(self, size):
+        """conv(mean image) without bias, (1 x C x H' x W') for size = (H, W) inputs"""
+        with torch.no_grad():
+            mean_img = self.mean.expand(1, self.mean.size(1), size[0], size[1])
+            return F.conv2d(mean_img, self.conv.weight, None, self.conv.stride, self.conv.padding,
+                            self.conv.dilation, self.conv.groups)
+
+    def forward(self, x):
+        offset = self.offset if tuple(x.shape[-2:]) == self.input_size else self.mean_offset(x.shape[-2:])
+        return self.conv(x) - offset.to(x.dtype)
+
+
+def fold_block(block):
+    """Folds the BatchNorms of a BasicBlock or Bottleneck into its convs. The bn2 of a noBN BasicBlock
+    (resnetMod layer4) is kept, the block also returns the conv2 output before it.
+    """
+    for conv, bn in (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')):
+        if not hasattr(block, bn) or (bn == 'bn2' and getattr(block, 'noBN', False)):
+            continue
+        setattr(block, conv, fold_bn(getattr(block, conv), getattr(block, bn)))
+        setattr(block, bn, nn.Identity())
+    if block.downsample is not None:
+        block.downsample = fold_bn(block.downsample[0], block.downsample[1])
+
+
+def fold_resnet(resnet, mean, std, norm_value=255):
+    """Folds, in place, the BatchNorms of a resnetMod or flow_resnet ResNet into the preceding convs and
+    the input normalization into conv1. resnet then takes raw [0, norm_value] frames.
+    """
+    resnet.conv1 = NormalizedInputConv(fold_bn(resnet.conv1, resnet.bn1), mean, std, norm_value)
+    resnet.bn1 = nn.Identity()
+    for layer in (resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4):
+        for block in layer:
+            fold_block(block)
+    return resnet
+
+
+def fold_model(model, mean=MEAN, std=STD, norm_value=255):
+    """Inference-only copy of a trained model (see BACKBONES) whose backbones take the frames before
+    spatial_transforms.Normalize, i.e. ToTensor(norm_value=1) values for the default norm_value.
+    The BatchNorms of the backbones are folded into their convs.
+    """
+    if type(model) not in BACKBONES:
+        raise ValueError('Cannot fold {}'.format(type(model).__name__))
+    model = copy.deepcopy(model)
+    model.train(False)
+    for params in model.parameters():
+        params.requires_grad = False
+    for path, kind in BACKBONES[type(model)]:
+        backbone = model
+        for name in path.split('.') if path else []:
+            backbone = getattr(backbone, name)
+        fold_resnet(backbone, *input_stats(kind, backbone.conv1.in_channels, mean, std), norm_value=norm_value)
+    return model
+
+
+def normalize(frames, mean, std, norm_value=255):
+    """Reference normalization of raw (... x C x H x W) frames, ToTensor followed by Normalize"""
+    mean = frames.new_tensor(mean).view(-1, 1, 1)
+    std = frames.new_tensor(std).view(-1, 1, 1)
+    return (frames / norm_value - mean) / std
+
+
+def make_raw_inputs(name, batchSize, seqLen, stackSize):
+    """Random raw [0, 255] inputs of each model, in the shapes of benchmark.make_inputs, and the same
+    inputs normalized
+    """
+    raw = tuple(x.uniform_(0, 255) for x in make_inputs(name, batchSize, seqLen, stackSize))
+    normalized = tuple(normalize(x, *input_stats('flow' if kind == 'flow' else 'rgb', x.size(-3)))
+                       for x, (kind, _) in zip(raw, INPUTS[name]))
+    return raw, normalized
+
+
+def first_output(outputs):
+    return outputs[0] if isinstance(outputs, tuple) else outputs
+
+
+def timed(model, inputs, iters):
+    with torch.no_grad():
+        first_output(model(*inputs))
+        start = time.perf_counter()
+        for _ in range(iters):
+            outputs = first_output(model(*inputs))
+    return outputs, (time.perf_counter() - start) / iters
+
+
+def main_run(model_name, model_state_dict, out_file, num_classes, stackSize, seqLen, memSize, batchSize, iters,
+             device='auto', cpuThreads=0):
+    device = setup_device(device, cpuThreads)
+    model = make_model(model_name, num_classes, stackSize, memSize)
+    if model_state_dict is not None:
+        model.load_state_dict(torch.load(model_state_dict, map_location='cpu'))
+    model.train(False)
+    folded = fold_model(model)
+    prepare_model(model, device)
+    prepare_model(folded, device)
+
+    raw, normalized = make_raw_inputs(model_name, batchSize, seqLen, stackSize)
+    reference, reference_time = timed(model, [x.to(device) for x in normalized], iters)
+    output, folded_time = timed(folded, [x.to(device) for x in raw], iters)
+    print('Max abs difference of the logits = {:.2e}'.format((reference - output).abs().max().item()))
+    print('Eager: {:.1f} ms | Folded: {:.1f} ms (without the Normalize of the frames)'.format(
+        reference_time * 1000, folded_time * 1000))
+    if out_file is not None:
+        torch.save(folded.cpu(), out_file)
+        print('Folded model saved to {}'.format(out_file))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='rgb', choices=['rgb', 'ms', 'flow', 'rgbflow', 'twoStream'],
+                        help='Model to fold')
+    parser.add_argument('--modelStateDict', type=str, default=None, help='Trained model path')
+    parser.add_argument('--outFile', type=str, default=None, help='Save the folded model (torch.save of the module)')
+    parser.add_argument('--numClasses', type=int, default=61, help='Number of classes')
+    parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input')
+    parser.add_argument('--seqLen', type=int, default=25, help='Length of sequence')
+    parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
+    parser.add_argument('--batchSize', type=int, default=2, help='Clips of the parity check')
+    parser.add_argument('--iters', type=int, default=3, help='Timed forwards')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
+
+    args = parser.parse_args()
+
+    main_run(args.model, args.modelStateDict, args.outFile, args.numClasses, args.stackSize, args.seqLen,
+             args.memSize, args.batchSize, args.iters, args.device, args.cpuThreads)
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,132 @@
+import threading
+import collections
+import multiprocessing
+
+
+class FrameCache(object):
+    """Keeps decoded (pre-augmentation) frames in memory, keyed by path and PIL mode.
+
+    Every DataLoader worker gets its own copy of the dataset and therefore its own cache,
+    so budget_bytes is a per-worker budget. With shared_counters, the hit/miss/eviction counters
+    live in shared memory and add up over all the workers, so they can be read from the training
+    process. The workers inherit them, which needs the fork start method (see make_frame_cache).
+    Use persistent_workers=True in the DataLoader, otherwise the workers and their caches
+    are recreated at every epoch.
+
+    Args:
+        budget_bytes (int): Maximum size of the cached frames (width * height * bands).
+        policy (string): 'lru' evicts the least recently used frame, 'lfu' the least
+            frequently used one (least recently used among equals).
+        shared_counters (bool): Share the counters with the workers, otherwise each process
+            counts its own lookups.
+    """
+
+    def __init__(self, budget_bytes, policy='lru', shared_counters=True):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown cache policy {}'.format(policy))
+        self.budget_bytes = budget_bytes
+        self.policy = policy
+        self.size = 0
+        self.entries = {}  # key -> [frame, nbytes, freq]
+        self.recency = collections.OrderedDict()  # lru: keys, least recent first
+        self.buckets = {}  # lfu: freq -> OrderedDict of keys
+        self.min_freq = 0
+        self.shared_counters = shared_counters
+        # hits, misses, evictions
+        self.counters = multiprocessing.Array('q', 3) if shared_counters else [0, 0, 0]
+        self.lock = threading.Lock()  # decode threads of FrameLoader.load_clip share the cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _count(self, i):
+        if not self.shared_counters:
+            self.counters[i] += 1
+            return
+        with self.counters.get_lock():
+            self.counters[i] += 1
+
+    def _touch(self, key, entry):
+        if self.policy == 'lru':
+            self.recency.move_to_end(key)
+            return
+        bucket = self.buckets[entry[2]]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[entry[2]]
+            if self.min_freq == entry[2]:
+                self.min_freq += 1
+        entry[2] += 1
+        self.buckets.setdefault(entry[2], collections.OrderedDict())[key] = None
+
+    def _evict(self):
+        if self.policy == 'lru':
+            key, _ = self.recency.popitem(last=False)
+        else:
+            bucket = self.buckets[self.min_freq]
+            key, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self.buckets[self.min_freq]
+                self.min_freq = min(self.buckets) if self.buckets else 0
+        self.size -= self.entries.pop(key)[1]
+        self._count(2)
+
+    def _insert(self, key, frame, nbytes):
+        if nbytes > self.budget_bytes or key in self.entries:
+            return
+        while self.size + nbytes > self.budget_bytes:
+            self._evict()
+        self.entries[key] = [frame, nbytes, 1]
+        self.size += nbytes
+        if self.policy == 'lru':
+            self.recency[key] = None
+        else:
+            self.buckets.setdefault(1, collections.OrderedDict())[key] = None
+            self.min_freq = 1
+
+    def get(self, key, load):
+        """Returns the cached frame for key, or load() and caches its result"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._touch(key, entry)
+                self._count(0)
+                return entry[0]
+        self._count(1)
+        frame = load()  # decoded outside the lock
+        with self.lock:
+            self._insert(key, frame, frame.size[0] * frame.size[1] * len(frame.getbands()))
+        return frame
+
+    def stats(self):
+        hits, misses, evictions = self.counters[:]
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'evictions': evictions,
+                'hit_rate': float(hits) / lookups if lookups else 0.0}
+
+
+def start_method():
+    """Start method of the DataLoader worker processes: the one set, or the default of the platform"""
+    return multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+
+
+def make_frame_cache(budget_mb, policy='lru'):
+    """FrameCache for the --frameCacheMB/--frameCachePolicy options of the scripts, None if disabled.
+
+    The shared counters can only be pickled to the workers by inheritance, i.e. with the fork start
+    method. Under spawn or forkserver every worker keeps its own cache and counters, and the statistics
+    read from the training process stay at zero.
+    """
+    if budget_mb <= 0:
+        return None
+    method = start_method()
+    if method != 'fork':
+        print('Frame cache: the {} start method does not share the cache statistics of the DataLoader '
+              'workers, they are not reported'.format(method))
+    return FrameCache(int(budget_mb * 2**20), policy, shared_counters=method == 'fork')
@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from clipArchive import ArchiveStore
+
+
+class FrameLoader(object):
+    """Opens the frames of a dataset and converts them to the requested PIL mode.
+
+    Args:
+        root_dir (string): Dataset directory the frame paths are built from.
+        archive_dir (string, optional): Directory of clip archives written by clipArchive.py.
+            If given, frames are read from the archives instead of the png files.
+        cache (FrameCache, optional): Keeps the converted frames in memory, transforms
+            are still applied by the dataset on every read.
+        decode_threads (int): Threads used by load_clip to decode the frames of a clip
+            concurrently (PIL releases the GIL while decoding), 0 decodes them one by one.
+    """
+
+    def __init__(self, root_dir, archive_dir=None, cache=None, decode_threads=0):
+        self.store = ArchiveStore(root_dir, archive_dir) if archive_dir is not None else None
+        self.cache = cache
+        self.decode_threads = decode_threads
+        self.pool = None
+        self.pool_pid = None
+
+    def __getstate__(self):
+        # the pool is recreated lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['pool_pid'] = None
+        return state
+
+    def exists(self, path):
+        if self.store is not None:
+            return self.store.exists(path)
+        return os.path.exists(path)
+
+    def open(self, path):
+        if self.store is not None:
+            return self.store.open(path)
+        return Image.open(path)
+
+    def decode(self, path, mode):
+        return self.open(path).convert(mode)
+
+    def __call__(self, path, mode):
+        if self.cache is not None:
+            return self.cache.get((path, mode), lambda: self.decode(path, mode))
+        return self.decode(path, mode)
+
+    def _pool(self):
+        # threads do not survive a fork, so a worker forked after the first use needs its own pool
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ThreadPoolExecutor(max_workers=self.decode_threads)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def load_clip(self, paths, mode):
+        """Returns the frames at paths, in order, converted to mode"""
+        if self.decode_threads <= 0 or len(paths) < 2:
+            return [self(path, mode) for path in paths]
+        return list(self._pool().map(lambda path: self(path, mode), paths))
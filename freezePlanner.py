@@ -0,0 +1,94 @@
+from fnmatch import fnmatchcase
+
+
+def match_modules(model, patterns):
+    """(name, module) of the sub-modules of model whose name (as in model.named_modules()) matches
+    one of the fnmatch patterns, e.g. 'resNet.layer4.*.conv[12]'. Modules are listed pattern by pattern,
+    in the named_modules order within a pattern.
+    """
+    named = list(model.named_modules())
+    matched = []
+    seen = set()
+    for pattern in patterns:
+        found = [(name, m) for name, m in named if fnmatchcase(name, pattern)]
+        if not found:
+            raise ValueError('No module of {} matches {}'.format(type(model).__name__, pattern))
+        for name, m in found:
+            if name not in seen:
+                seen.add(name)
+                matched.append((name, m))
+    return matched
+
+
+def no_grad_parts(backbone):
+    """Number of leading backbone.PARTS whose parameters are all frozen"""
+    n = 0
+    for part in backbone.PARTS:
+        if any(p.requires_grad for name in part for p in getattr(backbone, name).parameters()):
+            break
+        n += 1
+    return n
+
+
+class FreezePlan(object):
+    """Trainable part of a model for one training stage, everything else is frozen.
+
+    Args:
+        model (nn.Module): Model to train.
+        trainable (list): fnmatch patterns of the modules whose parameters are optimized.
+        train_mode (list, optional): Patterns of the modules put in training mode by train(),
+            the trainable ones by default. The other modules stay in eval mode, so that the
+            frozen BatchNorm layers keep their running statistics.
+    """
+
+    def __init__(self, model, trainable, train_mode=None):
+        self.model = model
+        self.trainable = list(trainable)
+        self.train_mode = self.trainable if train_mode is None else list(train_mode)
+
+    def apply(self):
+        """Sets requires_grad and the training modes, returns the parameters to optimize.
+
+        Backbones (modules with a PARTS attribute, see resnetMod.py) run their longest
+        fully frozen prefix under torch.no_grad(), its activations are not kept for the backward.
+        """
+        for params in self.model.parameters():
+            params.requires_grad = False
+        for _, m in match_modules(self.model, self.trainable):
+            for params in m.parameters():
+                params.requires_grad = True
+        for m in self.model.modules():
+            if hasattr(m, 'PARTS'):
+                m.no_grad_parts = no_grad_parts(m)
+        self.train()
+        return self.params()
+
+    def params(self, patterns=None):
+        """Parameters of the trainable modules matching patterns (all of them by default), in the
+        order of the patterns, e.g. to build optimizer param groups
+        """
+        params = []
+        seen = set()
+        for _, m in match_modules(self.model, self.trainable if patterns is None else patterns):
+            for p in m.parameters():
+                if p.requires_grad and id(p) not in seen:
+                    seen.add(id(p))
+                    params.append(p)
+        return params
+
+    def train(self):
+        """Puts the model in eval mode and the train_mode modules back in training mode, e.g. after validation"""
+        self.model.train(False)
+        for _, m in match_modules(self.model, self.train_mode):
+            m.train(True)
+
+    def summary(self):
+        lines = []
+        for name, m in self.model.named_modules():
+            if hasattr(m, 'PARTS'):
+                lines.append('{}: {} of {} parts without autograd'.format(
+                    name or type(m).__name__, m.no_grad_parts, len(m.PARTS)))
+        numTrain = sum(p.numel() for p in self.params())
+        numTotal = sum(p.numel() for p in self.model.parameters())
+        lines.append('{} of {} parameters trained'.format(numTrain, numTotal))
+        return '\n'.join(lines)
@@ -4,16 +4,18 @@ import cv2
 from objectAttentionModelConvLSTM import *
 from attentionMapModel import attentionMap
 from PIL import Image
+from devices import setup_device, prepare_model
 
 ####################Model definition###############################
 num_classes = 61 # Classes in the pre-trained model
 mem_size = 512
 model_state_dict = 'models/best_model_state_dict_rgb_split2.pth' # Weights of the pre-trained model
 
+device = setup_device('auto')
 model = attentionModel(num_classes=num_classes, mem_size=mem_size)
-model.load_state_dict(torch.load(model_state_dict))
+model.load_state_dict(torch.load(model_state_dict, map_location='cpu'))
 model_backbone = model.resNet
-attentionMapModel = attentionMap(model_backbone).cuda()
+attentionMapModel = prepare_model(attentionMap(model_backbone), device)
 attentionMapModel.train(False)
 for params in attentionMapModel.parameters():
     params.requires_grad = False
@@ -40,7 +42,7 @@ img_pil1 = preprocess1(img_pil)
 img_size = img_pil1.size
 size_upsample = (img_size[0], img_size[1])
 img_tensor = preprocess2(img_pil1)
-img_variable = Variable(img_tensor.unsqueeze(0).cuda())
+img_variable = Variable(img_tensor.unsqueeze(0).to(device))
 img = np.asarray(img_pil1)
 attentionMap_image = attentionMapModel(img_variable, img, size_upsample)
 cv2.imwrite(fl_name_out, attentionMap_image)
\ No newline at end of file
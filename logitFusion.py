@@ -0,0 +1,109 @@
+import time
+import argparse
+import itertools
+import collections
+import numpy as np
+from logitStore import list_runs, load_run, align_runs
+
+
+def softmax(x, axis=-1):
+    x = x - x.max(axis, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis, keepdims=True)
+
+
+def group_runs(names):
+    """Groups the runs of a model evaluated with several test transforms (<name>@<view>), the scores of
+    a group are averaged (test time augmentation)
+    """
+    groups = collections.OrderedDict()
+    for name in names:
+        groups.setdefault(name.split('@')[0], []).append(name)
+    return groups
+
+
+def simplex_grid(num, steps):
+    """(K x num) fusion weights, the multiples of 1/steps summing to 1"""
+    combos = [c for c in itertools.product(range(steps + 1), repeat=num - 1) if sum(c) <= steps]
+    weights = np.array(combos, dtype=np.float32).reshape(len(combos), num - 1)
+    return np.concatenate([weights, steps - weights.sum(1, keepdims=True)], 1) / steps
+
+
+def accuracies(scores, labels, weights, chunk=256):
+    """Top-1 accuracy (%) of the fusion of the scores for each row of weights
+
+    Args:
+        scores (array): (M x N x C) scores of M models on N clips.
+        labels (array): (N) labels of the clips.
+        weights (array): (K x M) fusion weights, the rows are evaluated chunk by chunk.
+    """
+    acc = np.empty(len(weights))
+    for k0 in range(0, len(weights), chunk):
+        fused = np.tensordot(weights[k0:k0 + chunk], scores, axes=(1, 0))
+        acc[k0:k0 + chunk] = (fused.argmax(2) == labels).mean(1) * 100
+    return acc
+
+
+def main_run(store_dir, runs, steps, normalize, top):
+    names = runs or list_runs(store_dir)
+    groups = group_runs(names)
+    loaded = [load_run(store_dir, name) for name in names]
+    keys, labels, logits = align_runs(loaded)
+    print('{} runs, {} models, {} clips in common'.format(len(names), len(groups), len(keys)))
+    scores = softmax(logits) if normalize == 'softmax' else logits
+
+    start = time.perf_counter()
+    for name, acc in zip(names, accuracies(scores, labels, np.eye(len(names), dtype=np.float32))):
+        print('{}: {:.2f}%'.format(name, acc))
+    # average of the views of each model
+    tta = np.zeros((len(groups), len(names)), dtype=np.float32)
+    for g, members in enumerate(groups.values()):
+        for name in members:
+            tta[g, names.index(name)] = 1.0 / len(members)
+    scores = np.tensordot(tta, scores, axes=(1, 0))
+    group_acc = accuracies(scores, labels, np.eye(len(groups), dtype=np.float32))
+    for (group, members), acc in zip(groups.items(), group_acc):
+        if len(members) > 1:
+            print('{} ({} views): {:.2f}%'.format(group, len(members), acc))
+
+    if len(groups) > 1:
+        weights = simplex_grid(len(groups), steps)
+        acc = accuracies(scores, labels, weights)
+        print('Fusion of {} models, {} weightings'.format(len(groups), len(weights)))
+        equal = accuracies(scores, labels, np.full((1, len(groups)), 1.0 / len(groups), dtype=np.float32))[0]
+        print('Equal weights: {:.2f}%'.format(equal))
+        for k in np.argsort(-acc, kind='stable')[:top]:
+            print('{:.2f}% | '.format(acc[k]) + ', '.join(
+                '{} = {:.2f}'.format(group, w) for group, w in zip(groups, weights[k])))
+        # best weighting of each ensemble, i.e. subset of the models with non-zero weights
+        if len(groups) > 2:
+            used = weights > 0
+            for size in range(2, len(groups)):
+                for subset in itertools.combinations(range(len(groups)), size):
+                    mask = np.zeros(len(groups), dtype=bool)
+                    mask[list(subset)] = True
+                    rows = np.flatnonzero((used == mask).all(1))
+                    if len(rows) == 0:
+                        continue
+                    k = rows[np.argmax(acc[rows])]
+                    print('Ensemble {}: {:.2f}% | '.format(', '.join(np.array(list(groups))[mask]), acc[k]) +
+                          ', '.join('{:.2f}'.format(w) for w in weights[k][mask]))
+    print('Sweep time = {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storeDir', type=str, default='./logits', help='Logit store written by the eval scripts')
+    parser.add_argument('--runs', type=str, nargs='+', default=None,
+                        help='Runs to fuse, all the runs of the store by default. <name>@<view> runs are averaged')
+    parser.add_argument('--steps', type=int, default=20, help='Fusion weights are multiples of 1/steps')
+    parser.add_argument('--normalize', type=str, default='logits', choices=['logits', 'softmax'],
+                        help='Fuse the raw logits, as eval-run-twoStream.py, or the class probabilities')
+    parser.add_argument('--top', type=int, default=5, help='Number of best weightings printed')
+
+    args = parser.parse_args()
+
+    main_run(args.storeDir, args.runs, args.steps, args.normalize, args.top)
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+from datasetManifest import clip_key
+
+INDEX_NAME = 'index.json'
+# the logits keep full precision for the fusion sweeps, the features are only looked at
+COLUMN_DTYPES = {'logits': np.float32, 'feats1': np.float16}
+
+
+# A logit store is a directory with one sub-directory per eval run (a model, a checkpoint and a test
+# transform), holding one .npy file per column (labels, logits, feats1, ...) with a row per clip and
+# an index.json with the clip keys of the rows and the description of the run.
+
+
+def run_name(dataset, model, checkpoint, view=None):
+    """Default name of a run, <dataset>-<model>-<checkpoint file name>[@<view>]"""
+    name = '{}-{}-{}'.format(dataset, model, os.path.splitext(os.path.basename(checkpoint))[0])
+    return name if view is None else name + '@' + view
+
+
+def write_run(store_dir, name, keys, labels, columns, meta=None):
+    """Stores the outputs of one eval run.
+
+    Args:
+        keys (list): clip_key of each row.
+        labels (array): Label of each row.
+        columns (dict): Column name -> (N x D) array, e.g. logits and feats1.
+        meta (dict, optional): Description of the run (model, checkpoint, ...) kept in the index.
+    """
+    run_dir = os.path.join(store_dir, name)
+    os.makedirs(run_dir, exist_ok=True)
+    np.save(os.path.join(run_dir, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+    for column, values in columns.items():
+        np.save(os.path.join(run_dir, column + '.npy'),
+                np.asarray(values, dtype=COLUMN_DTYPES.get(column, np.float32)))
+    index = dict(meta or {}, name=name, keys=list(keys), columns=sorted(columns))
+    with open(os.path.join(run_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    print('{} clips written to {}'.format(len(index['keys']), run_dir))
+
+
+def list_runs(store_dir):
+    return sorted(name for name in os.listdir(store_dir)
+                  if os.path.isfile(os.path.join(store_dir, name, INDEX_NAME)))
+
+
+def load_run(store_dir, name, columns=('logits',)):
+    """Index, labels and columns of a run, the columns are memory-mapped"""
+    run_dir = os.path.join(store_dir, name)
+    with open(os.path.join(run_dir, INDEX_NAME)) as f:
+        index = json.load(f)
+    run = {'index': index, 'keys': index['keys'], 'rows': {key: row for row, key in enumerate(index['keys'])},
+           'labels': np.load(os.path.join(run_dir, 'labels.npy'))}
+    for column in columns:
+        if column not in index['columns']:
+            raise ValueError('Run {} has no {} column'.format(name, column))
+        run[column] = np.load(os.path.join(run_dir, column + '.npy'), mmap_mode='r')
+    return run
+
+
+def align_runs(runs, column='logits'):
+    """Rows of the clips present in every run, in the order of the first one.
+    Returns the keys, the labels and an (R x N x D) array of the column of the runs.
+    """
+    keys = [key for key in runs[0]['keys'] if all(key in run['rows'] for run in runs[1:])]
+    values = []
+    labels = None
+    for run in runs:
+        rows = np.array([run['rows'][k] for k in keys], dtype=np.int64)
+        run_labels = run['labels'][rows]
+        if labels is None:
+            labels = run_labels
+        elif (labels != run_labels).any():
+            raise ValueError('Runs {} and {} disagree on the labels'.format(
+                runs[0]['index']['name'], run['index']['name']))
+        values.append(np.asarray(run[column][rows], dtype=np.float32))
+    return keys, labels, np.stack(values, 0)
+
+
+def write_result(store_dir, name, inst_dirs, result, prefix='', meta=None):
+    """Stores the outputs of an evalEngine.evaluate(..., keep_outputs=True) result, those named
+    <prefix><column> when the forward returned the outputs of several models
+
+    Args:
+        inst_dirs (list): Clip dir of each row, in the order of the (unshuffled) test loader.
+    """
+    columns = {name[len(prefix):]: value.numpy() for name, value in result['outputs'].items()
+               if name.startswith(prefix)}
+    write_run(store_dir, name, [clip_key(d) for d in inst_dirs], result['labels'].numpy(), columns, meta)
@@ -6,12 +6,19 @@ from tensorboardX import SummaryWriter
 import torch.nn as nn
 from torch.autograd import Variable
 from makeDatasetFlow import *
+from frameCache import make_frame_cache
 import argparse
 import sys
+from devices import setup_device, prepare_model, pin_memory
+from mixedPrecision import autocast, LossScaler
+from metrics import ClassificationMetrics
 
 
 def main_run(dataset, trainDir, valDir, outDir, stackSize, trainBatchSize, valBatchSize, numEpochs, lr1,
-             decay_factor, decay_step):
+             decay_factor, decay_step, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device='auto', cpuThreads=0,
+             amp=0, lossScale=None, dynamicLossScale=0):
+    device = setup_device(device, cpuThreads)
 
 
     if dataset == 'gtea61':
@@ -49,18 +56,21 @@ def main_run(dataset, trainDir, valDir, outDir, stackSize, trainBatchSize, valBa
     spatial_transform = Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224),
                                  ToTensor(), normalize])
 
+    frame_cache = make_frame_cache(frameCacheMB, frameCachePolicy)
     vid_seq_train = makeDataset(trainDir, spatial_transform=spatial_transform, sequence=False,
-                                stackSize=stackSize, fmt='.png')
+                                stackSize=stackSize, fmt='.png', frame_cache=frame_cache,
+                                archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, sampler=None, num_workers=4, pin_memory=True)
+                            shuffle=True, sampler=None, num_workers=numWorkers, pin_memory=pin_memory(device),
+                            persistent_workers=frame_cache is not None)
     if valDir is not None:
 
         vid_seq_val = makeDataset(valDir, spatial_transform=Compose([Scale(256), CenterCrop(224), ToTensor(), normalize]),
-                                   sequence=False, stackSize=stackSize, fmt='.png', phase='Test')
+                                   sequence=False, stackSize=stackSize, fmt='.png', phase='Test', archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
         val_loader = torch.utils.data.DataLoader(vid_seq_val, batch_size=valBatchSize,
-                                shuffle=False, num_workers=2, pin_memory=True)
+                                shuffle=False, num_workers=2, pin_memory=pin_memory(device))
         valInstances = vid_seq_val.__len__()
 
 
@@ -71,67 +81,66 @@ def main_run(dataset, trainDir, valDir, outDir, stackSize, trainBatchSize, valBa
     model.train(True)
     train_params = list(model.parameters())
 
-    model.cuda()
+    prepare_model(model, device)
 
     loss_fn = nn.CrossEntropyLoss()
 
     optimizer_fn = torch.optim.SGD(train_params, lr=lr1, momentum=0.9, weight_decay=5e-4)
 
     optim_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer_fn, milestones=decay_step, gamma=decay_factor)
+    loss_scaler = LossScaler(lossScale, dynamicLossScale)
 
+    train_metrics = ClassificationMetrics(num_classes)
+    val_metrics = ClassificationMetrics(num_classes)
     train_iter = 0
 
     for epoch in range(numEpochs):
         optim_scheduler.step()
-        epoch_loss = 0
-        numCorrTrain = 0
-        trainSamples = 0
-        iterPerEpoch = 0
+        train_metrics.reset()
         model.train(True)
         writer.add_scalar('lr', optimizer_fn.param_groups[0]['lr'], epoch+1)
         for i, (inputs, targets) in enumerate(train_loader):
             train_iter += 1
-            iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            inputVariable = Variable(inputs.cuda())
-            labelVariable = Variable(targets.cuda())
-            trainSamples += inputs.size(0)
-            output_label, _ = model(inputVariable)
+            inputVariable = Variable(inputs.to(device))
+            labelVariable = Variable(targets.to(device))
+            with autocast(device, amp):
+                output_label = model(inputVariable)[0]
+            output_label = output_label.float()
             loss = loss_fn(output_label, labelVariable)
-            loss.backward()
-            optimizer_fn.step()
-            _, predicted = torch.max(output_label.data, 1)
-            numCorrTrain += torch.sum(predicted == labelVariable.data).data.item()
-            epoch_loss += loss.item()
-        avg_loss = epoch_loss/iterPerEpoch
-        trainAccuracy = (numCorrTrain / trainSamples) * 100
+            loss_scaler.backward(loss)
+            loss_scaler.step(optimizer_fn)
+            train_metrics.update(output_label, labelVariable, loss)
+        train_result = train_metrics.compute()
+        avg_loss = train_result['loss']
+        trainAccuracy = train_result['accuracy']
         print('Train: Epoch = {} | Loss = {} | Accuracy = {}'.format(epoch + 1, avg_loss, trainAccuracy))
-        writer.add_scalar('train/epoch_loss', avg_loss, epoch+1)
-        writer.add_scalar('train/accuracy', trainAccuracy, epoch+1)
+        train_metrics.log(writer, 'train', epoch + 1)
+        if frame_cache is not None:
+            cache_stats = frame_cache.stats()
+            print('Frame cache: hits = {} | misses = {} | hit rate = {:.3f}'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate']))
+            writer.add_scalar('train/frame_cache_hit_rate', cache_stats['hit_rate'], epoch + 1)
         train_log_loss.write('Training loss after {} epoch = {}\n'.format(epoch+1, avg_loss))
         train_log_acc.write('Training accuracy after {} epoch = {}\n'.format(epoch+1, trainAccuracy))
         if valDir is not None:
             if (epoch+1) % 1 == 0:
                 model.train(False)
-                val_loss_epoch = 0
-                val_iter = 0
-                val_samples = 0
-                numCorr = 0
-                for j, (inputs, targets) in enumerate(val_loader):
-                    val_iter += 1
-                    val_samples += inputs.size(0)
-                    inputVariable = Variable(inputs.cuda(), volatile=True)
-                    labelVariable = Variable(targets.cuda(async=True), volatile=True)
-                    output_label, _ = model(inputVariable)
-                    val_loss = loss_fn(output_label, labelVariable)
-                    val_loss_epoch += val_loss.item()
-                    _, predicted = torch.max(output_label.data, 1)
-                    numCorr += torch.sum(predicted == labelVariable.data).data.item()
-                val_accuracy = (numCorr / val_samples) * 100
-                avg_val_loss = val_loss_epoch / val_iter
+                val_metrics.reset()
+                with torch.inference_mode():
+                    for j, (inputs, targets) in enumerate(val_loader):
+                        inputVariable = inputs.to(device)
+                        labelVariable = targets.to(device, non_blocking=True)
+                        with autocast(device, amp):
+                            output_label = model(inputVariable)[0]
+                        output_label = output_label.float()
+                        val_loss = loss_fn(output_label, labelVariable)
+                        val_metrics.update(output_label, labelVariable, val_loss)
+                val_result = val_metrics.compute()
+                avg_val_loss = val_result['loss']
+                val_accuracy = val_result['accuracy']
                 print('Validation: Epoch = {} | Loss = {} | Accuracy = {}'.format(epoch + 1, avg_val_loss, val_accuracy))
-                writer.add_scalar('val/epoch_loss', avg_val_loss, epoch + 1)
-                writer.add_scalar('val/accuracy', val_accuracy, epoch + 1)
+                val_metrics.log(writer, 'val', epoch + 1)
                 val_log_loss.write('Val Loss after {} epochs = {}\n'.format(epoch + 1, avg_val_loss))
                 val_log_acc.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
                 if val_accuracy > min_accuracy:
@@ -166,6 +175,30 @@ def __main__():
     parser.add_argument('--lr', type=float, default=1e-2, help='Learning rate')
     parser.add_argument('--stepSize', type=float, default=[150, 300, 500], nargs="+", help='Learning rate decay step')
     parser.add_argument('--decayRate', type=float, default=0.5, help='Learning rate decay rate')
+    parser.add_argument('--frameCacheMB', type=float, default=0,
+                        help='Decoded frame cache per DataLoader worker (MB), 0 disables it')
+    parser.add_argument('--frameCachePolicy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='Frame cache eviction policy')
+    parser.add_argument('--numWorkers', type=int, default=4, help='Train DataLoader worker processes')
+    parser.add_argument('--decodeThreads', type=int, default=0,
+                        help='Threads per DataLoader worker decoding the frames of a clip, 0 decodes them sequentially')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory '
+                             '(the train and val sets can be packed into the same one)')
+    parser.add_argument('--clipTransform', type=int, default=0,
+                        help='Transform each clip as one uint8 tensor instead of frame by frame, '
+                             'its resizes approximate the PIL ones to one gray level')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the forwards under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--lossScale', type=float, default=None,
+                        help='Scale of the loss before the backward, 1 (no loss scaling) by default. '
+                             'The starting scale with --dynamicLossScale 1, 2**16 by default')
+    parser.add_argument('--dynamicLossScale', type=int, default=0,
+                        help='Halve the loss scale and skip the step when the gradients overflow, '
+                             'double it after 2000 steps without overflow')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -180,8 +213,21 @@ def __main__():
     lr1 = args.lr
     stepSize = args.stepSize
     decayRate = args.decayRate
+    frameCacheMB = args.frameCacheMB
+    frameCachePolicy = args.frameCachePolicy
+    numWorkers = args.numWorkers
+    decodeThreads = args.decodeThreads
+    clipTransform = args.clipTransform
+    archiveDir = args.archiveDir
+    device = args.device
+    cpuThreads = args.cpuThreads
+    amp = args.amp
+    lossScale = args.lossScale
+    dynamicLossScale = args.dynamicLossScale
 
     main_run(dataset, trainDatasetDir, valDatasetDir, outDir, stackSize, trainBatchSize, valBatchSize, numEpochs, lr1,
-             decayRate, stepSize)
+             decayRate, stepSize, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device, cpuThreads,
+             amp, lossScale, dynamicLossScale)
 
 __main__()
@@ -4,12 +4,25 @@ from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize,
                                 RandomHorizontalFlip)
 from tensorboardX import SummaryWriter
 from makeDatasetRGB import *
+import makeDatasetFeatures
+from frameCache import make_frame_cache
+from freezePlanner import FreezePlan
 import argparse
 import sys
+from devices import setup_device, prepare_model, pin_memory
+from mixedPrecision import autocast, LossScaler
+from metrics import ClassificationMetrics
+
+# modules trained in each stage, the rest of the model is frozen
+TRAINABLE = {1: ['lstm_cell', 'classifier'],
+             2: ['resNet.layer4.*.conv[12]', 'resNet.fc', 'lstm_cell', 'classifier']}
 
 
 def main_run(dataset, stage, train_data_dir, val_data_dir, stage1_dict, out_dir, seqLen, trainBatchSize,
-             valBatchSize, numEpochs, lr1, decay_factor, decay_step, memSize, attention):
+             valBatchSize, numEpochs, lr1, decay_factor, decay_step, memSize, attention, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, featureCacheDir, device='auto', cpuThreads=0,
+             amp=0, lossScale=None, dynamicLossScale=0):
+    device = setup_device(device, cpuThreads)
 
     if dataset == 'gtea61':
         num_classes = 61
@@ -43,88 +56,52 @@ def main_run(dataset, stage, train_data_dir, val_data_dir, stage1_dict, out_dir,
     spatial_transform = Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224),
                                  ToTensor(), normalize])
 
-    vid_seq_train = makeDataset(train_data_dir,
-                                spatial_transform=spatial_transform, seqLen=seqLen, fmt='.png',phase='train')
+    frame_cache = make_frame_cache(frameCacheMB, frameCachePolicy)
+    use_features = featureCacheDir is not None
+    feature_level = 'lstm' if stage == 1 else 'layer3'
+    if use_features:
+        # read the output of the frozen part of the model stored by extractFeatures.py: the whole ResNet
+        # in stage 1, conv1 to layer3 in stage 2
+        vid_seq_train = makeDatasetFeatures.makeDataset(train_data_dir, featureCacheDir, seqLen=seqLen, phase='train',
+                                                        attention=attention, level=feature_level)
+    else:
+        vid_seq_train = makeDataset(train_data_dir,
+                                    spatial_transform=spatial_transform, seqLen=seqLen, fmt='.png',phase='train', frame_cache=frame_cache,
+                                    archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, num_workers=4, pin_memory=True)
+                            shuffle=True, num_workers=numWorkers, pin_memory=pin_memory(device),
+                            persistent_workers=frame_cache is not None)
     if val_data_dir is not None:
 
-        vid_seq_val = makeDataset(val_data_dir,
-                                   spatial_transform=Compose([Scale(256), CenterCrop(224), ToTensor(), normalize]),
-                                   seqLen=seqLen, fmt='.png',phase='test')
+        if use_features:
+            vid_seq_val = makeDatasetFeatures.makeDataset(val_data_dir, featureCacheDir, seqLen=seqLen, phase='test',
+                                                          attention=attention, level=feature_level)
+        else:
+            vid_seq_val = makeDataset(val_data_dir,
+                                       spatial_transform=Compose([Scale(256), CenterCrop(224), ToTensor(), normalize]),
+                                       seqLen=seqLen, fmt='.png',phase='test', archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
         val_loader = torch.utils.data.DataLoader(vid_seq_val, batch_size=valBatchSize,
-                                shuffle=False, num_workers=2, pin_memory=True)
+                                shuffle=False, num_workers=2, pin_memory=pin_memory(device))
         valInstances = vid_seq_val.__len__()
 
 
     trainInstances = vid_seq_train.__len__()
 
-    train_params = []
-    if stage == 1:
-
-        model = attentionModel(num_classes=num_classes, mem_size=memSize, attention=attention)
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
+    model = attentionModel(num_classes=num_classes, mem_size=memSize, attention=attention)
+    if stage == 2:
+        model.load_state_dict(torch.load(stage1_dict, map_location='cpu'))
+    freeze_plan = FreezePlan(model, TRAINABLE[stage])
+    train_params = freeze_plan.apply()
+    print(freeze_plan.summary())
+    prepare_model(model, device)
+    if not use_features:
+        model_fn = model
+    elif stage == 1:
+        model_fn = model.forward_features
     else:
-
-        model = attentionModel(num_classes=num_classes, mem_size=memSize, attention=attention)
-        model.load_state_dict(torch.load(stage1_dict))
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
-        #
-        for params in model.resNet.layer4[0].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[0].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[1].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[1].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[2].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.resNet.layer4[2].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.resNet.fc.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        model.resNet.layer4[0].conv1.train(True)
-        model.resNet.layer4[0].conv2.train(True)
-        model.resNet.layer4[1].conv1.train(True)
-        model.resNet.layer4[1].conv2.train(True)
-        model.resNet.layer4[2].conv1.train(True)
-        model.resNet.layer4[2].conv2.train(True)
-        model.resNet.fc.train(True)
-
-    for params in model.lstm_cell.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.classifier.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-
-    model.lstm_cell.train(True)
-
-    model.classifier.train(True)
-    model.cuda()
+        model_fn = model.forward_layer3
 
     loss_fn = nn.CrossEntropyLoss()
 
@@ -132,71 +109,61 @@ def main_run(dataset, stage, train_data_dir, val_data_dir, stage1_dict, out_dir,
 
     optim_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer_fn, milestones=decay_step,
                                                            gamma=decay_factor)
+    loss_scaler = LossScaler(lossScale, dynamicLossScale)
 
+    train_metrics = ClassificationMetrics(num_classes)
+    val_metrics = ClassificationMetrics(num_classes)
     train_iter = 0
     min_accuracy = 0
 
     for epoch in range(numEpochs):
         optim_scheduler.step()
-        epoch_loss = 0
-        numCorrTrain = 0
-        trainSamples = 0
-        iterPerEpoch = 0
-        model.lstm_cell.train(True)
-        model.classifier.train(True)
+        train_metrics.reset()
+        freeze_plan.train()
         writer.add_scalar('lr', optimizer_fn.param_groups[0]['lr'], epoch+1)
-        if stage == 2:
-            model.resNet.layer4[0].conv1.train(True)
-            model.resNet.layer4[0].conv2.train(True)
-            model.resNet.layer4[1].conv1.train(True)
-            model.resNet.layer4[1].conv2.train(True)
-            model.resNet.layer4[2].conv1.train(True)
-            model.resNet.layer4[2].conv2.train(True)
-            model.resNet.fc.train(True)
         for i, (inputs, targets) in enumerate(train_loader):
             train_iter += 1
-            iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).cuda())
-            labelVariable = Variable(targets.cuda())
-            trainSamples += inputs.size(0)
-            output_label, _ = model(inputVariable)
+            inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).to(device))
+            labelVariable = Variable(targets.to(device))
+            with autocast(device, amp):
+                output_label, _ = model_fn(inputVariable)
+            output_label = output_label.float()
             loss = loss_fn(output_label, labelVariable)
-            loss.backward()
-            optimizer_fn.step()
-            _, predicted = torch.max(output_label.data, 1)
-            numCorrTrain += torch.sum(predicted == labelVariable.data).data.item()
-            epoch_loss += loss.item()
-        avg_loss = epoch_loss/iterPerEpoch
-        trainAccuracy = (numCorrTrain / trainSamples) * 100
+            loss_scaler.backward(loss)
+            loss_scaler.step(optimizer_fn)
+            train_metrics.update(output_label, labelVariable, loss)
+        train_result = train_metrics.compute()
+        avg_loss = train_result['loss']
+        trainAccuracy = train_result['accuracy']
 
         print('Train: Epoch = {} | Loss = {} | Accuracy = {}'.format(epoch+1, avg_loss, trainAccuracy))
-        writer.add_scalar('train/epoch_loss', avg_loss, epoch+1)
-        writer.add_scalar('train/accuracy', trainAccuracy, epoch+1)
+        train_metrics.log(writer, 'train', epoch + 1)
+        if frame_cache is not None:
+            cache_stats = frame_cache.stats()
+            print('Frame cache: hits = {} | misses = {} | hit rate = {:.3f}'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate']))
+            writer.add_scalar('train/frame_cache_hit_rate', cache_stats['hit_rate'], epoch + 1)
         train_log_loss.write('Train Loss after {} epochs = {}\n'.format(epoch + 1, avg_loss))
         train_log_acc.write('Train Accuracy after {} epochs = {}%\n'.format(epoch + 1, trainAccuracy))
         if val_data_dir is not None:
             if (epoch+1) % 1 == 0:
                 model.train(False)
-                val_loss_epoch = 0
-                val_iter = 0
-                val_samples = 0
-                numCorr = 0
-                for j, (inputs, targets) in enumerate(val_loader):
-                    val_iter += 1
-                    val_samples += inputs.size(0)
-                    inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).cuda(), volatile=True)
-                    labelVariable = Variable(targets.cuda(async=True), volatile=True)
-                    output_label, _ = model(inputVariable)
-                    val_loss = loss_fn(output_label, labelVariable)
-                    val_loss_epoch += val_loss.item()
-                    _, predicted = torch.max(output_label.data, 1)
-                    numCorr += torch.sum(predicted == labelVariable.data).data.item()
-                val_accuracy = (numCorr / val_samples) * 100
-                avg_val_loss = val_loss_epoch / val_iter
+                val_metrics.reset()
+                with torch.inference_mode():
+                    for j, (inputs, targets) in enumerate(val_loader):
+                        inputVariable = inputs.permute(1, 0, 2, 3, 4).to(device)
+                        labelVariable = targets.to(device, non_blocking=True)
+                        with autocast(device, amp):
+                            output_label, _ = model_fn(inputVariable)
+                        output_label = output_label.float()
+                        val_loss = loss_fn(output_label, labelVariable)
+                        val_metrics.update(output_label, labelVariable, val_loss)
+                val_result = val_metrics.compute()
+                avg_val_loss = val_result['loss']
+                val_accuracy = val_result['accuracy']
                 print('Val: Epoch = {} | Loss {} | Accuracy = {}'.format(epoch + 1, avg_val_loss, val_accuracy))
-                writer.add_scalar('val/epoch_loss', avg_val_loss, epoch + 1)
-                writer.add_scalar('val/accuracy', val_accuracy, epoch + 1)
+                val_metrics.log(writer, 'val', epoch + 1)
                 val_log_loss.write('Val Loss after {} epochs = {}\n'.format(epoch + 1, avg_val_loss))
                 val_log_acc.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
                 if val_accuracy > min_accuracy:
@@ -236,6 +203,33 @@ def __main__():
     parser.add_argument('--decayRate', type=float, default=0.1, help='Learning rate decay rate')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
     parser.add_argument('--attention', type=int, default=1, help='Run attention model')
+    parser.add_argument('--frameCacheMB', type=float, default=0,
+                        help='Decoded frame cache per DataLoader worker (MB), 0 disables it')
+    parser.add_argument('--frameCachePolicy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='Frame cache eviction policy')
+    parser.add_argument('--numWorkers', type=int, default=4, help='Train DataLoader worker processes')
+    parser.add_argument('--decodeThreads', type=int, default=0,
+                        help='Threads per DataLoader worker decoding the frames of a clip, 0 decodes them sequentially')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory '
+                             '(the train and val sets can be packed into the same one)')
+    parser.add_argument('--clipTransform', type=int, default=0,
+                        help='Transform each clip as one uint8 tensor instead of frame by frame, '
+                             'its resizes approximate the PIL ones to one gray level')
+    parser.add_argument('--featureCacheDir', type=str, default=None,
+                        help='Train from the features stored by extractFeatures.py over the train and val dataset dirs '
+                             '(--level lstm for stage 1, layer3 for stage 2)')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the forwards under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--lossScale', type=float, default=None,
+                        help='Scale of the loss before the backward, 1 (no loss scaling) by default. '
+                             'The starting scale with --dynamicLossScale 1, 2**16 by default')
+    parser.add_argument('--dynamicLossScale', type=int, default=0,
+                        help='Halve the loss scale and skip the step when the gradients overflow, '
+                             'double it after 2000 steps without overflow')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -254,8 +248,22 @@ def __main__():
     decayRate = args.decayRate
     memSize = args.memSize
     attention = args.attention
+    frameCacheMB = args.frameCacheMB
+    frameCachePolicy = args.frameCachePolicy
+    numWorkers = args.numWorkers
+    decodeThreads = args.decodeThreads
+    clipTransform = args.clipTransform
+    archiveDir = args.archiveDir
+    featureCacheDir = args.featureCacheDir
+    device = args.device
+    cpuThreads = args.cpuThreads
+    amp = args.amp
+    lossScale = args.lossScale
+    dynamicLossScale = args.dynamicLossScale
 
     main_run(dataset, stage, trainDatasetDir, valDatasetDir, stage1Dict, outDir, seqLen, trainBatchSize,
-             valBatchSize, numEpochs, lr1, decayRate, stepSize, memSize, attention)
+             valBatchSize, numEpochs, lr1, decayRate, stepSize, memSize, attention, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, featureCacheDir, device, cpuThreads,
+             amp, lossScale, dynamicLossScale)
 
 __main__()
@@ -7,13 +7,27 @@ from twoStreamModel import *
 from torch.autograd import Variable
 from torch.utils.data.sampler import WeightedRandomSampler
 from makeDatasetTwoStream import *
+from frameCache import make_frame_cache
+from freezePlanner import FreezePlan
 import argparse
 
 import sys
+from devices import setup_device, prepare_model, pin_memory
+from mixedPrecision import autocast, LossScaler
+from metrics import ClassificationMetrics
+
+# trained modules, the rest of the model is frozen. The RGB layer4 and the flow layer4 are two
+# param groups, only the classifier and the flow layer4 are put in training mode
+TRAINABLE = ['classifier', 'frameModel.lstm_cell', 'frameModel.resNet.layer4.*.conv[12]', 'frameModel.resNet.fc',
+             'flowModel.layer4']
+TRAIN_MODE = ['classifier', 'flowModel.layer4']
 
 
 def main_run(dataset, flowModel, rgbModel, stackSize, seqLen, memSize, trainDatasetDir, valDatasetDir, outDir,
-             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor):
+             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device='auto', cpuThreads=0,
+             amp=0, lossScale=None, dynamicLossScale=0):
+    device = setup_device(device, cpuThreads)
 
 
     if dataset == 'gtea61':
@@ -51,74 +65,36 @@ def main_run(dataset, flowModel, rgbModel, stackSize, seqLen, memSize, trainData
     spatial_transform = Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224),
                                  ToTensor(), normalize])
 
+    frame_cache = make_frame_cache(frameCacheMB, frameCachePolicy)
     vid_seq_train = makeDataset(trainDatasetDir,spatial_transform=spatial_transform,
-                               sequence=False, numSeg=1, stackSize=stackSize, fmt='.png', seqLen=seqLen)
+                               sequence=False, numSeg=1, stackSize=stackSize, fmt='.png', seqLen=seqLen, frame_cache=frame_cache,
+                                archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, num_workers=4, pin_memory=True)
+                            shuffle=True, num_workers=numWorkers, pin_memory=pin_memory(device),
+                            persistent_workers=frame_cache is not None)
 
     if valDatasetDir is not None:
 
         vid_seq_val = makeDataset(valDatasetDir,
                                    spatial_transform=Compose([Scale(256), CenterCrop(224), ToTensor(), normalize]),
                                    sequence=False, numSeg=1, stackSize=stackSize, fmt='.png', phase='Test',
-                                   seqLen=seqLen)
+                                   seqLen=seqLen, archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
         val_loader = torch.utils.data.DataLoader(vid_seq_val, batch_size=valBatchSize,
-                                shuffle=False, num_workers=2, pin_memory=True)
+                                shuffle=False, num_workers=2, pin_memory=pin_memory(device))
         valSamples = vid_seq_val.__len__()
 
     model = twoStreamAttentionModel(flowModel=flowModel, frameModel=rgbModel, stackSize=stackSize, memSize=memSize,
                                     num_classes=num_classes)
 
-    for params in model.parameters():
-        params.requires_grad = False
-
-    model.train(False)
-    train_params = []
-
-    for params in model.classifier.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.frameModel.lstm_cell.parameters():
-        train_params += [params]
-        params.requires_grad = True
-
-    for params in model.frameModel.resNet.layer4[0].conv1.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.frameModel.resNet.layer4[0].conv2.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.frameModel.resNet.layer4[1].conv1.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.frameModel.resNet.layer4[1].conv2.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.frameModel.resNet.layer4[2].conv1.parameters():
-        params.requires_grad = True
-        train_params += [params]
-    #
-    for params in model.frameModel.resNet.layer4[2].conv2.parameters():
-        params.requires_grad = True
-        train_params += [params]
-    #
-    for params in model.frameModel.resNet.fc.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    base_params = []
-    for params in model.flowModel.layer4.parameters():
-        base_params += [params]
-        params.requires_grad = True
+    freeze_plan = FreezePlan(model, TRAINABLE, TRAIN_MODE)
+    freeze_plan.apply()
+    print(freeze_plan.summary())
+    train_params = freeze_plan.params(TRAINABLE[:-1])
+    base_params = freeze_plan.params(['flowModel.layer4'])
 
-    model.cuda()
+    prepare_model(model, device)
 
     trainSamples = vid_seq_train.__len__()
     min_accuracy = 0
@@ -130,59 +106,61 @@ def main_run(dataset, flowModel, rgbModel, stackSize, seqLen, memSize, trainData
     ], lr=lr1, momentum=0.9, weight_decay=5e-4)
 
     optim_scheduler = torch.optim.lr_scheduler.StepLR(optimizer_fn, step_size=decay_step, gamma=decay_factor)
+    loss_scaler = LossScaler(lossScale, dynamicLossScale)
+    train_metrics = ClassificationMetrics(num_classes)
+    val_metrics = ClassificationMetrics(num_classes)
     train_iter = 0
 
     for epoch in range(numEpochs):
         optim_scheduler.step()
-        epoch_loss = 0
-        numCorrTrain = 0
-        iterPerEpoch = 0
-        model.classifier.train(True)
-        model.flowModel.layer4.train(True)
+        train_metrics.reset()
+        freeze_plan.train()
         for j, (inputFlow, inputFrame, targets) in enumerate(train_loader):
             train_iter += 1
-            iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            inputVariableFlow = Variable(inputFlow.cuda())
-            inputVariableFrame = Variable(inputFrame.permute(1, 0, 2, 3, 4).cuda())
-            labelVariable = Variable(targets.cuda())
-            output_label = model(inputVariableFlow, inputVariableFrame)
+            inputVariableFlow = Variable(inputFlow.to(device))
+            inputVariableFrame = Variable(inputFrame.permute(1, 0, 2, 3, 4).to(device))
+            labelVariable = Variable(targets.to(device))
+            with autocast(device, amp):
+                output_label = model(inputVariableFlow, inputVariableFrame)
+            output_label = output_label.float()
             loss = loss_fn(torch.log_softmax(output_label, dim=1), labelVariable)
-            loss.backward()
-            optimizer_fn.step()
-            _, predicted = torch.max(output_label.data, 1)
-             numCorrTrain += torch.sum(predicted == labelVariable.data).data.item()
-            epoch_loss += loss.item()
-        avg_loss = epoch_loss / iterPerEpoch
-        trainAccuracy = (numCorrTrain / trainSamples) * 100
+            loss_scaler.backward(loss)
+            loss_scaler.step(optimizer_fn)
+            train_metrics.update(output_label, labelVariable, loss)
+        train_result = train_metrics.compute()
+        avg_loss = train_result['loss']
+        trainAccuracy = train_result['accuracy']
         print('Average training loss after {} epoch = {} '.format(epoch + 1, avg_loss))
         print('Training accuracy after {} epoch = {}% '.format(epoch + 1, trainAccuracy))
-        writer.add_scalar('train/epoch_loss', avg_loss, epoch + 1)
-        writer.add_scalar('train/accuracy', trainAccuracy, epoch + 1)
+        train_metrics.log(writer, 'train', epoch + 1)
+        if frame_cache is not None:
+            cache_stats = frame_cache.stats()
+            print('Frame cache: hits = {} | misses = {} | hit rate = {:.3f}'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate']))
+            writer.add_scalar('train/frame_cache_hit_rate', cache_stats['hit_rate'], epoch + 1)
         train_log_loss.write('Training loss after {} epoch = {}\n'.format(epoch + 1, avg_loss))
         train_log_acc.write('Training accuracy after {} epoch = {}\n'.format(epoch + 1, trainAccuracy))
         if valDatasetDir is not None:
             if (epoch + 1) % 1 == 0:
                 model.train(False)
-                val_loss_epoch = 0
-                val_iter = 0
-                numCorr = 0
-                for j, (inputFlow, inputFrame, targets) in enumerate(val_loader):
-                    val_iter += 1
-                    inputVariableFlow = Variable(inputFlow.cuda())
-                    inputVariableFrame = Variable(inputFrame.permute(1, 0, 2, 3, 4).cuda())
-                    labelVariable = Variable(targets.cuda())
-                    output_label = model(inputVariableFlow, inputVariableFrame)
-                    loss = loss_fn(torch.log_softmax(output_label, dim=1), labelVariable)
-                    val_loss_epoch += loss.item()
-                    _, predicted = torch.max(output_label.data, 1)
-                   numCorr += torch.sum(predicted == labelVariable.data).data.item()
-                val_accuracy = (numCorr / valSamples) * 100
-                avg_val_loss = val_loss_epoch / val_iter
+                val_metrics.reset()
+                with torch.inference_mode():
+                    for j, (inputFlow, inputFrame, targets) in enumerate(val_loader):
+                        inputVariableFlow = inputFlow.to(device)
+                        inputVariableFrame = inputFrame.permute(1, 0, 2, 3, 4).to(device)
+                        labelVariable = targets.to(device)
+                        with autocast(device, amp):
+                            output_label = model(inputVariableFlow, inputVariableFrame)
+                        output_label = output_label.float()
+                        loss = loss_fn(torch.log_softmax(output_label, dim=1), labelVariable)
+                        val_metrics.update(output_label, labelVariable, loss)
+                val_result = val_metrics.compute()
+                avg_val_loss = val_result['loss']
+                val_accuracy = val_result['accuracy']
                 print('Val Loss after {} epochs, loss = {}'.format(epoch + 1, avg_val_loss))
                 print('Val Accuracy after {} epochs = {}%'.format(epoch + 1, val_accuracy))
-                writer.add_scalar('val/epoch_loss', avg_val_loss, epoch + 1)
-                writer.add_scalar('val/accuracy', val_accuracy, epoch + 1)
+                val_metrics.log(writer, 'val', epoch + 1)
                 val_log_loss.write('Val Loss after {} epochs = {}\n'.format(epoch + 1, avg_val_loss))
                 val_log_acc.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
                 if val_accuracy > min_accuracy:
@@ -222,6 +200,30 @@ def __main__():
     parser.add_argument('--stepSize', type=float, default=1, help='Learning rate decay step')
     parser.add_argument('--decayRate', type=float, default=0.99, help='Learning rate decay rate')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
+    parser.add_argument('--frameCacheMB', type=float, default=0,
+                        help='Decoded frame cache per DataLoader worker (MB), 0 disables it')
+    parser.add_argument('--frameCachePolicy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='Frame cache eviction policy')
+    parser.add_argument('--numWorkers', type=int, default=4, help='Train DataLoader worker processes')
+    parser.add_argument('--decodeThreads', type=int, default=0,
+                        help='Threads per DataLoader worker decoding the frames of a clip, 0 decodes them sequentially')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory '
+                             '(the train and val sets can be packed into the same one)')
+    parser.add_argument('--clipTransform', type=int, default=0,
+                        help='Transform each clip as one uint8 tensor instead of frame by frame, '
+                             'its resizes approximate the PIL ones to one gray level')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the forwards under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--lossScale', type=float, default=None,
+                        help='Scale of the loss before the backward, 1 (no loss scaling) by default. '
+                             'The starting scale with --dynamicLossScale 1, 2**16 by default')
+    parser.add_argument('--dynamicLossScale', type=int, default=0,
+                        help='Halve the loss scale and skip the step when the gradients overflow, '
+                             'double it after 2000 steps without overflow')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -240,8 +242,21 @@ def __main__():
     decay_step = args.stepSize
     decay_factor = args.decayRate
     memSize = args.memSize
+    frameCacheMB = args.frameCacheMB
+    frameCachePolicy = args.frameCachePolicy
+    numWorkers = args.numWorkers
+    decodeThreads = args.decodeThreads
+    clipTransform = args.clipTransform
+    archiveDir = args.archiveDir
+    device = args.device
+    cpuThreads = args.cpuThreads
+    amp = args.amp
+    lossScale = args.lossScale
+    dynamicLossScale = args.dynamicLossScale
 
     main_run(dataset, flowModel, rgbModel, stackSize, seqLen, memSize, trainDatasetDir, valDatasetDir, outDir,
-             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor)
+             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device, cpuThreads,
+             amp, lossScale, dynamicLossScale)
 
 __main__()
@@ -4,13 +4,27 @@ from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize,
                                 RandomHorizontalFlip)
 from attentionmodel_ml import *
 from makeDatasetMS import makeDataset
+import makeDatasetFeatures
+from frameCache import make_frame_cache
+from freezePlanner import FreezePlan
+from multiTaskLoss import MultiTaskLoss
 import argparse
 import sys
 import os
 from tensorboardX import SummaryWriter
+from devices import setup_device, prepare_model, pin_memory
+from mixedPrecision import autocast, LossScaler
+from metrics import ClassificationMetrics
+
+# modules trained in each stage, the rest of the model is frozen
+TRAINABLE = {1: ['lstm_cell', 'classifier'],
+             2: ['resNet.layer4.*.conv[12]', 'resNet.fc', 'conv', 'clas', 'lstm_cell', 'classifier']}
 
 def main_run(dataset, stage, train_data_dir, val_data_dir, stage1_dict, out_dir, seqLen, trainBatchSize,
-             valBatchSize, numEpochs, lr1, decay_factor, decay_step, memSize, regressor):
+             valBatchSize, numEpochs, lr1, decay_factor, decay_step, memSize, regressor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, msTargetsDir, featureCacheDir, msLossWeight=1.0,
+             device='auto', cpuThreads=0, amp=0, lossScale=None, dynamicLossScale=0):
+    device = setup_device(device, cpuThreads)
 
     if dataset == 'gtea61':
         num_classes = 61
@@ -46,237 +60,196 @@ def main_run(dataset, stage, train_data_dir, val_data_dir, stage1_dict, out_dir,
     normalize = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     spatial_transform = Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224)])
 
-    vid_seq_train = makeDataset(train_data_dir,
-                                spatial_transform=spatial_transform, seqLen=seqLen, fmt='.png',phase='train', regressor=regressor)
+    frame_cache = make_frame_cache(frameCacheMB, frameCachePolicy)
+    use_features = featureCacheDir is not None
+    feature_level = 'lstm' if stage == 1 else 'layer3'
+    # the MS head only trains in stage 2, the cached features of stage 1 are read without the maps
+    features_targets_dir = msTargetsDir if stage == 2 else None
+    if use_features and stage == 2 and msTargetsDir is None:
+        print('Training stage 2 from --featureCacheDir needs the maps from --msTargetsDir')
+        sys.exit()
+    if use_features:
+        # read the output of the frozen part of the model stored by extractFeatures.py: the whole ResNet
+        # in stage 1, conv1 to layer3 in stage 2
+        vid_seq_train = makeDatasetFeatures.makeDataset(train_data_dir, featureCacheDir, seqLen=seqLen, phase='train',
+                                                        targets_dir=features_targets_dir, regressor=regressor,
+                                                        level=feature_level)
+    else:
+        vid_seq_train = makeDataset(train_data_dir,
+                                    spatial_transform=spatial_transform, seqLen=seqLen, fmt='.png',phase='train', regressor=regressor, frame_cache=frame_cache,
+                                    archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform,
+                                    targets_dir=msTargetsDir)
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, num_workers=4, pin_memory=True)
+                            shuffle=True, num_workers=numWorkers, pin_memory=pin_memory(device),
+                            persistent_workers=frame_cache is not None)
     if val_data_dir is not None:
 
-        vid_seq_val = makeDataset(val_data_dir,
-                                   spatial_transform=Compose([Scale(256), CenterCrop(224)]),
-                                   seqLen=seqLen, fmt='.png',phase='test', regressor=regressor)
+        if use_features:
+            vid_seq_val = makeDatasetFeatures.makeDataset(val_data_dir, featureCacheDir, seqLen=seqLen, phase='test',
+                                                          targets_dir=features_targets_dir, regressor=regressor,
+                                                          level=feature_level)
+        else:
+            vid_seq_val = makeDataset(val_data_dir,
+                                       spatial_transform=Compose([Scale(256), CenterCrop(224)]),
+                                       seqLen=seqLen, fmt='.png',phase='test', regressor=regressor, archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform,
+                                    targets_dir=msTargetsDir)
 
         val_loader = torch.utils.data.DataLoader(vid_seq_val, batch_size=valBatchSize,
-                                shuffle=False, num_workers=2, pin_memory=True)
+                                shuffle=False, num_workers=2, pin_memory=pin_memory(device))
         valInstances = vid_seq_val.__len__()
 
 
     trainInstances = vid_seq_train.__len__()
 
-    train_params = []
-    if stage == 1:
-
-        model = attentionModel_ml(num_classes=num_classes, mem_size=memSize, regressor=regressor)
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
+    model = attentionModel_ml(num_classes=num_classes, mem_size=memSize, regressor=regressor)
+    if stage == 2:
+        model.load_state_dict(torch.load(stage1_dict, map_location='cpu'),strict=False)
+    freeze_plan = FreezePlan(model, TRAINABLE[stage])
+    train_params = freeze_plan.apply()
+    print(freeze_plan.summary())
+    prepare_model(model, device)
+    if not use_features:
+        model_fn = model
+    elif stage == 1:
+        model_fn = model.forward_features
     else:
-
-        model = attentionModel_ml(num_classes=num_classes, mem_size=memSize, regressor=regressor)
-        model.load_state_dict(torch.load(stage1_dict),strict=False)
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
-        #
-        for params in model.resNet.layer4[0].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[0].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[1].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[1].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.resNet.layer4[2].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.resNet.layer4[2].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.resNet.fc.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        for params in model.conv.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        for params in model.clas.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        model.conv.train(True)
-        model.clas.train(True)
-        model.resNet.layer4[0].conv1.train(True)
-        model.resNet.layer4[0].conv2.train(True)
-        model.resNet.layer4[1].conv1.train(True)
-        model.resNet.layer4[1].conv2.train(True)
-        model.resNet.layer4[2].conv1.train(True)
-        model.resNet.layer4[2].conv2.train(True)
-        model.resNet.fc.train(True)
-
-    for params in model.lstm_cell.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.classifier.parameters():
-        params.requires_grad = True
-        train_params += [params]
-        
-
-
-    model.lstm_cell.train(True)
-
-    model.classifier.train(True)
-    model.cuda()
+        model_fn = model.forward_layer3
 
     loss_fn = nn.CrossEntropyLoss()
     loss_fms = nn.NLLLoss()
     loss_reg = nn.MSELoss()
+    # the MS head only trains in stage 2, stage 1 only has the action loss
+    task_losses = {'action': loss_fn, 'ms': loss_reg if regressor == 1 else loss_fn}
+    train_loss = MultiTaskLoss(task_losses, {'ms': msLossWeight})
+    val_loss = MultiTaskLoss(task_losses, {'ms': msLossWeight})
     optimizer_fn = torch.optim.Adam(train_params, lr=lr1, weight_decay=4e-5, eps=1e-4)
 
     optim_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer_fn, milestones=decay_step,
                                                            gamma=decay_factor)
-
+    loss_scaler = LossScaler(lossScale, dynamicLossScale)
+
+    train_metrics = ClassificationMetrics(num_classes)
+    val_metrics = ClassificationMetrics(num_classes)
+    # per-pixel accuracy (%) of the classification MS head, logged as */ms_pixel_accuracy. The baseline
+    # divided the correct pixels by the number of clips, its numbers are not comparable
+    train_metrics_ms = ClassificationMetrics(2)
+    val_metrics_ms = ClassificationMetrics(2)
     train_iter = 0
     min_accuracy = 0
 
     for epoch in range(numEpochs):
-        epoch_loss = 0
-        numCorrTrain = 0
-        numCorrTrain_ms = 0
-        trainSamples = 0
-        iterPerEpoch = 0
-        epoch_loss_ms = 0
-        model.lstm_cell.train(True)
-        model.classifier.train(True)
+        train_metrics.reset()
+        train_metrics_ms.reset()
+        train_loss.reset()
+        freeze_plan.train()
         writer.add_scalar('lr', optimizer_fn.param_groups[0]['lr'], epoch+1)
-        if stage == 2:
-            model.conv.train(True)
-            model.clas.train(True)
-            model.resNet.layer4[0].conv1.train(True)
-            model.resNet.layer4[0].conv2.train(True)
-            model.resNet.layer4[1].conv1.train(True)
-            model.resNet.layer4[1].conv2.train(True)
-            model.resNet.layer4[2].conv1.train(True)
-            model.resNet.layer4[2].conv2.train(True)
-            model.resNet.fc.train(True)
-        for i, (inputs ,binary_map, targets) in enumerate(train_loader):
+        # (inputs, binary_map, targets), or (inputs, targets) for the cached features of stage 1
+        for i, batch in enumerate(train_loader):
+            inputs, targets = batch[0], batch[-1]
             train_iter += 1
-            iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).cuda())
-            labelVariable = Variable(targets.cuda())
-            trainSamples += inputs.size(0)
-            output_label, output_ms = model(inputVariable)
-            
-            loss = loss_fn(output_label, labelVariable)
-
-            if stage==2 :
-                loss.backward(retain_graph=True)
-            else:
-                loss.backward()
-            if regressor == 0:
-                binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).type(torch.LongTensor).cuda())
-                output_ms = output_ms.view(-1,2)
-            elif regressor == 1:
-                binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).cuda())
-                output_ms = output_ms.view(-1)
-            binary_map =binary_map.contiguous().view(-1)
-                        
-            
-            if stage==2:
-                if regressor == 1:
-                    loss_ms=loss_reg(output_ms, binary_map)
-                    loss_ms.backward()
-                    
-                    epoch_loss_ms+=loss_ms.item()
-                elif regressor == 0:
-                    loss_ms=loss_fn(output_ms, binary_map)
-                    loss_ms.backward()
-                    _, predicted = torch.max(output_ms.data, 1)
-                    numCorrTrain_ms += torch.sum(predicted == binary_map.data).data.item()
-                    epoch_loss_ms+=loss_ms.item()
-        
-            optimizer_fn.step()
-            _, predicted = torch.max(output_label.data, 1)
-            numCorrTrain += torch.sum(predicted == labelVariable.data).data.item()
-            epoch_loss += loss.item()
-
-            
-        avg_loss = epoch_loss/iterPerEpoch
+            inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).to(device))
+            labelVariable = Variable(targets.to(device))
+            with autocast(device, amp):
+                output_label, output_ms = model_fn(inputVariable)
+            output_label, output_ms = output_label.float(), output_ms.float()
+
+            outputs = {'action': output_label}
+            labels = {'action': labelVariable}
+            if stage == 2:
+                binary_map = batch[1]
+                if regressor == 0:
+                    binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).type(torch.LongTensor).to(device))
+                    output_ms = output_ms.view(-1,2)
+                elif regressor == 1:
+                    binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).to(device))
+                    output_ms = output_ms.view(-1)
+                binary_map =binary_map.contiguous().view(-1)
+                outputs['ms'] = output_ms
+                labels['ms'] = binary_map
+            # one backward of the weighted sum through the shared ResNet
+            loss, _ = train_loss(outputs, labels)
+            loss_scaler.backward(loss)
+            loss_scaler.step(optimizer_fn)
+
+            if stage == 2 and regressor == 0:
+                train_metrics_ms.update(output_ms, binary_map)
+            train_metrics.update(output_label, labelVariable)
+
+        train_losses = train_loss.averages()
+        train_loss.log(writer, 'train', epoch+1)
+        avg_loss = train_losses['action']
         if stage ==2:
-            trainAccuracy = (numCorrTrain_ms / trainSamples) * 100
-            avg_loss_ms= epoch_loss_ms/iterPerEpoch
+            trainAccuracy = train_metrics_ms.compute()['accuracy']
+            avg_loss_ms = train_losses['ms']
             #avg_loss = avg_loss + avg_loss_ms
             train_log_loss_ms.write('Train Loss MS after {} epochs = {}\n'.format(epoch + 1, avg_loss_ms))
-            if regressor == 0:train_log_acc_ms.write('Train Accuracy after {} epochs = {}%\n'.format(epoch + 1, trainAccuracy))
+            if regressor == 0:
+                train_log_acc_ms.write('Train MS Pixel Accuracy after {} epochs = {}%\n'.format(epoch + 1, trainAccuracy))
+                writer.add_scalar('train/ms_pixel_accuracy', trainAccuracy, epoch + 1)
 
-        trainAccuracy = (numCorrTrain / trainSamples) * 100
+        trainAccuracy = train_metrics.compute()['accuracy']
 
         print('Train: Epoch = {} | Loss = {} | Accuracy = {}'.format(epoch+1, avg_loss, trainAccuracy))
         writer.add_scalar('train/epoch_loss', avg_loss, epoch+1)
-        writer.add_scalar('train/accuracy', trainAccuracy, epoch+1)
+        train_metrics.log(writer, 'train', epoch + 1)
+        if frame_cache is not None:
+            cache_stats = frame_cache.stats()
+            print('Frame cache: hits = {} | misses = {} | hit rate = {:.3f}'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate']))
+            writer.add_scalar('train/frame_cache_hit_rate', cache_stats['hit_rate'], epoch + 1)
         train_log_loss.write('Train Loss after {} epochs = {}\n'.format(epoch + 1, avg_loss))
         
         train_log_acc.write('Train Accuracy after {} epochs = {}%\n'.format(epoch + 1, trainAccuracy))
         if val_data_dir is not None:
             if (epoch+1) % 1 == 0:
                 model.train(False)
-                val_loss_epoch = 0
-                val_iter = 0
-                val_samples = 0
-                numCorr = 0
-                numCorr_ms = 0
-                epoch_loss_ms_val=0
+                val_metrics.reset()
+                val_metrics_ms.reset()
+                val_loss.reset()
                 
-                for j, (inputs, binary_map, targets) in enumerate(val_loader):
-                    val_iter += 1
-                    val_samples += inputs.size(0)
-                    inputVariable = Variable(inputs.permute(1, 0, 2, 3, 4).cuda(), volatile=True)
-                    labelVariable = Variable(targets.cuda(async=True), volatile=True)
-                    output_label, output_ms = model(inputVariable)
-                    val_loss = loss_fn(output_label, labelVariable)
-                    val_loss_epoch += val_loss.item()
-                    if regressor == 0:
-                        binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).type(torch.LongTensor).cuda())
-                        output_ms = output_ms.view(-1,2)
-                    elif regressor == 1:
-                        binary_map = Variable(binary_map.permute(1, 0, 2, 3, 4).cuda())
-                        output_ms = output_ms.view(-1)
-                    binary_map =binary_map.contiguous().view(-1)
-                    if stage==2:
-                        if regressor == 1:
-                            loss_ms=loss_reg(output_ms, binary_map)
-                            
-                            epoch_loss_ms_val+=loss_ms.item()
-                        elif regressor == 0:
-                            loss_ms=loss_fn(output_ms, binary_map)
-                            _, predicted = torch.max(output_ms.data, 1)
-                            numCorr_ms += torch.sum(predicted == binary_map.data).data.item()
-                            epoch_loss_ms_val+=loss_ms.item()
-                                
-                    _, predicted = torch.max(output_label.data, 1)
-                    numCorr += torch.sum(predicted == labelVariable.data).data.item()
+                with torch.inference_mode():
+                    for j, batch in enumerate(val_loader):
+                        inputs, targets = batch[0], batch[-1]
+                        inputVariable = inputs.permute(1, 0, 2, 3, 4).to(device)
+                        labelVariable = targets.to(device, non_blocking=True)
+                        with autocast(device, amp):
+                            output_label, output_ms = model_fn(inputVariable)
+                        output_label, output_ms = output_label.float(), output_ms.float()
+                        outputs = {'action': output_label}
+                        labels = {'action': labelVariable}
+                        if stage == 2:
+                            binary_map = batch[1]
+                            if regressor == 0:
+                                binary_map = binary_map.permute(1, 0, 2, 3, 4).type(torch.LongTensor).to(device)
+                                output_ms = output_ms.view(-1,2)
+                            elif regressor == 1:
+                                binary_map = binary_map.permute(1, 0, 2, 3, 4).to(device)
+                                output_ms = output_ms.view(-1)
+                            binary_map =binary_map.contiguous().view(-1)
+                            outputs['ms'] = output_ms
+                            labels['ms'] = binary_map
+                        val_loss(outputs, labels)
+                        if stage == 2 and regressor == 0:
+                            val_metrics_ms.update(output_ms, binary_map)
+                        val_metrics.update(output_label, labelVariable)
                 
-                avg_val_loss = val_loss_epoch / val_iter
+                val_losses = val_loss.averages()
+                val_loss.log(writer, 'val', epoch + 1)
+                avg_val_loss = val_losses['action']
                 if stage ==2:
-                    avg_loss_ms= epoch_loss_ms_val/ val_iter
-                    val_accuracy = (numCorr_ms / val_samples) * 100
+                    avg_loss_ms = val_losses['ms']
+                    val_accuracy = val_metrics_ms.compute()['accuracy']
                     #avg_loss = avg_loss + avg_loss_ms 
                     val_log_loss_ms.write('Val Loss MS after {} epochs = {}\n'.format(epoch + 1, avg_loss_ms))
-                    if regressor == 0:val_log_acc_ms.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
-                val_accuracy = (numCorr / val_samples) * 100
+                    if regressor == 0:
+                        val_log_acc_ms.write('Val MS Pixel Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
+                        writer.add_scalar('val/ms_pixel_accuracy', val_accuracy, epoch + 1)
+                val_accuracy = val_metrics.compute()['accuracy']
                 print('Val: Epoch = {} | Loss {} | Accuracy = {}'.format(epoch + 1, avg_val_loss, val_accuracy))
                 writer.add_scalar('val/epoch_loss', avg_val_loss, epoch + 1)
-                writer.add_scalar('val/accuracy', val_accuracy, epoch + 1)
+                val_metrics.log(writer, 'val', epoch + 1)
                 
                 val_log_loss.write('Val Loss after {} epochs = {}\n'.format(epoch + 1, avg_val_loss))
                 val_log_acc.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
@@ -320,6 +293,39 @@ def __main__():
     parser.add_argument('--decayRate', type=float, default=0.1, help='Learning rate decay rate')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
     parser.add_argument('--regressor', type=int, default=0, help='Regression version of MS task')
+    parser.add_argument('--frameCacheMB', type=float, default=0,
+                        help='Decoded frame cache per DataLoader worker (MB), 0 disables it')
+    parser.add_argument('--frameCachePolicy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='Frame cache eviction policy')
+    parser.add_argument('--numWorkers', type=int, default=4, help='Train DataLoader worker processes')
+    parser.add_argument('--decodeThreads', type=int, default=0,
+                        help='Threads per DataLoader worker decoding the frames of a clip, 0 decodes them sequentially')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory '
+                             '(the train and val sets can be packed into the same one)')
+    parser.add_argument('--clipTransform', type=int, default=0,
+                        help='Transform each clip as one uint8 tensor instead of frame by frame (the MS targets stay frame by frame), '
+                             'its resizes approximate the PIL ones to one gray level')
+    parser.add_argument('--msTargetsDir', type=str, default=None,
+                        help='Motion segmentation targets precomputed by msTargets.py over the train and val dataset dirs, '
+                             'computed from the maps if not given. Only read from --featureCacheDir in stage 2, '
+                             'stage 1 does not train the MS head')
+    parser.add_argument('--featureCacheDir', type=str, default=None,
+                        help='Train from the features stored by extractFeatures.py over the train and val dataset dirs '
+                             '(--level lstm for stage 1, layer3 for stage 2)')
+    parser.add_argument('--msLossWeight', type=float, default=1.0,
+                        help='Weight of the MS loss in the stage 2 loss, the action loss has weight 1')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the forwards under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--lossScale', type=float, default=None,
+                        help='Scale of the loss before the backward, 1 (no loss scaling) by default. '
+                             'The starting scale with --dynamicLossScale 1, 2**16 by default')
+    parser.add_argument('--dynamicLossScale', type=int, default=0,
+                        help='Halve the loss scale and skip the step when the gradients overflow, '
+                             'double it after 2000 steps without overflow')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -338,9 +344,25 @@ def __main__():
     decayRate = args.decayRate
     memSize = args.memSize
     regressor = args.regressor
+    frameCacheMB = args.frameCacheMB
+    frameCachePolicy = args.frameCachePolicy
+    numWorkers = args.numWorkers
+    decodeThreads = args.decodeThreads
+    clipTransform = args.clipTransform
+    archiveDir = args.archiveDir
+    msTargetsDir = args.msTargetsDir
+    featureCacheDir = args.featureCacheDir
+    msLossWeight = args.msLossWeight
+    device = args.device
+    cpuThreads = args.cpuThreads
+    amp = args.amp
+    lossScale = args.lossScale
+    dynamicLossScale = args.dynamicLossScale
 
     main_run(dataset, stage, trainDatasetDir, valDatasetDir, stage1Dict, outDir, seqLen, trainBatchSize,
-             valBatchSize, numEpochs, lr1, decayRate, stepSize, memSize, regressor)
+             valBatchSize, numEpochs, lr1, decayRate, stepSize, memSize, regressor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, msTargetsDir, featureCacheDir, msLossWeight, device, cpuThreads,
+             amp, lossScale, dynamicLossScale)
 
 __main__()
     
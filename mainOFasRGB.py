@@ -7,15 +7,27 @@ from flow_camModel import *
 
 from torch.utils.data.sampler import WeightedRandomSampler
 from makeDatasetTwoStream import *
+from frameCache import make_frame_cache
 import argparse
 
 import sys
 
 import flow_resnet
+from freezePlanner import FreezePlan
+from devices import setup_device, prepare_model, pin_memory
+from mixedPrecision import autocast, LossScaler
+from metrics import ClassificationMetrics
+
+# modules trained in each stage, the rest of the model is frozen
+TRAINABLE = {1: ['lstm_cell', 'classifier'],
+             2: ['flowResNet.layer4.*.conv[12]', 'flowResNet.fc_action', 'lstm_cell', 'classifier']}
 
 
 def main_run(dataset, flowModel, rgbModel, stage, seqLen, memSize, trainDatasetDir, valDatasetDir, outDir,
-             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor):
+             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device='auto', cpuThreads=0,
+             amp=0, lossScale=None, dynamicLossScale=0):
+    device = setup_device(device, cpuThreads)
 
 
     if dataset == 'gtea61':
@@ -53,11 +65,14 @@ def main_run(dataset, flowModel, rgbModel, stage, seqLen, memSize, trainDatasetD
     spatial_transform = Compose([Scale(256), RandomHorizontalFlip(), MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224),
                                  ToTensor(), normalize])
 
+    frame_cache = make_frame_cache(frameCacheMB, frameCachePolicy)
     vid_seq_train = makeDataset(trainDatasetDir,spatial_transform=spatial_transform,
-                               sequence=False, numSeg=1, fmt='.png', seqLen=seqLen, frame_div=True)
+                               sequence=False, numSeg=1, fmt='.png', seqLen=seqLen, frame_div=True, frame_cache=frame_cache,
+                                archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
     train_loader = torch.utils.data.DataLoader(vid_seq_train, batch_size=trainBatchSize,
-                            shuffle=True, num_workers=4, pin_memory=True)
+                            shuffle=True, num_workers=numWorkers, pin_memory=pin_memory(device),
+                            persistent_workers=frame_cache is not None)
 
     
 
@@ -66,76 +81,21 @@ def main_run(dataset, flowModel, rgbModel, stage, seqLen, memSize, trainDatasetD
         vid_seq_val = makeDataset(valDatasetDir,
                                    spatial_transform=Compose([Scale(256), CenterCrop(224), ToTensor(), normalize]),
                                    sequence=False, numSeg=1, fmt='.png', phase='Test',
-                                   seqLen=seqLen, frame_div=True)
+                                   seqLen=seqLen, frame_div=True, archive_dir=archiveDir, decode_threads=decodeThreads, clip_transform=clipTransform)
 
         val_loader = torch.utils.data.DataLoader(vid_seq_val, batch_size=valBatchSize,
-                                shuffle=False, num_workers=2, pin_memory=True)
+                                shuffle=False, num_workers=2, pin_memory=pin_memory(device))
         valSamples = vid_seq_val.__len__()
 
-    train_params = []
     if stage == 1:
-
         model = attentionModel_flow(num_classes=num_classes,frameModel=rgbModel, mem_size=memSize)
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
     else:
-
         model = attentionModel_flow(num_classes=num_classes, mem_size=memSize)
-        model.load_state_dict(torch.load(flowModel))
-        model.train(False)
-        for params in model.parameters():
-            params.requires_grad = False
-        #
-        for params in model.flowResNet.layer4[0].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.flowResNet.layer4[0].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.flowResNet.layer4[1].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.flowResNet.layer4[1].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        for params in model.flowResNet.layer4[2].conv1.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.flowResNet.layer4[2].conv2.parameters():
-            params.requires_grad = True
-            train_params += [params]
-        #
-        for params in model.flowResNet.fc_action.parameters():
-            params.requires_grad = True
-            train_params += [params]
-
-        model.flowResNet.layer4[0].conv1.train(True)
-        model.flowResNet.layer4[0].conv2.train(True)
-        model.flowResNet.layer4[1].conv1.train(True)
-        model.flowResNet.layer4[1].conv2.train(True)
-        model.flowResNet.layer4[2].conv1.train(True)
-        model.flowResNet.layer4[2].conv2.train(True)
-        model.flowResNet.fc_action.train(True)
-
-    for params in model.lstm_cell.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-    for params in model.classifier.parameters():
-        params.requires_grad = True
-        train_params += [params]
-
-
-    model.lstm_cell.train(True)
-
-    model.classifier.train(True)
-    model.cuda()
+        model.load_state_dict(torch.load(flowModel, map_location='cpu'))
+    freeze_plan = FreezePlan(model, TRAINABLE[stage])
+    train_params = freeze_plan.apply()
+    print(freeze_plan.summary())
+    prepare_model(model, device)
 
     loss_fn = nn.CrossEntropyLoss()
 
@@ -143,77 +103,71 @@ def main_run(dataset, flowModel, rgbModel, stage, seqLen, memSize, trainDatasetD
 
     optim_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer_fn, milestones=decay_step,
                                                            gamma=decay_factor)
+    loss_scaler = LossScaler(lossScale, dynamicLossScale)
 
     trainSamples = vid_seq_train.__len__()
     min_accuracy = 0
 
+    train_metrics = ClassificationMetrics(num_classes)
+    val_metrics = ClassificationMetrics(num_classes)
     train_iter = 0
 
     for epoch in range(numEpochs):
         
-        model.lstm_cell.train(True)
-        model.classifier.train(True)
-        if stage == 2:
-            model.flowResNet.layer4[0].conv1.train(True)
-            model.flowResNet.layer4[0].conv2.train(True)
-            model.flowResNet.layer4[1].conv1.train(True)
-            model.flowResNet.layer4[1].conv2.train(True)
-            model.flowResNet.layer4[2].conv1.train(True)
-            model.flowResNet.layer4[2].conv2.train(True)
-            model.flowResNet.fc_action.train(True)
+        freeze_plan.train()
 
         
-        epoch_loss = 0
-        numCorrTrain = 0
-        iterPerEpoch = 0
+        train_metrics.reset()
         
         for j, (inputFlow, inputFrame, targets) in enumerate(train_loader):
             train_iter += 1
-            iterPerEpoch += 1
             optimizer_fn.zero_grad()
-            inputVariableFlow = inputFlow.permute(1, 0, 2, 3, 4).cuda()
-            inputVariableFrame = inputFrame.permute(1, 0, 2, 3, 4).cuda()
-            labelVariable = targets.cuda()
+            inputVariableFlow = inputFlow.permute(1, 0, 2, 3, 4).to(device)
+            inputVariableFrame = inputFrame.permute(1, 0, 2, 3, 4).to(device)
+            labelVariable = targets.to(device)
             
-            output_label,_ = model(inputVariableFlow, inputVariableFrame)
+            with autocast(device, amp):
+                output_label,_ = model(inputVariableFlow, inputVariableFrame)
+            output_label = output_label.float()
             loss = loss_fn(output_label, labelVariable)
-            loss.backward()
+            loss_scaler.backward(loss)
         
-            optimizer_fn.step()
-            _, predicted = torch.max(output_label.data, 1)
-            numCorrTrain += torch.sum(predicted == labelVariable.data).data.item()
-            epoch_loss += loss.item()
+            loss_scaler.step(optimizer_fn)
+            train_metrics.update(output_label, labelVariable, loss)
         optim_scheduler.step()
-        avg_loss = epoch_loss / iterPerEpoch
-        trainAccuracy = (numCorrTrain / trainSamples) * 100
+        train_result = train_metrics.compute()
+        avg_loss = train_result['loss']
+        trainAccuracy = train_result['accuracy']
         print('Train: Epoch = {} | Loss = {} | Accuracy = {}'.format(epoch+1, avg_loss, trainAccuracy))
-        writer.add_scalar('train/epoch_loss', avg_loss, epoch + 1)
-        writer.add_scalar('train/accuracy', trainAccuracy, epoch + 1)
+        train_metrics.log(writer, 'train', epoch + 1)
+        if frame_cache is not None:
+            cache_stats = frame_cache.stats()
+            print('Frame cache: hits = {} | misses = {} | hit rate = {:.3f}'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate']))
+            writer.add_scalar('train/frame_cache_hit_rate', cache_stats['hit_rate'], epoch + 1)
         train_log_loss.write('Training loss after {} epoch = {}\n'.format(epoch + 1, avg_loss))
         train_log_acc.write('Training accuracy after {} epoch = {}\n'.format(epoch + 1, trainAccuracy))
         if valDatasetDir is not None:
             if (epoch + 1) % 1 == 0:
                 model.train(False)
-                val_loss_epoch = 0
-                val_iter = 0
-                numCorr = 0
-                for j, (inputFlow, inputFrame, targets) in enumerate(val_loader):
-                    val_iter += 1
-                    inputVariableFlow = inputFlow.permute(1, 0, 2, 3, 4).cuda()
-                    inputVariableFrame = inputFrame.permute(1, 0, 2, 3, 4).cuda()
-                    labelVariable = targets.cuda()
+                val_metrics.reset()
+                with torch.inference_mode():
+                    for j, (inputFlow, inputFrame, targets) in enumerate(val_loader):
+                        inputVariableFlow = inputFlow.permute(1, 0, 2, 3, 4).to(device)
+                        inputVariableFrame = inputFrame.permute(1, 0, 2, 3, 4).to(device)
+                        labelVariable = targets.to(device)
                  
-                    output_label,_ = model(inputVariableFlow, inputVariableFrame)
-                    loss = loss_fn(output_label, labelVariable)
+                        with autocast(device, amp):
+                            output_label,_ = model(inputVariableFlow, inputVariableFrame)
+                        output_label = output_label.float()
+                        loss = loss_fn(output_label, labelVariable)
             
-                    val_loss_epoch += loss.item()
-                    _, predicted = torch.max(output_label.data, 1)
-                    numCorr += torch.sum(predicted == labelVariable.data).data.item()
-                val_accuracy = (numCorr / valSamples) * 100
-                avg_val_loss = val_loss_epoch / val_iter
+                        val_metrics.update(output_label, labelVariable, loss)
+                val_result = val_metrics.compute()
+                avg_val_loss = val_result['loss']
+                val_accuracy = val_result['accuracy']
                 print('Val: Epoch = {} | Loss {} | Accuracy = {}'.format(epoch + 1, avg_val_loss, val_accuracy))
-                writer.add_scalar('val/epoch_loss', avg_val_loss, epoch + 1)
-                writer.add_scalar('val/accuracy', val_accuracy, epoch + 1)
+                val_metrics.log(writer, 'val', epoch + 1)
                 val_log_loss.write('Val Loss after {} epochs = {}\n'.format(epoch + 1, avg_val_loss))
                 val_log_acc.write('Val Accuracy after {} epochs = {}%\n'.format(epoch + 1, val_accuracy))
                 if val_accuracy > min_accuracy:
@@ -254,6 +208,30 @@ def __main__():
     parser.add_argument('--decayRate', type=float, default=0.99, help='Learning rate decay rate')
     parser.add_argument('--memSize', type=int, default=512, help='ConvLSTM hidden state size')
     parser.add_argument('--stage', type=int, default=1, help='Stage of the network training process')
+    parser.add_argument('--frameCacheMB', type=float, default=0,
+                        help='Decoded frame cache per DataLoader worker (MB), 0 disables it')
+    parser.add_argument('--frameCachePolicy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='Frame cache eviction policy')
+    parser.add_argument('--numWorkers', type=int, default=4, help='Train DataLoader worker processes')
+    parser.add_argument('--decodeThreads', type=int, default=0,
+                        help='Threads per DataLoader worker decoding the frames of a clip, 0 decodes them sequentially')
+    parser.add_argument('--archiveDir', type=str, default=None,
+                        help='Read the frames from the clip archives written by clipArchive.py in this directory '
+                             '(the train and val sets can be packed into the same one)')
+    parser.add_argument('--clipTransform', type=int, default=0,
+                        help='Transform each clip as one uint8 tensor instead of frame by frame, '
+                             'its resizes approximate the PIL ones to one gray level')
+    parser.add_argument('--amp', type=int, default=0,
+                        help='Run the forwards under bfloat16 autocast (bf16-capable cpus and gpus)')
+    parser.add_argument('--lossScale', type=float, default=None,
+                        help='Scale of the loss before the backward, 1 (no loss scaling) by default. '
+                             'The starting scale with --dynamicLossScale 1, 2**16 by default')
+    parser.add_argument('--dynamicLossScale', type=int, default=0,
+                        help='Halve the loss scale and skip the step when the gradients overflow, '
+                             'double it after 2000 steps without overflow')
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu, or auto to use cuda when available')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
 
     args = parser.parse_args()
 
@@ -272,8 +250,21 @@ def __main__():
     decay_step = args.stepSize
     decay_factor = args.decayRate
     memSize = args.memSize
+    frameCacheMB = args.frameCacheMB
+    frameCachePolicy = args.frameCachePolicy
+    numWorkers = args.numWorkers
+    decodeThreads = args.decodeThreads
+    clipTransform = args.clipTransform
+    archiveDir = args.archiveDir
+    device = args.device
+    cpuThreads = args.cpuThreads
+    amp = args.amp
+    lossScale = args.lossScale
+    dynamicLossScale = args.dynamicLossScale
 
     main_run(dataset, flowModel, rgbModel, stage, seqLen, memSize, trainDatasetDir, valDatasetDir, outDir,
-             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor)
+             trainBatchSize, valBatchSize, lr1, numEpochs, decay_step, decay_factor, frameCacheMB, frameCachePolicy,
+             numWorkers, decodeThreads, clipTransform, archiveDir, device, cpuThreads,
+             amp, lossScale, dynamicLossScale)
 
 __main__()
@@ -4,8 +4,9 @@ from torch.utils.data import Dataset
 from PIL import Image
 import numpy as np
 import random
-import glob
 import sys
+from datasetManifest import load_manifest, manifest_trees, iter_instances
+from frameLoader import FrameLoader
 from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize, MultiScaleCornerCrop,
                                 RandomHorizontalFlip, Binary)
 
@@ -16,55 +17,48 @@ def gen_split(root_dir, stackSize, phase):
     DatasetY = []
     Labels = []
     NumFrames = []
-    
-    for original_dir in sorted(os.listdir(root_dir)):
-        if (original_dir=='.DS_Store' or original_dir=='processed_frames2'): continue
-        root_dir1 = os.path.join(root_dir, original_dir) #GTEA61/flow_x_processed/
-        for dir_user in sorted(os.listdir(root_dir1)):
-            if dir_user=='.DS_Store': continue
-            if (phase=='train') ^ (dir_user=="S2"):
-                class_id = 0
-                dir = os.path.join(root_dir1, dir_user) #GTEA61/processed_frames2/S1/
-                for target in sorted(os.listdir(dir)):
-                    if target=='.DS_Store': continue
-                    dir1 = os.path.join(dir, target) #GTEA61/processed_frames2/S1/close_choco/
-                    insts = sorted(os.listdir(dir1))
-                    if insts != []:
-                        for inst in insts:
-                            if inst=='.DS_Store': continue
-                            inst_dir = os.path.join(dir1, inst) #GTEA61/processed_frames2/S1/close_choco/1/
-                            numFrames = len(glob.glob1(inst_dir, '*.png'))
-                            if numFrames >= stackSize:
-                                if original_dir=='flow_x_processed':
-                                    DatasetX.append(inst_dir)
-                                    Labels.append(class_id)
-                                    NumFrames.append(numFrames)
-                                else:DatasetY.append(inst_dir)
-                               
-                                   
-                                
-                    class_id += 1
+    manifest = load_manifest(root_dir)
+
+    for original_dir in manifest_trees(manifest):
+        if original_dir=='processed_frames2': continue
+        for dir_user, class_id, inst_dir, counts in iter_instances(root_dir, manifest, original_dir, phase):
+            numFrames = counts[''] #GTEA61/flow_x_processed/S1/close_choco/1/
+            if numFrames >= stackSize:
+                if original_dir=='flow_x_processed':
+                    DatasetX.append(inst_dir)
+                    Labels.append(class_id)
+                    NumFrames.append(numFrames)
+                else:DatasetY.append(inst_dir)
     return DatasetX, DatasetY, Labels, NumFrames
 
 class makeDataset(Dataset):
     def __init__(self, root_dir, spatial_transform=None, sequence=False, stackSize=5,
-                 train=True, numSeg=5, fmt='.png', phase='train', seqLen = 25):
+                 train=True, numSeg=5, fmt='.png', phase='train', seqLen = 25, archive_dir=None, frame_cache=None,
+                 decode_threads=0, clip_transform=False):
         """
         Args:
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            archive_dir (string, optional): Read the frames from the clip archives
+                written by clipArchive.py instead of root_dir.
+            frame_cache (FrameCache, optional): Cache for the decoded frames.
+            decode_threads (int): Threads decoding the frames of a clip concurrently.
+            clip_transform (bool): Transform each clip as one uint8 tensor (Compose.clip)
+                instead of frame by frame.
         """
 
         self.imagesX, self.imagesY, self.labels, self.numFrames = gen_split(
             root_dir, stackSize, phase)
-        self.spatial_transform = spatial_transform        
+        self.spatial_transform = spatial_transform
          
         self.train = train
         self.numSeg = numSeg
         self.sequence = sequence
         self.stackSize = stackSize
         self.fmt = fmt
+        self.loader = FrameLoader(root_dir, archive_dir, frame_cache, decode_threads)
+        self.clip_transform = clip_transform
         self.phase = phase
         self.seqLen = seqLen
 
@@ -93,15 +87,19 @@ class makeDataset(Dataset):
                 startFrame = np.ceil((numFrame - self.stackSize)/2)
         
         
+        fl_names = []
         for k in range(self.stackSize):
             i = k + int(startFrame)
-            fl_name = vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png'
-            imgX = Image.open(fl_name)
-            # fl_names.append(fl_name)
-            f1_name = vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png'
-            imgY = Image.open(f1_name)
-            flow_2_channel=torch.stack([self.spatial_transform(imgX.convert('L'), inv=True, flow=True),
-                                        self.spatial_transform(imgY.convert('L'), inv=False, flow=True)],0)
+            fl_names.append(vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png')
+            fl_names.append(vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png')
+        imgs = self.loader.load_clip(fl_names, 'L')
+        if self.clip_transform:
+            inpSeqSegs = torch.cat([self.spatial_transform.clip(imgs[0::2], inv=True, flow=True),
+                                    self.spatial_transform.clip(imgs[1::2], inv=False, flow=True)], 1)
+            return inpSeqSegs, label
+        for imgX, imgY in zip(imgs[0::2], imgs[1::2]):
+            flow_2_channel=torch.stack([self.spatial_transform(imgX, inv=True, flow=True),
+                                        self.spatial_transform(imgY, inv=False, flow=True)],0)
             inpSeqX.append(flow_2_channel.squeeze(1))
 
         inpSeqSegs = torch.stack(inpSeqX, 0)
@@ -0,0 +1,74 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+import makeDatasetRGB
+from extractFeatures import INDEX_NAME
+from datasetManifest import clip_key
+from msTargets import MSTargets, TRANSFORMS, as_view
+
+
+class makeDataset(Dataset):
+    def __init__(self, root_dir, cache_dir, seqLen=25, phase='train', attention=1, targets_dir=None,
+                 regressor=False, level='lstm'):
+        """
+        Args:
+            root_dir (string): Directory with all the images, lists the clips of the phase.
+            cache_dir (string): Output directory of extractFeatures.py.
+            phase (string): 'train' draws one of the stored augmentations of the clip at
+                each read, any other phase reads the center crop.
+            targets_dir (string, optional): Output directory of msTargets.py, the motion
+                segmentation targets of the drawn augmentation are returned too.
+            level (string): 'lstm' reads the ConvLSTM input of stage 1, 'layer3' the ResNet
+                layer3 activations of stage 2, see extractFeatures.py --level.
+        """
+        with open(os.path.join(cache_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        if index.get('keys') != 'instance':
+            raise ValueError('Features in {} are keyed by dataset path, run extractFeatures.py again'.format(cache_dir))
+        if index.get('level', 'lstm') != level:
+            raise ValueError('Features in {} were extracted at level {}, not {}'.format(
+                cache_dir, index.get('level', 'lstm'), level))
+        # the layer3 activations do not depend on the attention
+        if index['seqLen'] != seqLen or (level == 'lstm' and index['attention'] != attention):
+            raise ValueError('Features in {} were extracted with seqLen={} and attention={}'.format(
+                cache_dir, index['seqLen'], index['attention']))
+        self.section = 'train' if phase == 'train' else 'test'
+        self.views = [as_view(v) for v in index['sections'][self.section]['views']]
+        self.path = os.path.join(cache_dir, self.section + '_feats.npy')
+        self.feats = None
+
+        images, self.labels, self.numFrames = makeDatasetRGB.gen_split(root_dir, 5, phase)
+        missing = [clip_key(vid_name) for vid_name in images if clip_key(vid_name) not in index['instances']]
+        if missing:
+            raise ValueError('{} clips of {} are not in {} (e.g. {}), run extractFeatures.py with this dataset dir'.format(
+                len(missing), root_dir, cache_dir, missing[0]))
+        self.rows = [index['instances'][clip_key(vid_name)] for vid_name in images]
+        self.maps = [os.path.dirname(vid_name) + '/mmaps' for vid_name in images]
+        self.seqLen = seqLen
+        self.targets = None
+        if targets_dir is not None:
+            self.targets = MSTargets(targets_dir, TRANSFORMS[self.section](), regressor)
+
+    def __getstate__(self):
+        # the mapping is reopened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['feats'] = None
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if self.feats is None:
+            self.feats = np.load(self.path, mmap_mode='r')
+        label = self.labels[idx]
+        v = random.randint(0, len(self.views) - 1) if self.section == 'train' else 0
+        inpSeq = torch.from_numpy(self.feats[self.rows[idx], v].astype(np.float32))
+        if self.targets is None:
+            return inpSeq, label
+        frames = [int(np.floor(i)) for i in np.linspace(1, self.numFrames[idx], self.seqLen, endpoint=False)]
+        mapSeq = self.targets.lookup(self.maps[idx], frames, self.views[v])
+        return inpSeq, mapSeq, label
@@ -4,8 +4,9 @@ from torch.utils.data import Dataset
 from PIL import Image
 import numpy as np
 import random
-import glob
 import sys
+from datasetManifest import load_manifest, manifest_trees, iter_instances
+from frameLoader import FrameLoader
 
 
 def gen_split(root_dir, stackSize, phase):
@@ -13,44 +14,38 @@ def gen_split(root_dir, stackSize, phase):
     DatasetY = []
     Labels = []
     NumFrames = []
-    
-    for original_dir in sorted(os.listdir(root_dir)):
-        if (original_dir=='.DS_Store' or original_dir=='processed_frames2'): continue
-        root_dir1 = os.path.join(root_dir, original_dir) #GTEA61/flow_x_processed/
-        for dir_user in sorted(os.listdir(root_dir1)):
-            if dir_user=='.DS_Store': continue
-            if (phase=='train') ^ (dir_user=="S2"):
-                class_id = 0
-                dir = os.path.join(root_dir1, dir_user) #GTEA61/processed_frames2/S1/
-                for target in sorted(os.listdir(dir)):
-                    if target=='.DS_Store': continue
-                    dir1 = os.path.join(dir, target) #GTEA61/processed_frames2/S1/close_choco/
-                    insts = sorted(os.listdir(dir1))
-                    if insts != []:
-                        for inst in insts:
-                            if inst=='.DS_Store': continue
-                            inst_dir = os.path.join(dir1, inst) #GTEA61/processed_frames2/S1/close_choco/1/
-                            numFrames = len(glob.glob1(inst_dir, '*.png'))
-                            if numFrames >= stackSize:
+    manifest = load_manifest(root_dir)
 
-                                if (original_dir == 'flow_x_processed'):
-                                    DatasetX.append(inst_dir)
-                                if (original_dir == 'flow_y_processed'):
-                                    DatasetY.append(inst_dir)
-                                    Labels.append(class_id)
-                                NumFrames.append(numFrames)
-                    class_id += 1
+    for original_dir in manifest_trees(manifest):
+        if original_dir=='processed_frames2': continue
+        for dir_user, class_id, inst_dir, counts in iter_instances(root_dir, manifest, original_dir, phase):
+            numFrames = counts[''] #GTEA61/flow_x_processed/S1/close_choco/1/
+            if numFrames >= stackSize:
+
+                if (original_dir == 'flow_x_processed'):
+                    DatasetX.append(inst_dir)
+                if (original_dir == 'flow_y_processed'):
+                    DatasetY.append(inst_dir)
+                    Labels.append(class_id)
+                NumFrames.append(numFrames)
     return DatasetX, DatasetY, Labels, NumFrames
 
 
 class makeDataset(Dataset):
     def __init__(self, root_dir, spatial_transform=None, sequence=False, stackSize=5,
-                 train=True, numSeg = 1, fmt='.png', phase='train',frame_div=False):
+                 train=True, numSeg = 1, fmt='.png', phase='train',frame_div=False, archive_dir=None, frame_cache=None,
+                 decode_threads=0, clip_transform=False):
         """
         Args:
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            archive_dir (string, optional): Read the frames from the clip archives
+                written by clipArchive.py instead of root_dir.
+            frame_cache (FrameCache, optional): Cache for the decoded frames.
+            decode_threads (int): Threads decoding the frames of a clip concurrently.
+            clip_transform (bool): Transform each clip as one uint8 tensor (Compose.clip)
+                instead of frame by frame.
         """
         self.imagesX, self.imagesY, self.labels, self.numFrames = gen_split(root_dir, stackSize,phase)
         self.spatial_transform = spatial_transform
@@ -59,6 +54,8 @@ class makeDataset(Dataset):
         self.sequence = sequence
         self.stackSize = stackSize
         self.fmt = fmt
+        self.loader = FrameLoader(root_dir, archive_dir, frame_cache, decode_threads)
+        self.clip_transform = clip_transform
         self.phase = phase
         self.frame_div=frame_div
     def __len__(self):
@@ -69,40 +66,50 @@ class makeDataset(Dataset):
         vid_nameY = self.imagesY[idx]
         label = self.labels[idx]
         numFrame = self.numFrames[idx]
-        inpSeqSegs = []
         self.spatial_transform.randomize_parameters()
-        
-        if numFrame <= self.stackSize:
-            startFrame = 1
+
+        if self.sequence:
+            # numSeg stacks spread over the clip, the eval scripts average their scores
+            if numFrame <= self.stackSize:
+                startFrames = np.ones(self.numSeg)
+            else:
+                startFrames = np.linspace(1, numFrame - self.stackSize, self.numSeg)
+        elif numFrame <= self.stackSize:
+            startFrames = [1]
         else:
             if self.phase == 'train':
-                startFrame = random.randint(1, numFrame - self.stackSize)
+                startFrames = [random.randint(1, numFrame - self.stackSize)]
             else:
-                startFrame = np.ceil((numFrame - self.stackSize)/2)
+                startFrames = [np.ceil((numFrame - self.stackSize)/2)]
+        fl_names = []
+        for startFrame in startFrames:
+            for k in range(self.stackSize):
+                i = k + int(startFrame)
+                fl_names.append(vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png')
+                fl_names.append(vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png')
+        imgs = self.loader.load_clip(fl_names, 'L')
+        segs = [self.stack(imgs[2 * self.stackSize * s:2 * self.stackSize * (s + 1)]) for s in range(len(startFrames))]
+        if self.sequence:
+            return torch.stack(segs, 0), label
+        return segs[0], label#, fl_name
+
+    def stack(self, imgs):
+        """Input of the flow model for one stack of interleaved x, y frames"""
         inpSeq = []
         inpSeqX = []
         inpSeqY = []
+        if self.clip_transform:
+            inpSeqX = self.spatial_transform.clip(imgs[0::2], inv=True, flow=True)
+            inpSeqY = self.spatial_transform.clip(imgs[1::2], inv=False, flow=True)
+            if self.frame_div:
+                return torch.cat([inpSeqX, inpSeqY], 1)
+            return torch.stack([inpSeqX, inpSeqY], 1).view(-1, *inpSeqX.shape[2:])
         if self.frame_div:
-            for k in range(self.stackSize):
-                i = k + int(startFrame)
-                fl_name = vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png'
-                img = Image.open(fl_name)
-                inpSeqX.append(self.spatial_transform(img.convert('L'), inv=True, flow=True))
-                # fl_names.append(fl_name)
-                f1_name = vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png'
-                img2 = Image.open(f1_name)
-                inpSeqY.append(self.spatial_transform(img2.convert('L'), inv=False, flow=True))
-            inpSeqSegs = torch.stack([torch.stack(inpSeqX, 0).squeeze(1),torch.stack(inpSeqY, 0).squeeze(1)],0).permute(1,0,2,3)
-
-        else:
-            for k in range(self.stackSize):
-                i = k + int(startFrame)
-                fl_name = vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png'
-                img = Image.open(fl_name)
-                inpSeq.append(self.spatial_transform(img.convert('L'), inv=True, flow=True))
-                # fl_names.append(fl_name)
-                fl_name = vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png'
-                img = Image.open(fl_name)
-                inpSeq.append(self.spatial_transform(img.convert('L'), inv=False, flow=True))
-            inpSeqSegs = torch.stack(inpSeq, 0).squeeze(1)
-        return inpSeqSegs, label#, fl_name
+            for img, img2 in zip(imgs[0::2], imgs[1::2]):
+                inpSeqX.append(self.spatial_transform(img, inv=True, flow=True))
+                inpSeqY.append(self.spatial_transform(img2, inv=False, flow=True))
+            return torch.stack([torch.stack(inpSeqX, 0).squeeze(1),torch.stack(inpSeqY, 0).squeeze(1)],0).permute(1,0,2,3)
+        for img, img2 in zip(imgs[0::2], imgs[1::2]):
+            inpSeq.append(self.spatial_transform(img, inv=True, flow=True))
+            inpSeq.append(self.spatial_transform(img2, inv=False, flow=True))
+        return torch.stack(inpSeq, 0).squeeze(1)
@@ -3,10 +3,12 @@ import torch
 from torch.utils.data import Dataset
 from PIL import Image
 import numpy as np
-import glob
 import random
+from datasetManifest import load_manifest, iter_instances
+from frameLoader import FrameLoader
+from msTargets import MSTargets, MAP_THRESHOLD
 from spatial_transforms import (Compose, ToTensor, CenterCrop, Scale, Normalize, MultiScaleCornerCrop,
-                                RandomHorizontalFlip, Binary)
+                                RandomHorizontalFlip, Binary, get_view)
 
 
 def gen_split(root_dir, stackSize, phase):
@@ -14,41 +16,22 @@ def gen_split(root_dir, stackSize, phase):
     Labels = []
     Maps = []
     NumFrames = []
-    root_dir = os.path.join(root_dir, 'processed_frames2') #GTEA61/processed_frames2/
-    
-    for dir_user in sorted(os.listdir(root_dir)): #S1/
-        if dir_user=='.DS_Store': continue
-        if (phase=='train') ^ (dir_user=="S2"):
-            dir = os.path.join(root_dir, dir_user) #GTEA61/processed_frames2/S1/
-            class_id=0
-            
-            for target in sorted(os.listdir(dir)): #close_choco/
-                if target=='.DS_Store': continue
-                dir1 = os.path.join(dir, target) #GTEA61/processed_frames2/S1/close_choco/
-                
-                insts = sorted(os.listdir(dir1)) #1/
-                if insts != []:
-                    for inst in insts:
-                        if inst=='.DS_Store': continue
-                        
-                        inst_dir = os.path.join(dir1, inst+"/rgb") #GTEA61/processed_frames2/S1/close_choco/1/rgb/
-                        numFrames = len(glob.glob1(inst_dir, '*.png'))
-                        
-                        if numFrames >= stackSize:
-                            RGB.append(inst_dir)
-                            Labels.append(class_id)
-                            NumFrames.append(numFrames)
-                            
-                        inst_dir = os.path.join(dir1, inst+"/mmaps") #GTEA61/processed_frames2/S1/close_choco/1/mmaps/
-                        
-                        if numFrames >= stackSize:
-                            Maps.append(inst_dir)
-                class_id += 1
+    manifest = load_manifest(root_dir)
+
+    for dir_user, class_id, inst_dir, counts in iter_instances(root_dir, manifest, 'processed_frames2', phase):
+        numFrames = counts['rgb']
+
+        if numFrames >= stackSize:
+            RGB.append(inst_dir + "/rgb") #GTEA61/processed_frames2/S1/close_choco/1/rgb/
+            Labels.append(class_id)
+            NumFrames.append(numFrames)
+            Maps.append(inst_dir + "/mmaps") #GTEA61/processed_frames2/S1/close_choco/1/mmaps/
     return RGB, Maps, Labels, NumFrames 
 
 class makeDataset(Dataset):
     def __init__(self, root_dir, spatial_transform=None, seqLen=20,
-                 train=True, mulSeg=False, numSeg=1, fmt='.png',phase='train', regressor=False):
+                 train=True, mulSeg=False, numSeg=1, fmt='.png',phase='train', regressor=False, archive_dir=None, frame_cache=None,
+                 decode_threads=0, clip_transform=False, targets_dir=None):
 
         self.images, self.maps, self.labels, self.numFrames = gen_split(root_dir, 5,phase)
         normalize = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
@@ -56,7 +39,7 @@ class makeDataset(Dataset):
         self.spatial_rgb= Compose([self.spatial_transform0, ToTensor(), normalize])
         
         if not(regressor):
-            self.spatial_transform_map = Compose([self.spatial_transform0, Scale(7), ToTensor(), Binary(0.4)])
+            self.spatial_transform_map = Compose([self.spatial_transform0, Scale(7), ToTensor(), Binary(MAP_THRESHOLD)])
         else:
             self.spatial_transform_map = Compose([self.spatial_transform0, Scale(7), ToTensor()])
                
@@ -66,6 +49,22 @@ class makeDataset(Dataset):
         self.numSeg = numSeg
         self.seqLen = seqLen
         self.fmt = fmt
+        self.loader = FrameLoader(root_dir, archive_dir, frame_cache, decode_threads)
+        self.clip_transform = clip_transform
+        # 7x7 targets precomputed by msTargets.py for every view of spatial_transform0
+        self.targets = MSTargets(targets_dir, self.spatial_transform0, regressor) if targets_dir is not None else None
+
+    def map_frame(self, map_name, i):
+        # nearest existing map around frame i: i, i+1, i-1, i+2, i-2, ...
+        j=i
+        while True:
+            maps_name = map_name + '/' + 'map' + str(int(np.floor(j))).zfill(4) + self.fmt
+            if self.loader.exists(maps_name):
+                return maps_name
+            if j<=i:
+                j= 2*i-j+1 #j=i --> j=i +1 ; j=i-1 j-i=-1 --> j=i-(-1)+1
+            else:
+                j= 2*i-j #j=i+1 j-i=1 --> j=i-1
 
     def __len__(self):
         return len(self.images)
@@ -79,26 +78,19 @@ class makeDataset(Dataset):
         inpSeq = []
         mapSeq = []
         self.spatial_transform0.randomize_parameters()
-        for i in np.linspace(1, numFrame, self.seqLen, endpoint=False):
-            fl_name = vid_name + '/' + 'rgb' + str(int(np.floor(i))).zfill(4) + self.fmt
-            img = Image.open(fl_name)
-            flag=1
-            j=i
-            while(flag):
-                
-                maps_name = map_name + '/' + 'map' + str(int(np.floor(j))).zfill(4) + self.fmt
-                try:
-                    mappa = Image.open(maps_name)
-                    flag=0
-                except:
-                    if j<=i:
-                        j= 2*i-j+1 #j=i --> j=i +1 ; j=i-1 j-i=-1 --> j=i-(-1)+1
-                    else:
-                        j= 2*i-j #j=i+1 j-i=1 --> j=i-1
-                    continue
-
-            inpSeq.append(self.spatial_rgb(img.convert('RGB')))
-            mapSeq.append(self.spatial_transform_map(mappa.convert('L'))) #Grayscale
-        inpSeq = torch.stack(inpSeq, 0)
-        mapSeq = torch.stack(mapSeq, 0)
+        frames = [int(np.floor(i)) for i in np.linspace(1, numFrame, self.seqLen, endpoint=False)]
+        fl_names = [vid_name + '/' + 'rgb' + str(i).zfill(4) + self.fmt for i in frames]
+        imgs = self.loader.load_clip(fl_names, 'RGB')
+        if self.targets is not None:
+            mapSeq = self.targets.lookup(map_name, frames, get_view(self.spatial_transform0))
+            if self.clip_transform:
+                return self.spatial_rgb.clip(imgs), mapSeq, label
+            inpSeq = torch.stack([self.spatial_rgb(img) for img in imgs], 0)
+            return inpSeq, mapSeq, label
+        maps = self.loader.load_clip([self.map_frame(map_name, i) for i in frames], 'L')
+        # the maps stay on the PIL path, the off by one pixels of resize_clip would flip Binary targets
+        mapSeq = torch.stack([self.spatial_transform_map(mappa) for mappa in maps], 0) #Grayscale
+        if self.clip_transform:
+            return self.spatial_rgb.clip(imgs), mapSeq, label
+        inpSeq = torch.stack([self.spatial_rgb(img) for img in imgs], 0)
         return inpSeq, mapSeq, label
@@ -4,72 +4,63 @@ from torch.utils.data import Dataset
 from PIL import Image
 import numpy as np
 import random
-import glob
 import sys
+from datasetManifest import load_manifest, join_instances
+from frameLoader import FrameLoader
+
+
+FLOW_X_TREE = 'flow_x_processed'
+FLOW_Y_TREE = 'flow_y_processed'
+RGB_TREE = 'processed_frames2'
 
 
 def gen_split(root_dir, stackSize, seqLen, frame_div, phase):
+    """Lists the instances having rgb frames and both flow components.
+    Returns the flow_x, flow_y and rgb dirs, the labels and the flow and rgb frame counts,
+    all aligned on the instance."""
     DatasetX = []
     DatasetY = []
     DatasetF = []
     Labels = []
+    NumFlowFrames = []
     NumFrames = []
-    
-    for original_dir in sorted(os.listdir(root_dir)):
-        if (original_dir=='.DS_Store'): continue
-        root_dir1 = os.path.join(root_dir, original_dir) #GTEA61/flow_x_processed/
-        for dir_user in sorted(os.listdir(root_dir1)):
-            if dir_user=='.DS_Store': continue
-            if (phase=='train') ^ (dir_user=="S2"):
-                class_id = 0
-                dir = os.path.join(root_dir1, dir_user) #GTEA61/processed_frames2/S1/
-                for target in sorted(os.listdir(dir)):
-                    if target=='.DS_Store': continue
-                    dir1 = os.path.join(dir, target) #GTEA61/processed_frames2/S1/close_choco/
-                    insts = sorted(os.listdir(dir1))
-                    if insts != []:
-                        for inst in insts:
-                            if inst=='.DS_Store': continue
-                            inst_dir = os.path.join(dir1, inst) #GTEA61/processed_frames2/S1/close_choco/1/
-                            numFrames = len(glob.glob1(inst_dir, '*.png'))
-                            if (original_dir == 'processed_frames2'):
-                                numFrames = len(glob.glob1(inst_dir+'/rgb', '*.png'))
-                            if frame_div:
-                                if numFrames >= seqLen:
-
-                                    if (original_dir == 'flow_x_processed'):
-                                        DatasetX.append(inst_dir)
-                                    if (original_dir == 'flow_y_processed'):
-                                        DatasetY.append(inst_dir)
-                                    if (original_dir == 'processed_frames2'):   
-                                        DatasetF.append(inst_dir+'/rgb')
-                                        Labels.append(class_id)
-                                    NumFrames.append(numFrames)
-                            else:
-                                if numFrames >= stackSize:
+    manifest = load_manifest(root_dir)
+    minFrames = seqLen if frame_div else stackSize
 
-                                    if (original_dir == 'flow_x_processed'):
-                                        DatasetX.append(inst_dir)
-                                    if (original_dir == 'flow_y_processed'):
-                                        DatasetY.append(inst_dir)
-                                    if (original_dir == 'processed_frames2'):   
-                                        DatasetF.append(inst_dir+'/rgb')
-                                        Labels.append(class_id)
-                                    NumFrames.append(numFrames)
-                    class_id += 1
-    return DatasetX, DatasetY, DatasetF, Labels, NumFrames
+    joined, incomplete = join_instances(root_dir, manifest, (RGB_TREE, FLOW_X_TREE, FLOW_Y_TREE), phase)
+    for (dir_user, target, inst), missing in incomplete:
+        print('Skipping {}/{}/{}: missing in {}'.format(dir_user, target, inst, ', '.join(missing)))
+    for dir_user, class_id, trees in joined:
+        #GTEA61/flow_x_processed/S1/close_choco/1/
+        numFlowFrames = min(trees[FLOW_X_TREE][1][''], trees[FLOW_Y_TREE][1][''])
+        numFrames = trees[RGB_TREE][1]['rgb']
+        if numFlowFrames >= minFrames and numFrames >= minFrames:
+            DatasetX.append(trees[FLOW_X_TREE][0])
+            DatasetY.append(trees[FLOW_Y_TREE][0])
+            DatasetF.append(trees[RGB_TREE][0] + '/rgb')
+            Labels.append(class_id)
+            NumFlowFrames.append(numFlowFrames)
+            NumFrames.append(numFrames)
+    return DatasetX, DatasetY, DatasetF, Labels, NumFlowFrames, NumFrames
 
 class makeDataset(Dataset):
     def __init__(self, root_dir, spatial_transform=None, sequence=False, stackSize=5,
-                 train=True, numSeg=5, fmt='.png', phase='train', seqLen = 25,frame_div=False):
+                 train=True, numSeg=5, fmt='.png', phase='train', seqLen = 25,frame_div=False, archive_dir=None, frame_cache=None,
+                 decode_threads=0, clip_transform=False):
         """
         Args:
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            archive_dir (string, optional): Read the frames from the clip archives
+                written by clipArchive.py instead of root_dir.
+            frame_cache (FrameCache, optional): Cache for the decoded frames.
+            decode_threads (int): Threads decoding the frames of a clip concurrently.
+            clip_transform (bool): Transform each clip as one uint8 tensor (Compose.clip)
+                instead of frame by frame.
         """
 
-        self.imagesX, self.imagesY, self.imagesF, self.labels, self.numFrames = gen_split(
+        self.imagesX, self.imagesY, self.imagesF, self.labels, self.numFlowFrames, self.numFrames = gen_split(
             root_dir, stackSize, seqLen, frame_div, phase)
         self.spatial_transform = spatial_transform
         self.train = train
@@ -77,6 +68,8 @@ class makeDataset(Dataset):
         self.sequence = sequence
         self.stackSize = stackSize
         self.fmt = fmt
+        self.loader = FrameLoader(root_dir, archive_dir, frame_cache, decode_threads)
+        self.clip_transform = clip_transform
         self.phase = phase
         self.seqLen = seqLen
         self.frame_div=frame_div
@@ -89,53 +82,78 @@ class makeDataset(Dataset):
         vid_nameY = self.imagesY[idx]
         vid_nameF = self.imagesF[idx]
         label = self.labels[idx]
+        numFlowFrame = self.numFlowFrames[idx]
         numFrame = self.numFrames[idx]
         inpSeqSegs = []
         self.spatial_transform.randomize_parameters()
         
         inpSeq = []
         if self.frame_div:
-            if numFrame <= self.seqLen:
+            if numFlowFrame <= self.seqLen:
                 startFrame = 1
             else:
                 if self.phase == 'train':
-                    startFrame = random.randint(1, numFrame - self.seqLen)
+                    startFrame = random.randint(1, numFlowFrame - self.seqLen)
                 else:
-                    startFrame = np.ceil((numFrame - self.seqLen)/2)
+                    startFrame = np.ceil((numFlowFrame - self.seqLen)/2)
+            fl_names = []
             for k in range(self.seqLen):
                 i = k + int(startFrame)
-                fl_name = vid_nameX + '/flow_x_' + str(int(np.floor(i))).zfill(5) + '.png'
-                imgX = Image.open(fl_name)
-                f1_name = vid_nameY + '/flow_y_' + str(int(np.floor(i))).zfill(5) + '.png'
-                imgY = Image.open(f1_name)
-                flow_2_channel=torch.stack([self.spatial_transform(imgX.convert('L'), inv=True, flow=True),
-                                            self.spatial_transform(imgY.convert('L'), inv=False, flow=True)],0)
-                inpSeq.append(flow_2_channel.squeeze(1))
-            inpSeqSegs = torch.stack(inpSeq,0)
+                fl_names.append(vid_nameX + '/flow_x_' + str(int(np.floor(i))).zfill(5) + '.png')
+                fl_names.append(vid_nameY + '/flow_y_' + str(int(np.floor(i))).zfill(5) + '.png')
+            imgs = self.loader.load_clip(fl_names, 'L')
+            if self.clip_transform:
+                inpSeqSegs = torch.cat([self.spatial_transform.clip(imgs[0::2], inv=True, flow=True),
+                                        self.spatial_transform.clip(imgs[1::2], inv=False, flow=True)], 1)
+            else:
+                for imgX, imgY in zip(imgs[0::2], imgs[1::2]):
+                    flow_2_channel=torch.stack([self.spatial_transform(imgX, inv=True, flow=True),
+                                                self.spatial_transform(imgY, inv=False, flow=True)],0)
+                    inpSeq.append(flow_2_channel.squeeze(1))
+                inpSeqSegs = torch.stack(inpSeq,0)
         else:
-            if numFrame <= self.stackSize:
-                startFrame = 1
+            if self.sequence:
+                # numSeg stacks spread over the clip, the eval scripts average their scores
+                if numFlowFrame <= self.stackSize:
+                    startFrames = np.ones(self.numSeg)
+                else:
+                    startFrames = np.linspace(1, numFlowFrame - self.stackSize, self.numSeg)
+            elif numFlowFrame <= self.stackSize:
+                startFrames = [1]
             else:
                 if self.phase == 'train':
-                    startFrame = random.randint(1, numFrame - self.stackSize)
+                    startFrames = [random.randint(1, numFlowFrame - self.stackSize)]
                 else:
-                    startFrame = np.ceil((numFrame - self.stackSize)/2)
-            
-            
-            for k in range(self.stackSize):
-                i = k + int(startFrame)
-                fl_name = vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png'
-                img = Image.open(fl_name)
-                inpSeq.append(self.spatial_transform(img.convert('L'), inv=True, flow=True))
-                # fl_names.append(fl_name)
-                fl_name = vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png'
-                img = Image.open(fl_name)
-                inpSeq.append(self.spatial_transform(img.convert('L'), inv=False, flow=True))
-            inpSeqSegs = torch.stack(inpSeq, 0).squeeze(1)
+                    startFrames = [np.ceil((numFlowFrame - self.stackSize)/2)]
+
+            fl_names = []
+            for startFrame in startFrames:
+                for k in range(self.stackSize):
+                    i = k + int(startFrame)
+                    fl_names.append(vid_nameX + '/flow_x_' + str(int(round(i))).zfill(5) + '.png')
+                    fl_names.append(vid_nameY + '/flow_y_' + str(int(round(i))).zfill(5) + '.png')
+            imgs = self.loader.load_clip(fl_names, 'L')
+            segs = []
+            for seg in range(len(startFrames)):
+                segImgs = imgs[2 * self.stackSize * seg:2 * self.stackSize * (seg + 1)]
+                if self.clip_transform:
+                    inpSeqX = self.spatial_transform.clip(segImgs[0::2], inv=True, flow=True)
+                    inpSeqY = self.spatial_transform.clip(segImgs[1::2], inv=False, flow=True)
+                    segs.append(torch.stack([inpSeqX, inpSeqY], 1).view(-1, *inpSeqX.shape[2:]))
+                else:
+                    inpSeq = []
+                    for img, img2 in zip(segImgs[0::2], segImgs[1::2]):
+                        inpSeq.append(self.spatial_transform(img, inv=True, flow=True))
+                        inpSeq.append(self.spatial_transform(img2, inv=False, flow=True))
+                    segs.append(torch.stack(inpSeq, 0).squeeze(1))
+            inpSeqSegs = torch.stack(segs, 0) if self.sequence else segs[0]
         inpSeqF = []
-        for i in np.linspace(1, numFrame, self.seqLen, endpoint=False):
-            fl_name = vid_nameF + '/' + 'rgb' + str(int(np.floor(i))).zfill(4) + self.fmt
-            img = Image.open(fl_name)
-            inpSeqF.append(self.spatial_transform(img.convert('RGB')))
+        fl_names = [vid_nameF + '/' + 'rgb' + str(int(np.floor(i))).zfill(4) + self.fmt
+                    for i in np.linspace(1, numFrame, self.seqLen, endpoint=False)]
+        imgs = self.loader.load_clip(fl_names, 'RGB')
+        if self.clip_transform:
+            return inpSeqSegs, self.spatial_transform.clip(imgs), label
+        for img in imgs:
+            inpSeqF.append(self.spatial_transform(img))
         inpSeqF = torch.stack(inpSeqF, 0)
         return inpSeqSegs, inpSeqF, label#, vid_nameF#, fl_name
@@ -0,0 +1,96 @@
+import torch
+
+
+class ClassificationMetrics(object):
+    """Confusion matrix, top-k accuracies and average loss of a classifier, accumulated with
+    bincount on the device of its outputs. Nothing is copied to the host before compute(), so that
+    a training loop only synchronizes once per epoch.
+
+    Args:
+        num_classes (int): Number of classes.
+        topk (tuple): Top-k accuracies reported besides the top-1 one, k > num_classes are ignored.
+    """
+
+    def __init__(self, num_classes, topk=(5,)):
+        self.num_classes = num_classes
+        self.topk = tuple(k for k in topk if 1 < k <= num_classes)
+        self.reset()
+
+    def reset(self):
+        self.confusion = None
+        self.topk_hits = None
+        self.loss_sum = None
+        self.loss_count = 0
+        self.result = None
+
+    def update(self, scores, labels, loss=None):
+        """Adds a batch of (B x num_classes) scores, their (B) labels and, optionally, their loss"""
+        scores = scores.detach()
+        labels = labels.to(scores.device, non_blocking=True).view(-1)
+        n = self.num_classes
+        if self.confusion is None:
+            self.confusion = torch.zeros(n * n, dtype=torch.long, device=scores.device)
+            self.topk_hits = torch.zeros(len(self.topk), dtype=torch.long, device=scores.device)
+        # row = true class, column = predicted class
+        self.confusion += torch.bincount(labels * n + scores.argmax(1), minlength=n * n)
+        if self.topk:
+            hits = (scores.topk(max(self.topk), 1)[1] == labels[:, None]).cumsum(1)
+            self.topk_hits += hits[:, [k - 1 for k in self.topk]].sum(0)
+        if loss is not None:
+            loss = loss.detach().float()
+            self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+            self.loss_count += 1
+        self.result = None
+
+    def compute(self):
+        """Copies the accumulated counts to the host (the only synchronization) and returns a dict with
+        the confusion matrix, the accuracy, top<k>_accuracy, per_class_accuracy (nan for the classes
+        without samples), the number of samples and, when losses were given, the average loss per batch.
+        Accuracies are in percent.
+        """
+        if self.result is not None:
+            return self.result
+        n = self.num_classes
+        if self.confusion is None:
+            confusion = torch.zeros(n, n, dtype=torch.long)
+            topk_hits = torch.zeros(len(self.topk), dtype=torch.long)
+        else:
+            confusion = self.confusion.cpu().view(n, n)
+            topk_hits = self.topk_hits.cpu()
+        samples = int(confusion.sum())
+        per_class = confusion.diag().double() / confusion.sum(1).double()
+        result = {'confusion': confusion, 'samples': samples,
+                  'accuracy': 100.0 * float(confusion.diag().sum()) / max(samples, 1),
+                  'per_class_accuracy': 100.0 * per_class}
+        for k, hits in zip(self.topk, topk_hits.tolist()):
+            result['top{}_accuracy'.format(k)] = 100.0 * hits / max(samples, 1)
+        if self.loss_count:
+            result['loss'] = float(self.loss_sum) / self.loss_count
+        self.result = result
+        return result
+
+    def log(self, writer, prefix, epoch):
+        """Writes <prefix>/accuracy, <prefix>/top<k>_accuracy and <prefix>/epoch_loss to a tensorboard SummaryWriter"""
+        result = self.compute()
+        writer.add_scalar('{}/accuracy'.format(prefix), result['accuracy'], epoch)
+        for k in self.topk:
+            writer.add_scalar('{}/top{}_accuracy'.format(prefix, k), result['top{}_accuracy'.format(k)], epoch)
+        if 'loss' in result:
+            writer.add_scalar('{}/epoch_loss'.format(prefix), result['loss'], epoch)
+
+
+def plot_confusion(confusion, path, show=True):
+    """Saves the row-normalized confusion matrix to path (and shows it). matplotlib is only needed here."""
+    import matplotlib.pyplot as plt
+    confusion = confusion.double()
+    normalized = (confusion / confusion.sum(1, keepdim=True).clamp(min=1)).numpy()
+    ticks = range(confusion.size(0))
+    plt.imshow(normalized, interpolation='none', cmap='binary')
+    plt.colorbar()
+    plt.xticks(ticks, fontsize=6)
+    plt.yticks(ticks, fontsize=6)
+    plt.grid(True)
+    plt.clim(0, 1)
+    plt.savefig(path, bbox_inches='tight')
+    if show:
+        plt.show()
@@ -0,0 +1,62 @@
+import torch
+
+
+def autocast(device, enabled):
+    """bfloat16 autocast of the forwards on device when enabled (--amp 1), a no-op context otherwise.
+
+    The convolutions and matmuls of the backbones and of the ConvLSTM run in bf16. The models keep
+    the CAM softmax and the gates and cell state of MyConvLSTMCell in fp32, and the scripts compute
+    the losses on the fp32 scores, out of the autocast region.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=bool(enabled))
+
+
+class LossScaler(object):
+    """Loss scaling of the backward of a training loop, off by default: bf16 has the exponent range
+    of fp32, its small gradients do not underflow as fp16 ones do.
+
+    Args:
+        scale (float): Scale of the loss, the gradients are divided by it before the step. 1 disables it.
+            With dynamic, the starting scale. None gives 1, or 2**16 with dynamic.
+        dynamic (bool): Skip the steps whose gradients overflow and halve the scale, double it after
+            growth_interval steps without overflow. The check synchronizes once per step.
+    """
+
+    def __init__(self, scale=None, dynamic=False, growth_interval=2000):
+        if scale is None:
+            scale = 2.0 ** 16 if dynamic else 1.0
+        self.scale = float(scale)
+        self.dynamic = dynamic
+        self.growth_interval = growth_interval
+        self.good_steps = 0
+        self.skipped_steps = 0
+
+    def enabled(self):
+        return self.dynamic or self.scale != 1.0
+
+    def backward(self, loss):
+        (loss * self.scale if self.enabled() else loss).backward()
+
+    def step(self, optimizer):
+        """Unscales the gradients of the params of optimizer and steps it, returns False if the step was skipped"""
+        if not self.enabled():
+            optimizer.step()
+            return True
+        grads = [p.grad for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+        if not grads:
+            optimizer.step()
+            return True
+        # an inf or nan gradient makes its sum non finite
+        if self.dynamic and not bool(torch.isfinite(torch.stack([g.float().sum() for g in grads])).all()):
+            self.scale /= 2
+            self.good_steps = 0
+            self.skipped_steps += 1
+            return False
+        for g in grads:
+            g.div_(self.scale)
+        optimizer.step()
+        if self.dynamic:
+            self.good_steps += 1
+            if self.good_steps % self.growth_interval == 0:
+                self.scale *= 2
+        return True
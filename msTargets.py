@@ -0,0 +1,170 @@
+import os
+import copy
+import json
+import argparse
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from datasetManifest import clip_key
+from spatial_transforms import (Compose, Scale, CenterCrop, MultiScaleCornerCrop, RandomHorizontalFlip,
+                                enumerate_views, set_view, transform_steps)
+
+INDEX_NAME = 'index.json'
+MAP_SIZE = 7
+MAP_THRESHOLD = 0.4
+# spatial_transform0 of mainMsTask.py for training and validation
+TRANSFORMS = {'train': lambda: Compose([Scale(256), RandomHorizontalFlip(),
+                                        MultiScaleCornerCrop([1, 0.875, 0.75, 0.65625], 224)]),
+              'test': lambda: Compose([Scale(256), CenterCrop(224)])}
+
+
+def transform_signature(transform):
+    """Names the steps of a transform and their fixed parameters, e.g. Scale(256)|CenterCrop((224, 224))"""
+    steps = []
+    for t in transform_steps(transform):
+        params = [repr(getattr(t, a)) for a in ('scales', 'size') if hasattr(t, a)]
+        steps.append('{}({})'.format(type(t).__name__, ', '.join(params)))
+    return '|'.join(steps)
+
+
+def as_view(value):
+    # json turns the view tuples into lists
+    if isinstance(value, list):
+        return tuple(as_view(v) for v in value)
+    return value
+
+
+class MSTargets(object):
+    """Looks up the 7x7 motion segmentation targets precomputed by msTargets.py.
+
+    Args:
+        targets_dir (string): Output directory of msTargets.py.
+        transform (Compose): spatial_transform0 of the dataset, selects the precomputed views.
+        regressor (bool): Return the map values in [0, 1] instead of the binary targets.
+    """
+
+    def __init__(self, targets_dir, transform, regressor=False):
+        with open(os.path.join(targets_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        if index.get('keys') != 'instance':
+            raise ValueError('Targets in {} are keyed by dataset path, run msTargets.py again'.format(targets_dir))
+        signature = transform_signature(transform)
+        if signature not in index['sections']:
+            raise ValueError('No targets for {} in {}, run msTargets.py for this transform'.format(
+                signature, targets_dir))
+        if index['threshold'] != MAP_THRESHOLD:
+            raise ValueError('Targets in {} were binarized at {}'.format(targets_dir, index['threshold']))
+        section = index['sections'][signature]
+        self.views = {as_view(v): i for i, v in enumerate(section['views'])}
+        self.path = os.path.join(targets_dir, section['name'] + ('_values.npy' if regressor else '_bits.npy'))
+        self.instances = index['instances']
+        self.targets_dir = targets_dir
+        self.regressor = regressor
+        self.data = None
+
+    def __getstate__(self):
+        # the mapping is reopened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def lookup(self, map_dir, frames, view):
+        """Targets of frames (1-based) of an instance for the given view, a float tensor (T x 1 x 7 x 7)"""
+        if self.data is None:
+            self.data = np.load(self.path, mmap_mode='r')
+        key = clip_key(map_dir)
+        if key not in self.instances:
+            raise KeyError('No targets for the instance {} ({}) in {}, run msTargets.py with its dataset dir'.format(
+                key, map_dir, self.targets_dir))
+        offset = self.instances[key][0]
+        rows = self.data[offset + np.asarray(frames) - 1, self.views[view]]
+        if self.regressor:
+            maps = rows.astype(np.float32) / np.float32(255)
+        else:
+            maps = np.unpackbits(rows, axis=-1)[:, :MAP_SIZE * MAP_SIZE].astype(np.float32)
+        return torch.from_numpy(maps.reshape(-1, 1, MAP_SIZE, MAP_SIZE))
+
+
+def binarize(values, threshold):
+    # same comparison as Binary: float32 map value against a double threshold
+    return np.packbits((values.astype(np.float32) / np.float32(255)).astype(np.float64) > threshold, axis=-1)
+
+
+def instance_targets(dataset, map_dir, num_frames, sections, outputs, offset):
+    sections = copy.deepcopy(sections)  # set_view changes the transforms, one copy per task
+    for f in range(1, num_frames + 1):
+        mappa = dataset.loader(dataset.map_frame(map_dir, f), 'L')
+        for (name, transform, views) in sections:
+            values = np.empty((len(views), MAP_SIZE * MAP_SIZE), np.uint8)
+            for v, view in enumerate(views):
+                set_view(transform, view)
+                values[v] = np.asarray(transform(mappa)).reshape(-1)
+            outputs[name][0][offset + f - 1] = values
+            outputs[name][1][offset + f - 1] = binarize(values, MAP_THRESHOLD)
+
+
+def main_run(root_dirs, out_dir, workers):
+    import makeDatasetMS
+
+    # the instances of every dataset dir, e.g. the train and val splits of mainMsTask.py
+    instances = {}
+    for root_dir in root_dirs:
+        for phase in ('train', 'test'):
+            dataset = makeDatasetMS.makeDataset(root_dir, spatial_transform=TRANSFORMS[phase](), phase=phase)
+            for map_dir, num_frames in zip(dataset.maps, dataset.numFrames):
+                key = clip_key(map_dir)
+                if key in instances and instances[key][1] != map_dir:
+                    raise ValueError('Instance {} in both {} and {}'.format(key, instances[key][1], map_dir))
+                instances[key] = (dataset, map_dir, num_frames)
+
+    offsets = {}
+    total = 0
+    for key in sorted(instances):
+        offsets[key] = [total, instances[key][2]]
+        total += instances[key][2]
+
+    os.makedirs(out_dir, exist_ok=True)
+    sections = []
+    outputs = {}
+    index = {'threshold': MAP_THRESHOLD, 'keys': 'instance', 'sections': {}, 'instances': offsets}
+    for name, make in sorted(TRANSFORMS.items()):
+        transform = make()
+        views = enumerate_views(transform)
+        # Scale(7) of spatial_transform_map, stopped before ToTensor
+        sections.append((name, Compose([transform, Scale(MAP_SIZE)]), views))
+        index['sections'][transform_signature(transform)] = {'name': name, 'views': views}
+        outputs[name] = (
+            np.lib.format.open_memmap(os.path.join(out_dir, name + '_values.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(total, len(views), MAP_SIZE * MAP_SIZE)),
+            np.lib.format.open_memmap(os.path.join(out_dir, name + '_bits.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(total, len(views), (MAP_SIZE * MAP_SIZE + 7) // 8)))
+        print('{}: {} views'.format(name, len(views)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(instance_targets, instances[key][0], instances[key][1], instances[key][2], sections,
+                            outputs, offsets[key][0]) for key in sorted(instances)]
+        for job in jobs:
+            job.result()
+    for values, bits in outputs.values():
+        values.flush()
+        bits.flush()
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    print('{} instances, {} frames written to {}'.format(len(offsets), total, out_dir))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetDir', type=str, nargs='+',
+                        default=['./dataset/gtea_warped_flow_61/split2/train', './dataset/gtea_warped_flow_61/split2/test'],
+                        help='Dataset directories, the train and val dirs of mainMsTask.py')
+    parser.add_argument('--outDir', type=str, default='./ms_targets', help='Directory to save the targets')
+    parser.add_argument('--workers', type=int, default=16, help='Instances processed in parallel')
+
+    args = parser.parse_args()
+
+    main_run(args.datasetDir, args.outDir, args.workers)
+
+if __name__ == '__main__':
+    __main__()
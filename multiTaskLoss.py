@@ -0,0 +1,41 @@
+class MultiTaskLoss(object):
+    """Weighted sum of the losses of several outputs of a model, e.g. the action logits and the
+    output_msnet head of attentionModel_ml, so that one backward goes through the shared trunk.
+
+    Args:
+        losses (dict): Task name -> loss function(output, target).
+        weights (dict, optional): Task name -> weight of its loss in the sum, 1 by default.
+    """
+
+    def __init__(self, losses, weights=None):
+        self.losses = losses
+        self.weights = dict(weights or {})
+        self.reset()
+
+    def __call__(self, outputs, targets):
+        """Returns (total, task_losses) for the tasks present in outputs.
+        The unweighted loss of each task is also summed up for averages().
+        """
+        total = 0
+        task_losses = {}
+        for task in sorted(outputs):
+            loss = self.losses[task](outputs[task], targets[task])
+            task_losses[task] = loss
+            total = total + self.weights.get(task, 1.0) * loss
+            # kept on the device, read once per epoch
+            self.sums[task] = self.sums.get(task, 0) + loss.detach()
+            self.counts[task] = self.counts.get(task, 0) + 1
+        return total, task_losses
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def averages(self):
+        """Average loss of each task since the last reset"""
+        return {task: float(self.sums[task]) / self.counts[task] for task in self.sums}
+
+    def log(self, writer, prefix, epoch):
+        """Writes the average of each task, as <prefix>/loss_<task>, to a tensorboard SummaryWriter"""
+        for task, value in sorted(self.averages().items()):
+            writer.add_scalar('{}/loss_{}'.format(prefix, task), value, epoch)
@@ -4,6 +4,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from torch.autograd import Variable
 from MyConvLSTMCell import *
+from timeDistributed import time_distributed
 
 
 class attentionModel(nn.Module):
@@ -21,22 +22,40 @@ class attentionModel(nn.Module):
         self.classifier = nn.Sequential(self.dropout, self.fc)
 
     def forward(self, inputVariable):
-        state = (Variable(torch.zeros((inputVariable.size(1), self.mem_size, 7, 7)).cuda()),
-                 Variable(torch.zeros((inputVariable.size(1), self.mem_size, 7, 7)).cuda()))
-        for t in range(inputVariable.size(0)):
-            logit, feature_conv, feature_convNBN = self.resNet(inputVariable[t])
-            if self.attention == 1: 
-                bz, nc, h, w = feature_conv.size()
-                feature_conv1 = feature_conv.view(bz, nc, h*w)
-                probs, idxs = logit.sort(1, True)
-                class_idx = idxs[:, 0]
-                cam = torch.bmm(self.weight_softmax[class_idx].unsqueeze(1), feature_conv1)
-                attentionMAP = torch.softmax(cam.squeeze(1), dim=1)
-                attentionMAP = attentionMAP.view(attentionMAP.size(0), 1, 7, 7)
-                attentionFeat = feature_convNBN * attentionMAP.expand_as(feature_conv)
-                state = self.lstm_cell(attentionFeat, state)
-            elif self.attention == 0:
-                state = self.lstm_cell(feature_conv, state)
+        return self.forward_features(self.features(inputVariable))
+
+    def forward_layer3(self, layer3):
+        """Forward from the layer3 activations of the clip, e.g. read from extractFeatures.py --level layer3"""
+        return self.forward_features(self.features_layer3(layer3))
+
+    def features(self, inputVariable):
+        """ConvLSTM input (T x B x 512 x 7 x 7) of a clip: the CAM weighted features, or the plain ones without attention"""
+        return self.features_layer3(time_distributed(self.resNet.forward_prefix, inputVariable, self.resNet))
+
+    def features_layer3(self, layer3):
+        """Same as features, from the layer3 activations (T x B x 256 x 14 x 14) of the clip"""
+        # backbone and attention of all the frames at once, (T*B) x ...
+        seq_len = layer3.size(0)
+        logit, feature_conv, feature_convNBN = time_distributed(self.resNet.forward_layer4, layer3, self.resNet)
+        if self.attention == 0:
+            return feature_conv
+        _, bz, nc, h, w = feature_conv.size()
+        feature_conv1 = feature_conv.view(seq_len*bz, nc, h*w)
+        # CAM of the top scoring class of each frame
+        class_idx = logit.view(seq_len*bz, -1).argmax(1)
+        # the CAM and its softmax stay in fp32 under autocast
+        with torch.autocast(feature_conv.device.type, enabled=False):
+            cam = torch.bmm(self.weight_softmax[class_idx].unsqueeze(1), feature_conv1.float())
+            attentionMAP = torch.softmax(cam.squeeze(1), dim=1)
+        attentionMAP = attentionMAP.view(seq_len, bz, 1, 7, 7)
+        return feature_convNBN * attentionMAP.expand_as(feature_conv)
+
+    def forward_features(self, lstm_input):
+        """Rest of the forward from the output of features, e.g. read from extractFeatures.py"""
+        # initial state on the device of the input
+        state = (lstm_input.new_zeros((lstm_input.size(1), self.mem_size, 7, 7)),
+                 lstm_input.new_zeros((lstm_input.size(1), self.mem_size, 7, 7)))
+        state = self.lstm_cell.forward_sequence(lstm_input, state)
         feats1 = self.avgpool(state[1]).view(state[1].size(0), -1)
         feats = self.classifier(feats1)
         return feats, feats1
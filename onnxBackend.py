@@ -0,0 +1,76 @@
+import os
+import copy
+import tempfile
+import torch
+
+# Inputs and outputs of each model (names of benchmark.make_model) with their batch axis. The clips are
+# (T x B x C x H x W) and the flow stacks (B x 2*stackSize x H x W), the MS head output is (T x B x 49 x 2).
+INPUTS = {'rgb': [('frames', 1)],
+          'ms': [('frames', 1)],
+          'flow': [('flow', 0)],
+          'rgbflow': [('flow', 1), ('frames', 1)],
+          'twoStream': [('flow', 0), ('frames', 1)]}
+OUTPUTS = {'rgb': [('logits', 0), ('feats1', 0)],
+           'ms': [('logits', 0), ('ms', 1)],
+           'flow': [('logits', 0), ('feats1', 0), ('conv', 0)],
+           'rgbflow': [('logits', 0), ('feats1', 0)],
+           'twoStream': [('logits', 0)]}
+
+
+def export_onnx(model, model_name, example_inputs, path, opset=17):
+    """Exports a model in eval mode to ONNX, with a dynamic batch size.
+
+    The export traces the forward, so the ConvLSTM recurrence is unrolled over the timesteps of
+    example_inputs: the graph only takes clips of that seqLen. The flow stacks have no such constraint.
+    """
+    model = copy.deepcopy(model).train(False).cpu().to(memory_format=torch.contiguous_format)
+    inputs, outputs = INPUTS[model_name], OUTPUTS[model_name]
+    dynamic_axes = {name: {axis: 'batch'} for name, axis in inputs + outputs}
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(x.cpu() for x in example_inputs), path,
+                          input_names=[name for name, _ in inputs], output_names=[name for name, _ in outputs],
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    return path
+
+
+class OrtModel(object):
+    """onnxruntime session of an exported model, called like the torch model: it takes torch tensors and
+    returns torch tensors on device (a tuple when the model has several outputs). onnxruntime is only
+    needed here.
+
+    The session applies all the ORT graph optimizations (constant folding, node fusions, layout
+    transformations). It runs on cpu, or on cuda when device is cuda and onnxruntime-gpu is installed.
+
+    Args:
+        path (str): .onnx file.
+        device (torch.device): Device of the returned tensors.
+        threads (int): Intra-op threads of the session, 0 keeps the ORT default (the physical cores).
+    """
+
+    def __init__(self, path, device, threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        self.device = device
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().cpu().float().contiguous().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(y).to(self.device) for y in self.session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def onnx_model(model, model_name, example_inputs, device, threads=0, path=None):
+    """OrtModel of model, exported to path, or to a temporary file when path is None"""
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), model_name + '.onnx')
+    export_onnx(model, model_name, example_inputs, path)
+    print('ONNX model exported to {}'.format(path))
+    return OrtModel(path, device, threads)
@@ -0,0 +1,71 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from datasetManifest import load_manifest, manifest_trees, save_manifest, manifest_path, LEAVES
+from spatial_transforms import Scale
+
+
+def plan_resize(root_dir, out_dir, manifest):
+    """Lists (source, destination, mode) for every png of the dataset"""
+    jobs = []
+    for tree in manifest_trees(manifest):
+        for user, u in sorted(manifest['trees'][tree]['users'].items()):
+            for target, c in sorted(u['classes'].items()):
+                for inst in sorted(c['insts']):
+                    for leaf in LEAVES.get(tree, ('',)):
+                        rel_dir = os.path.join(tree, user, target, inst, leaf)
+                        src_dir = os.path.join(root_dir, rel_dir)
+                        if not os.path.isdir(src_dir):
+                            continue
+                        # same modes the datasets convert to, so resizing commutes with convert()
+                        mode = 'RGB' if leaf == 'rgb' else 'L'
+                        for name in sorted(n for n in os.listdir(src_dir) if n.endswith('.png')):
+                            jobs.append((os.path.join(src_dir, name), os.path.join(out_dir, rel_dir, name), mode))
+    return jobs
+
+
+def resize_frame(src, dst, mode, scale, resume):
+    if resume and os.path.exists(dst):
+        return
+    img = scale(Image.open(src).convert(mode), False, False)
+    tmp = dst + '.tmp'
+    img.save(tmp, 'PNG')
+    os.replace(tmp, dst)
+
+
+def pre_resize(root_dir, out_dir, size, workers=16, resume=True):
+    """Writes a copy of root_dir with every frame scaled to the given short side,
+    with the same Scale(size) the training and eval scripts apply on the fly."""
+    jobs = plan_resize(root_dir, out_dir, load_manifest(root_dir))
+    for d in sorted(set(os.path.dirname(dst) for _, dst, _ in jobs)):
+        os.makedirs(d, exist_ok=True)
+    scale = Scale(size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda job: resize_frame(job[0], job[1], job[2], scale, resume), jobs))
+
+    manifest = load_manifest(out_dir)
+    manifest['short_side'] = size
+    save_manifest(manifest, manifest_path(out_dir))
+    return len(jobs)
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetDir', type=str, required=True, help='Dataset directory')
+    parser.add_argument('--outDir', type=str, required=True,
+                        help='Output directory, one <outDir>/<size> dataset is written per size')
+    parser.add_argument('--sizes', type=int, default=[256], nargs="+", help='Short sides to scale the frames to')
+    parser.add_argument('--workers', type=int, default=16, help='Frames resized in parallel')
+    parser.add_argument('--overwrite', action='store_true', help='Resize frames already present in outDir again')
+
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        out_dir = os.path.join(args.outDir, str(size))
+        numFrames = pre_resize(args.datasetDir, out_dir, size, args.workers, not args.overwrite)
+        print('Scaled {} frames to {} in {}'.format(numFrames, size, out_dir))
+
+
+if __name__ == '__main__':
+    __main__()
@@ -1,45 +1,141 @@
 import os
-import glob
-
-label_dir = './labels' # Dir containing the labels
-src_img_dir = './images/frames' # Dir containing the frames/flow
-des_img_dir = './gtea_dataset/frames' # Dir to which the images have to be copied
-
-label_files = glob.glob1(label_dir, '*.txt')
-action_inst = {}
-for label_file in sorted(label_files):
-    print(label_file)
-    file = os.path.join(label_dir, label_file)
-    sub_dir = label_file[:2]
-    label_fl = open(file, 'r')
-    annots = label_fl.readlines()
-    for line1 in annots:
-        if '><' in line1:
-            w1b = line1.find('<')
-            w2b = line1.find('<', w1b+1)
-            w1e = line1.find('>')
-            w2e = line1.find('>', w1e+1)
-            action_name = line1[w1b+1:w1e] + '_' + line1[w2b+1:w2e]
-            if action_name == 'stir_cup':
-                action_name = 'stir_spoon,cup'
-            action_dir = os.path.join(des_img_dir, sub_dir, action_name)
-            if not os.path.exists(action_dir):
-                os.makedirs(action_dir)
-                action_inst[action_name] = 1
-            des_dir = os.path.join(action_dir, str(action_inst[action_name]))
-            action_inst[action_name] += 1
-            os.makedirs(des_dir)
-            f1 = line1.find('(')
-            f2 = line1.find('-')
-            f3 = line1.find(')')
-            start_frame = line1[f1+1:f2]
-            end_frame = line1[f2+1:f3]
-            frame_ind = 0
-            for f in range(int(start_frame), int(end_frame)+1):
-                frame_name = src_img_dir + '/' + label_file[:-4] + '/' + str(f).zfill(5) + '.jpg'
-                cmd = 'cp ' + frame_name + ' ' + des_dir + '/image_' + str(frame_ind).zfill(5) + '.jpg'
-                os.system(cmd)
-                frame_ind += 1
-
-os.system('rm -rf ' + des_img_dir + '/S1/put_tea')
-os.system('rm -rf ' + des_img_dir + '/S2/put_tea')
+import sys
+import errno
+import fcntl
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+FICLONE = 0x40049409  # linux/fs.h, clone a file's extents (reflink) on btrfs/xfs
+
+# Action renamed so that it matches the GTEA61 class list
+RENAMED_ACTIONS = {'stir_cup': 'stir_spoon,cup'}
+# (subject, action) pairs left out of the dataset
+REMOVED_ACTIONS = {('S1', 'put_tea'), ('S2', 'put_tea')}
+
+
+def parse_labels(label_dir):
+    """Reads every label file once.
+    Returns a list of (label file, subject dir, action name, start frame, end frame)."""
+    annotations = []
+    for label_file in sorted(f for f in os.listdir(label_dir) if f.endswith('.txt') and not f.startswith('.')):
+        sub_dir = label_file[:2]
+        with open(os.path.join(label_dir, label_file), 'r') as label_fl:
+            annots = label_fl.readlines()
+        for line1 in annots:
+            if '><' in line1:
+                w1b = line1.find('<')
+                w2b = line1.find('<', w1b+1)
+                w1e = line1.find('>')
+                w2e = line1.find('>', w1e+1)
+                action_name = line1[w1b+1:w1e] + '_' + line1[w2b+1:w2e]
+                action_name = RENAMED_ACTIONS.get(action_name, action_name)
+                f1 = line1.find('(')
+                f2 = line1.find('-')
+                f3 = line1.find(')')
+                start_frame = int(line1[f1+1:f2])
+                end_frame = int(line1[f2+1:f3])
+                annotations.append((label_file, sub_dir, action_name, start_frame, end_frame))
+    return annotations
+
+
+def plan_copies(annotations, src_img_dir, des_img_dir):
+    """Numbers the instances of each action per subject and lists every (source, destination) frame.
+    Returns (instance dirs, [(src, dst), ...])."""
+    action_inst = {}
+    inst_dirs = []
+    pairs = []
+    for label_file, sub_dir, action_name, start_frame, end_frame in annotations:
+        key = (sub_dir, action_name)
+        action_inst[key] = action_inst.get(key, 0) + 1
+        if key in REMOVED_ACTIONS:
+            continue
+        des_dir = os.path.join(des_img_dir, sub_dir, action_name, str(action_inst[key]))
+        inst_dirs.append(des_dir)
+        for frame_ind, f in enumerate(range(start_frame, end_frame + 1)):
+            frame_name = src_img_dir + '/' + label_file[:-4] + '/' + str(f).zfill(5) + '.jpg'
+            pairs.append((frame_name, des_dir + '/image_' + str(frame_ind).zfill(5) + '.jpg'))
+    return inst_dirs, pairs
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def materialize(src, dst, method):
+    """Creates dst from src with a hardlink or reflink when possible, else a buffered copy"""
+    if method in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if method == 'hardlink' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if method in ('auto', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if method == 'reflink':
+                raise
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def main_run(label_dir, src_img_dir, des_img_dir, method, workers, dry_run, resume):
+    annotations = parse_labels(label_dir)
+    inst_dirs, pairs = plan_copies(annotations, src_img_dir, des_img_dir)
+    print('{} instances, {} frames to {}'.format(len(inst_dirs), len(pairs), des_img_dir))
+
+    removed_dirs = [os.path.join(des_img_dir, sub_dir, action_name) for sub_dir, action_name in sorted(REMOVED_ACTIONS)]
+    if dry_run:
+        for src, dst in pairs[:10]:
+            print('{} -> {}'.format(src, dst))
+        for d in removed_dirs:
+            if os.path.exists(d):
+                print('would remove {}'.format(d))
+        return
+
+    for d in removed_dirs:
+        if os.path.exists(d):
+            shutil.rmtree(d)
+
+    for des_dir in inst_dirs:
+        os.makedirs(des_dir, exist_ok=resume)
+
+    if resume:
+        pairs = [(src, dst) for src, dst in pairs if not os.path.exists(dst)]
+        print('{} frames left to materialize'.format(len(pairs)))
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for used in pool.map(lambda pair: materialize(pair[0], pair[1], method), pairs):
+            counts[used] = counts.get(used, 0) + 1
+    print('Done: ' + ', '.join('{} {}'.format(n, m) for m, n in sorted(counts.items())))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--labelDir', type=str, default='./labels', help='Dir containing the labels')
+    parser.add_argument('--srcDir', type=str, default='./images/frames', help='Dir containing the frames/flow')
+    parser.add_argument('--desDir', type=str, default='./gtea_dataset/frames',
+                        help='Dir to which the images have to be copied')
+    parser.add_argument('--method', type=str, default='auto', choices=['auto', 'hardlink', 'reflink', 'copy'],
+                        help='How frames are materialized, auto tries hardlink, then reflink, then copy')
+    parser.add_argument('--workers', type=int, default=16, help='Frames materialized in parallel')
+    parser.add_argument('--dryRun', action='store_true', help='Only print the plan')
+    parser.add_argument('--resume', action='store_true', help='Skip frames already present in desDir')
+
+    args = parser.parse_args()
+
+    if not args.resume and not args.dryRun and os.path.exists(args.desDir) and os.listdir(args.desDir):
+        print('Directory {} is not empty, use --resume to complete it'.format(args.desDir))
+        sys.exit()
+
+    main_run(args.labelDir, args.srcDir, args.desDir, args.method, args.workers, args.dryRun, args.resume)
+
+if __name__ == '__main__':
+    __main__()
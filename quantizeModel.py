@@ -0,0 +1,199 @@
+import io
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, get_default_qconfig_mapping, prepare, convert
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from MyConvLSTMCell import MyConvLSTMCell
+from foldModel import BACKBONES
+from benchmark import make_model
+from exportModel import clip_loader, model_inputs, logits
+from metrics import ClassificationMetrics
+from evalEngine import evaluate
+from devices import setup_device, prepare_model
+
+
+def quantized_engine():
+    """Quantized kernels of the machine: x86 (fbgemm with oneDNN) or fbgemm on x86, qnnpack on arm"""
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError('No quantized engine in this torch build')
+
+
+class _Method(nn.Module):
+    """Module whose forward is a method of module, e.g. ResNet.forward_prefix, for the FX tracer"""
+
+    def __init__(self, module, method):
+        super(_Method, self).__init__()
+        self.module = module
+        self.method = method
+
+    def forward(self, x):
+        return getattr(self.module, self.method)(x)
+
+
+class QuantizedResNet(nn.Module):
+    """int8 copy of a resnetMod or flow_resnet ResNet, with the forward_prefix and forward_layer4 the
+    recurrent models call. Each part is an FX graph with float inputs and outputs: the convs, BatchNorms
+    (fused), ReLUs, poolings and residual adds run in int8, the fc stays in float, its logits select
+    the class of the CAM.
+    """
+
+    def __init__(self, prefix, layer4):
+        super(QuantizedResNet, self).__init__()
+        self.prefix = prefix
+        self.layer4 = layer4
+
+    def forward(self, x):
+        return self.forward_layer4(self.forward_prefix(x))
+
+    def forward_prefix(self, x):
+        return self.prefix(x)
+
+    def forward_layer4(self, x):
+        return self.layer4(x)
+
+
+def prepare_resnet(resnet, qconfig_mapping):
+    """QuantizedResNet of a float ResNet with observers in place of the quantized ops, to be calibrated"""
+    resnet = copy.deepcopy(resnet).cpu().train(False)
+    example = torch.zeros(1, resnet.conv1.in_channels, 224, 224)
+    with torch.no_grad():
+        layer3 = resnet.forward_prefix(example)
+    # the GraphModules only keep the modules of their part
+    prefix = prepare_fx(_Method(copy.deepcopy(resnet), 'forward_prefix'), qconfig_mapping, (example,))
+    layer4 = prepare_fx(_Method(resnet, 'forward_layer4'), qconfig_mapping, (layer3,))
+    return QuantizedResNet(prefix, layer4)
+
+
+def prepare_cell(cell, qconfig):
+    """Observes, in place, the input and hidden convolutions of a MyConvLSTMCell. The gates, the cell
+    state ct and the hidden state between the steps stay in float.
+    """
+    for name in ('conv_xx', 'conv_hh'):
+        wrapper = QuantWrapper(getattr(cell, name))
+        wrapper.qconfig = qconfig
+        prepare(wrapper, inplace=True)
+        setattr(cell, name, wrapper)
+
+
+def _get(model, path):
+    for name in path.split('.') if path else []:
+        model = getattr(model, name)
+    return model
+
+
+def quantize_model(model, calib_batches, lstm=True, engine=None):
+    """Static int8 post-training quantization of a float model (see foldModel.BACKBONES).
+
+    The backbones, and with lstm the ConvLSTM convolutions, are quantized with observers calibrated
+    on the forwards of calib_batches (tuples of model inputs). The CAM, the softmaxes, the MS head and
+    the classifiers stay in float. Returns the quantized copy, for cpu inference.
+    """
+    engine = engine or quantized_engine()
+    torch.backends.quantized.engine = engine
+    if type(model) not in BACKBONES:
+        raise ValueError('Cannot quantize {}'.format(type(model).__name__))
+    model = copy.deepcopy(model).cpu().train(False)
+    qconfig_mapping = get_default_qconfig_mapping(engine).set_object_type(nn.Linear, None)
+    backbones = []
+    for path, _ in BACKBONES[type(model)]:
+        backbone = prepare_resnet(_get(model, path), qconfig_mapping)
+        if not path:
+            model = backbone
+        else:
+            parent, _, name = path.rpartition('.')
+            setattr(_get(model, parent), name, backbone)
+        backbones.append(backbone)
+    cells = [m for m in model.modules() if isinstance(m, MyConvLSTMCell)] if lstm else []
+    for cell in cells:
+        prepare_cell(cell, get_default_qconfig(engine))
+
+    with torch.no_grad():
+        for inputs in calib_batches:
+            model(*inputs)
+
+    for backbone in backbones:
+        backbone.prefix = convert_fx(backbone.prefix)
+        backbone.layer4 = convert_fx(backbone.layer4)
+    for cell in cells:
+        convert(cell.conv_xx, inplace=True)
+        convert(cell.conv_hh, inplace=True)
+    return model
+
+
+def size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def main_run(model_name, model_state_dict, dataset_dir, calib_dir, out_file, num_classes, batchSize, seqLen,
+             stackSize, numCalibClips, fmt, cpuThreads=0):
+    # quantized kernels run on cpu
+    device = setup_device('cpu', cpuThreads)
+    model = make_model(model_name, num_classes, stackSize)
+    if model_state_dict is not None:
+        model.load_state_dict(torch.load(model_state_dict, map_location='cpu'))
+    model.train(False)
+    for params in model.parameters():
+        params.requires_grad = False
+
+    calib_batches = []
+    for batch in clip_loader(model_name, calib_dir or dataset_dir, batchSize, seqLen, stackSize, fmt):
+        calib_batches.append(model_inputs(model_name, batch))
+        if len(calib_batches) * batchSize >= numCalibClips:
+            break
+    print('Calibration on {} clips'.format(len(calib_batches) * batchSize))
+
+    variants = [('float', prepare_model(copy.deepcopy(model), device)),
+                ('int8 backbones', quantize_model(model, calib_batches, lstm=False))]
+    if any(isinstance(m, MyConvLSTMCell) for m in model.modules()):
+        variants.append(('int8 backbones + ConvLSTM', quantize_model(model, calib_batches, lstm=True)))
+
+    # the whole test set, the eager and FX models take any batch size
+    test_loader = clip_loader(model_name, dataset_dir, batchSize, seqLen, stackSize, fmt, drop_last=False)
+    reference = None
+    for name, variant in variants:
+        result = evaluate(lambda *inputs: logits(variant(*model_inputs(model_name, inputs))), test_loader, device,
+                          ClassificationMetrics(num_classes))
+        if reference is None:
+            reference = result
+        print('{} {}: accuracy = {:.2f}% ({:+.2f}) | {:.2f} clips/s ({:.2f}x) | {:.1f} MB'.format(
+            model_name, name, result['accuracy'], result['accuracy'] - reference['accuracy'],
+            result['clips_per_sec'], result['clips_per_sec'] / reference['clips_per_sec'], size_mb(variant)))
+
+    if out_file is not None:
+        torch.save(variants[-1][1], out_file)
+        print('{} model saved to {}'.format(variants[-1][0], out_file))
+
+
+def __main__():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='rgb', choices=['rgb', 'ms', 'flow', 'rgbflow', 'twoStream'],
+                        help='Model to quantize')
+    parser.add_argument('--modelStateDict', type=str, default=None, help='Trained model path')
+    parser.add_argument('--datasetDir', type=str, default='./dataset/gtea_warped_flow_61/split2/test',
+                        help='Test set of the accuracy and speed comparison')
+    parser.add_argument('--calibDir', type=str, default=None,
+                        help='Dataset whose first clips calibrate the observers, e.g. the train split, datasetDir by default')
+    parser.add_argument('--numCalibClips', type=int, default=64, help='Clips of the calibration')
+    parser.add_argument('--outFile', type=str, default=None,
+                        help='Save the fully quantized model (torch.save of the module)')
+    parser.add_argument('--numClasses', type=int, default=61, help='Number of classes')
+    parser.add_argument('--batchSize', type=int, default=8, help='Clips per forward')
+    parser.add_argument('--seqLen', type=int, default=25, help='Length of sequence')
+    parser.add_argument('--stackSize', type=int, default=5, help='Number of optical flow images in input')
+    parser.add_argument('--fmt', type=str, default='.jpg', help='Frame file extension of the dataset')
+    parser.add_argument('--cpuThreads', type=int, default=0,
+                        help='Intra-op threads on cpu, 0 keeps the torch default')
+
+    args = parser.parse_args()
+
+    main_run(args.model, args.modelStateDict, args.datasetDir, args.calibDir, args.outFile, args.numClasses,
+             args.batchSize, args.seqLen, args.stackSize, args.numCalibClips, args.fmt, args.cpuThreads)
+
+if __name__ == '__main__':
+    __main__()
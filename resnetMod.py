@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import math
 import torch.utils.model_zoo as model_zoo
@@ -99,11 +100,15 @@ class Bottleneck(nn.Module):
 
 
 class ResNet(nn.Module):
+    # modules run by forward_prefix and by forward_layer4. The first no_grad_parts of them are
+    # frozen and run without autograd, see freezePlanner.py
+    PARTS = (('conv1', 'bn1', 'layer1', 'layer2', 'layer3'), ('layer4', 'fc'))
 
     def __init__(self, block, layers, num_classes=1000, noBN=False):
         self.inplanes = 64
         self.noBN = noBN
         super(ResNet, self).__init__()
+        self.no_grad_parts = 0
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(64)
@@ -154,14 +159,26 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
+        return self.forward_layer4(self.forward_prefix(x))
+
+    def forward_prefix(self, x):
+        """conv1 to layer3, the part left frozen in stage 2 (N x 256 x 14 x 14 for 224 x 224 inputs)"""
+        with torch.set_grad_enabled(torch.is_grad_enabled() and self.no_grad_parts < 1):
+            x = self.conv1(x)
+            x = self.bn1(x)
+            x = self.relu(x)
+            x = self.maxpool(x)
+
+            x = self.layer1(x)
+            x = self.layer2(x)
+            return self.layer3(x)
+
+    def forward_layer4(self, x):
+        """Rest of the forward from the output of forward_prefix"""
+        with torch.set_grad_enabled(torch.is_grad_enabled() and self.no_grad_parts < 2):
+            return self._forward_layer4(x)
+
+    def _forward_layer4(self, x):
         if self.noBN:
             conv_layer4BN, conv_layer4NBN = self.layer4(x)
         else:
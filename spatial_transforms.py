@@ -4,6 +4,7 @@ import numbers
 import collections
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image, ImageOps
 try:
     import accimage
@@ -11,6 +12,27 @@ except ImportError:
     accimage = None
 
 
+def stack_clip(imgs):
+    """Stacks the PIL images of a clip into a uint8 tensor of shape (T x C x H x W)"""
+    arrays = np.stack([np.asarray(img) for img in imgs])
+    if arrays.ndim == 3:
+        arrays = arrays[..., None]
+    return torch.from_numpy(arrays).permute(0, 3, 1, 2)
+
+
+def resize_clip(clip, size):
+    """Bilinear resize of a uint8 (... x H x W) tensor to size (h, w), rounded back to uint8.
+    An approximation of the PIL bilinear resize of the frame transforms: the antialiased kernel and the
+    rounding differ, some pixels are off by one.
+    """
+    if tuple(clip.shape[-2:]) == tuple(size):
+        return clip
+    shape = clip.shape
+    out = F.interpolate(clip.reshape(-1, shape[-3], shape[-2], shape[-1]).float(), size=size,
+                        mode='bilinear', align_corners=False, antialias=True)
+    return out.round_().clamp_(0, 255).to(torch.uint8).reshape(shape[:-2] + out.shape[-2:])
+
+
 class Compose(object):
     """Composes several transforms together.
     Args:
@@ -30,6 +52,34 @@ class Compose(object):
             img = t(img, inv, flow)
         return img
 
+    def clip(self, clip, inv=False, flow=False):
+        """Transforms a whole clip at once with the current random parameters.
+        Args:
+            clip (list of PIL.Image or uint8 Tensor of shape (T x C x H x W)): Frames of the clip.
+        Returns:
+            Tensor: Stack of the outputs of __call__ on every frame, up to the resizes: resize_clip is
+            off by one on some pixels of PIL's, so thresholded outputs (e.g. Binary) can differ.
+        """
+        if isinstance(clip, (list, tuple)):
+            if not self.has_clip():
+                return torch.stack([self(img, inv, flow) for img in clip], 0)
+            clip = stack_clip(clip)
+        i = 0
+        while i < len(self.transforms):
+            t = self.transforms[i]
+            nxt = self.transforms[i + 1] if i + 1 < len(self.transforms) else None
+            if isinstance(t, ToTensor) and isinstance(nxt, Normalize):
+                # float conversion and normalization in one pass
+                clip = nxt.clip(clip, inv, flow, norm_value=t.norm_value)
+                i += 2
+            else:
+                clip = t.clip(clip, inv, flow)
+                i += 1
+        return clip
+
+    def has_clip(self):
+        return all(t.has_clip() if isinstance(t, Compose) else hasattr(t, 'clip') for t in self.transforms)
+
     def randomize_parameters(self):
         for t in self.transforms:
             t.randomize_parameters()
@@ -85,6 +135,9 @@ class ToTensor(object):
         else:
             return img
 
+    def clip(self, clip, inv, flow):
+        return clip.float().div_(self.norm_value)
+
     def randomize_parameters(self):
         pass
 
@@ -122,6 +175,22 @@ class Normalize(object):
             t.sub_(m).div_(s)
         return tensor
 
+    def clip(self, clip, inv, flow, norm_value=None):
+        """Normalizes a float tensor of shape (... x C x H x W), e.g. a clip or a collated batch.
+        With norm_value, clip holds raw uint8 values and is converted to float in the same pass."""
+        if flow is True:
+            mean = [np.mean(self.mean)]
+            std = [np.mean(self.std)]
+        else:
+            mean = self.mean
+            std = self.std
+        scale = 1 if norm_value is None else norm_value
+        mean = torch.tensor(mean, dtype=torch.float32, device=clip.device).view(-1, 1, 1) * scale
+        std = torch.tensor(std, dtype=torch.float32, device=clip.device).view(-1, 1, 1) * scale
+        if norm_value is None:
+            return clip.sub(mean).div_(std)
+        return clip.float().sub_(mean).div_(std)
+
     def randomize_parameters(self):
         pass
 
@@ -165,10 +234,66 @@ class Scale(object):
         else:
             return img.resize(self.size, self.interpolation)
 
+    def clip(self, clip, inv, flow):
+        h, w = clip.shape[-2:]
+        if isinstance(self.size, int):
+            if (w <= h and w == self.size) or (h <= w and h == self.size):
+                return clip
+            if w < h:
+                return resize_clip(clip, (int(self.size * h / w), self.size))
+            return resize_clip(clip, (self.size, int(self.size * w / h)))
+        return resize_clip(clip, (self.size[1], self.size[0]))
+
     def randomize_parameters(self):
         pass
 
 
+def transform_steps(transform):
+    if isinstance(transform, Compose):
+        return [s for t in transform.transforms for s in transform_steps(t)]
+    return [transform]
+
+
+def view_choices(t):
+    """Values the random parameters of a transform step can take, None if it has none"""
+    if isinstance(t, RandomHorizontalFlip):
+        return [False, True]
+    if isinstance(t, MultiScaleCornerCrop):
+        return [(scale, position) for scale in t.scales for position in t.crop_positions]
+    return None
+
+
+def enumerate_views(transform):
+    """Lists every combination of random parameters of a transform, in the form used by get_view/set_view"""
+    views = [()]
+    for t in transform_steps(transform):
+        choices = view_choices(t)
+        if choices is not None:
+            views = [v + (c,) for v in views for c in choices]
+    return views
+
+
+def get_view(transform):
+    """Random parameters currently drawn by a transform"""
+    view = ()
+    for t in transform_steps(transform):
+        if isinstance(t, RandomHorizontalFlip):
+            view += (t.p < 0.5,)
+        elif isinstance(t, MultiScaleCornerCrop):
+            view += ((t.scale, t.crop_position),)
+    return view
+
+
+def set_view(transform, view):
+    """Fixes the random parameters of a transform to one of enumerate_views"""
+    view = list(view)
+    for t in transform_steps(transform):
+        if isinstance(t, RandomHorizontalFlip):
+            t.p = 0.0 if view.pop(0) else 1.0
+        elif isinstance(t, MultiScaleCornerCrop):
+            t.scale, t.crop_position = view.pop(0)
+
+
 class CenterCrop(object):
     """Crops the given PIL.Image at the center.
     Args:
@@ -196,6 +321,13 @@ class CenterCrop(object):
         y1 = int(round((h - th) / 2.))
         return img.crop((x1, y1, x1 + tw, y1 + th))
 
+    def clip(self, clip, inv, flow):
+        h, w = clip.shape[-2:]
+        th, tw = self.size
+        x1 = int(round((w - tw) / 2.))
+        y1 = int(round((h - th) / 2.))
+        return clip[..., y1:y1 + th, x1:x1 + tw]
+
     def randomize_parameters(self):
         pass
 
@@ -216,6 +348,13 @@ class RandomHorizontalFlip(object):
                 img = ImageOps.invert(img)
         return img
 
+    def clip(self, clip, inv, flow):
+        if self.p < 0.5:
+            clip = clip.flip(-1)
+            if inv is True:
+                clip = 255 - clip
+        return clip
+
     def randomize_parameters(self):
         self.p = random.random()
 
@@ -240,11 +379,17 @@ class MultiScaleCornerCrop(object):
 
     def __call__(self, img, inv, flow):
         # print(img.size[0])
-        min_length = min(img.size[0], img.size[1])
-        crop_size = int(min_length * self.scale)
+        img = img.crop(self.crop_box(img.size[0], img.size[1]))
 
-        image_width = img.size[0]
-        image_height = img.size[1]
+        return img.resize((self.size, self.size), self.interpolation)
+
+    def clip(self, clip, inv, flow):
+        x1, y1, x2, y2 = self.crop_box(clip.shape[-1], clip.shape[-2])
+        return resize_clip(clip[..., y1:y2, x1:x2], (self.size, self.size))
+
+    def crop_box(self, image_width, image_height):
+        min_length = min(image_width, image_height)
+        crop_size = int(min_length * self.scale)
 
         if self.crop_position == 'c':
             center_x = image_width // 2
@@ -275,9 +420,7 @@ class MultiScaleCornerCrop(object):
             x2 = image_width
             y2 = image_height
 
-        img = img.crop((x1, y1, x2, y2))
-
-        return img.resize((self.size, self.size), self.interpolation)
+        return x1, y1, x2, y2
 
     def randomize_parameters(self):
         self.scale = self.scales[random.randint(0, len(self.scales) - 1)]
@@ -427,8 +570,11 @@ class Binary(object):
         self.threshold=threshold
     
     def __call__(self, img_tensor, inv, flow):
-        img_tensor.map_(img_tensor,lambda x,_ : 1 if x>self.threshold else 0)
-        return img_tensor
+        # compared in double precision, like the python floats of the former map_ lambda
+        return (img_tensor.double() > self.threshold).to(img_tensor.dtype)
+
+    def clip(self, clip, inv, flow):
+        return (clip.double() > self.threshold).float()
     
     def randomize_parameters(self):
         pass
@@ -0,0 +1,35 @@
+import torch
+import torch.nn as nn
+
+
+def batchnorm_training(*modules):
+    """True if a BatchNorm layer of modules is in training mode"""
+    return any(isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training
+               for module in modules for m in module.modules())
+
+
+def _unfold(out, seq_len):
+    if isinstance(out, tuple):
+        return tuple(_unfold(o, seq_len) for o in out)
+    return out.view(seq_len, out.size(0) // seq_len, *out.shape[1:])
+
+
+def _stack(outs):
+    if isinstance(outs[0], tuple):
+        return tuple(_stack(o) for o in zip(*outs))
+    return torch.stack(outs, 0)
+
+
+def time_distributed(fn, x, *modules):
+    """Applies fn to every frame of a (T x B x ...) sequence and returns its output(s) as (T x B x ...).
+
+    The frames of all timesteps go through fn as one batch of T*B. When a BatchNorm of
+    modules (fn itself by default) is in training mode, its batch statistics would then mix
+    timesteps, so fn is run frame by frame instead, as the recurrent models used to do.
+    """
+    if not modules:
+        modules = (fn,)
+    seq_len = x.size(0)
+    if batchnorm_training(*modules):
+        return _stack([fn(x[t]) for t in range(seq_len)])
+    return _unfold(fn(x.reshape(seq_len * x.size(1), *x.shape[2:])), seq_len)